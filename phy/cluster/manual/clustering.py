@@ -18,18 +18,27 @@ from phy.utils.event import EventEmitter
 
 
 #------------------------------------------------------------------------------
-# Clustering class
+# Utility functions
 #------------------------------------------------------------------------------
 
-def _extend_spikes(spike_ids, spike_clusters):
+def _extend_spikes(spike_ids, spike_clusters, spikes_in_clusters=None):
     """Return all spikes belonging to the clusters containing the specified
-    spikes."""
+    spikes.
+
+    An optional `spikes_in_clusters(clusters)` function can be passed to
+    avoid a full scan of `spike_clusters`.
+
+    """
     # We find the spikes belonging to modified clusters.
     # What are the old clusters that are modified by the assignment?
     old_spike_clusters = spike_clusters[spike_ids]
     unique_clusters = _unique(old_spike_clusters)
     # Now we take all spikes from these clusters.
-    changed_spike_ids = _spikes_in_clusters(spike_clusters, unique_clusters)
+    if spikes_in_clusters is None:
+        changed_spike_ids = _spikes_in_clusters(spike_clusters,
+                                                unique_clusters)
+    else:
+        changed_spike_ids = spikes_in_clusters(unique_clusters)
     # These are the new spikes that need to be reassigned.
     extended_spike_ids = np.setdiff1d(changed_spike_ids, spike_ids,
                                       assume_unique=True)
@@ -50,6 +59,7 @@ def _extend_assignment(spike_ids,
                        old_spike_clusters,
                        spike_clusters_rel,
                        new_cluster_id,
+                       spikes_in_clusters=None,
                        ):
     # 1. Add spikes that belong to modified clusters.
     # 2. Find new cluster ids for all changed clusters.
@@ -66,7 +76,8 @@ def _extend_assignment(spike_ids,
                           (new_cluster_id - spike_clusters_rel.min()))
 
     # We find the spikes belonging to modified clusters.
-    extended_spike_ids = _extend_spikes(spike_ids, old_spike_clusters)
+    extended_spike_ids = _extend_spikes(spike_ids, old_spike_clusters,
+                                        spikes_in_clusters=spikes_in_clusters)
     if len(extended_spike_ids) == 0:
         return spike_ids, new_spike_clusters
 
@@ -97,6 +108,125 @@ def _assign_update_info(spike_ids, old_spike_clusters, new_spike_clusters):
     return update_info
 
 
+#------------------------------------------------------------------------------
+# Spikes per cluster index
+#------------------------------------------------------------------------------
+
+class SpikesPerCluster(object):
+    """CSR-style index of the spikes belonging to every cluster.
+
+    The index contains three arrays:
+
+    * `cluster_ids`: the sorted list of non-empty clusters
+    * `offsets`: a `n_clusters + 1` array with the position of every
+      cluster in `spike_ids`
+    * `spike_ids`: all spike ids, sorted by cluster, then by spike id
+
+    The spikes of the `i`-th cluster are
+    `spike_ids[offsets[i]:offsets[i + 1]]`.
+
+    The index is built once with a single sort, and it is then updated
+    after every clustering change without rescanning `spike_clusters`.
+
+    """
+    def __init__(self, spike_clusters):
+        self.build(spike_clusters)
+
+    def build(self, spike_clusters):
+        """Build the index from scratch."""
+        spike_clusters = _as_array(spike_clusters)
+        # NOTE: stable sort so that spikes are sorted within every cluster.
+        spike_ids = np.argsort(spike_clusters, kind='mergesort')
+        cluster_ids, counts = np.unique(spike_clusters[spike_ids],
+                                        return_counts=True)
+        self._set(cluster_ids, counts, spike_ids)
+
+    def _set(self, cluster_ids, counts, spike_ids):
+        self.cluster_ids = cluster_ids.astype(np.int64)
+        self.offsets = np.zeros(len(cluster_ids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.spike_ids = spike_ids.astype(np.int64)
+        assert self.offsets[-1] == len(self.spike_ids)
+
+    @property
+    def counts(self):
+        """Number of spikes in every cluster."""
+        return np.diff(self.offsets)
+
+    def _cluster_index(self, clusters):
+        """Return the positions of existing clusters in `cluster_ids`."""
+        clusters = np.asarray(clusters, dtype=np.int64).ravel()
+        idx = np.searchsorted(self.cluster_ids, clusters)
+        idx = idx[idx < len(self.cluster_ids)]
+        return idx[np.in1d(self.cluster_ids[idx], clusters)]
+
+    def spikes_per_cluster(self, cluster_id):
+        """Return the sorted spikes of a cluster.
+
+        The returned array is a view into the index.
+
+        """
+        i = np.searchsorted(self.cluster_ids, cluster_id)
+        if i >= len(self.cluster_ids) or self.cluster_ids[i] != cluster_id:
+            return np.array([], dtype=np.int64)
+        return self.spike_ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def spikes_in_clusters(self, clusters):
+        """Return the sorted spikes belonging to a list of clusters."""
+        idx = _unique(self._cluster_index(clusters))
+        if not len(idx):
+            return np.array([], dtype=np.int64)
+        out = np.concatenate([self.spike_ids[self.offsets[i]:
+                                             self.offsets[i + 1]]
+                              for i in idx])
+        if len(idx) > 1:
+            out.sort()
+        return out
+
+    def update(self, up, spike_clusters):
+        """Update the index after a clustering change.
+
+        This must be called *after* the assignment has been made in the
+        `spike_clusters` array. Only the clusters appearing in `up.added` and
+        `up.deleted` are touched.
+
+        """
+        spike_ids = _as_array(up.spike_ids).astype(np.int64)
+        clusters = np.union1d(_as_array(up.deleted), _as_array(up.added))
+        idx = self._cluster_index(clusters)
+        # Spikes remaining in the affected clusters, plus the new ones.
+        old = self.spikes_in_clusters(self.cluster_ids[idx])
+        old = old[~np.in1d(old, spike_ids)]
+        new_ids = np.concatenate((old, spike_ids))
+        new_clusters = spike_clusters[new_ids]
+        order = np.lexsort((new_ids, new_clusters))
+        new_ids = new_ids[order]
+        new_clusters, new_counts = np.unique(new_clusters[order],
+                                             return_counts=True)
+
+        # Remove the affected clusters from the index.
+        keep = np.ones(len(self.cluster_ids), dtype=np.bool_)
+        keep[idx] = False
+        counts = self.counts
+        kept_clusters = self.cluster_ids[keep]
+        kept_counts = counts[keep]
+        kept_ids = self.spike_ids[np.repeat(keep, counts)]
+
+        # Insert the updated clusters at the right positions.
+        pos = np.searchsorted(kept_clusters, new_clusters)
+        kept_offsets = np.concatenate(([0], np.cumsum(kept_counts)))
+        spike_ids = np.insert(kept_ids,
+                              np.repeat(kept_offsets[pos], new_counts),
+                              new_ids)
+        self._set(np.insert(kept_clusters, pos, new_clusters),
+                  np.insert(kept_counts, pos, new_counts),
+                  spike_ids)
+
+
+#------------------------------------------------------------------------------
+# Clustering class
+#------------------------------------------------------------------------------
+
 class Clustering(EventEmitter):
     """Handle cluster changes in a set of spikes.
 
@@ -104,7 +234,7 @@ class Clustering(EventEmitter):
     --------
 
     * List of clusters appearing in a `spike_clusters` array
-    * Dictionary of spikes per cluster
+    * Index of spikes per cluster, updated after every change
     * Merge
     * Split and assign
     * Undo/redo stack
@@ -160,6 +290,16 @@ class Clustering(EventEmitter):
         assert np.all(self._spike_clusters < self._new_cluster_id)
         # Keep a copy of the original spike clusters assignment.
         self._spike_clusters_base = self._spike_clusters.copy()
+        self._update_all_spikes_per_cluster()
+
+    def _update_all_spikes_per_cluster(self):
+        """Rebuild the spikes per cluster index from `spike_clusters`.
+
+        This is only necessary when the `spike_clusters` array is modified
+        directly.
+
+        """
+        self._spikes_per_cluster = SpikesPerCluster(self._spike_clusters)
 
     def reset(self):
         """Reset the clustering to the original clustering.
@@ -170,6 +310,7 @@ class Clustering(EventEmitter):
         self._undo_stack.clear()
         self._spike_clusters = self._spike_clusters_base
         self._new_cluster_id = self._new_cluster_id_0
+        self._update_all_spikes_per_cluster()
 
     @property
     def spike_clusters(self):
@@ -179,7 +320,7 @@ class Clustering(EventEmitter):
     @property
     def cluster_ids(self):
         """Ordered list of ids of all non-empty clusters."""
-        return np.unique(self._spike_clusters)
+        return self._spikes_per_cluster.cluster_ids
 
     def new_cluster_id(self):
         """Generate a brand new cluster id.
@@ -207,9 +348,13 @@ class Clustering(EventEmitter):
         """Array of all spike ids."""
         return self._spike_ids
 
+    def spikes_per_cluster(self, cluster_id):
+        """Return the array of spike ids belonging to a cluster."""
+        return self._spikes_per_cluster.spikes_per_cluster(cluster_id)
+
     def spikes_in_clusters(self, clusters):
         """Return the array of spike ids belonging to a list of clusters."""
-        return _spikes_in_clusters(self.spike_clusters, clusters)
+        return self._spikes_per_cluster.spikes_in_clusters(clusters)
 
     # Actions
     #--------------------------------------------------------------------------
@@ -249,6 +394,8 @@ class Clustering(EventEmitter):
 
         # We make the assignments.
         self._spike_clusters[spike_ids] = new_spike_clusters
+        # We update the spikes per cluster index.
+        self._spikes_per_cluster.update(up, self._spike_clusters)
         return up
 
     def _do_merge(self, spike_ids, cluster_ids, to):
@@ -267,6 +414,8 @@ class Clustering(EventEmitter):
 
         # Assign the clusters.
         self.spike_clusters[spike_ids] = to
+        # We update the spikes per cluster index.
+        self._spikes_per_cluster.update(up, self._spike_clusters)
         return up
 
     def merge(self, cluster_ids, to=None):
@@ -308,7 +457,7 @@ class Clustering(EventEmitter):
         # cheaper operation.
 
         # Find all spikes in the specified clusters.
-        spike_ids = _spikes_in_clusters(self.spike_clusters, cluster_ids)
+        spike_ids = self.spikes_in_clusters(cluster_ids)
 
         up = self._do_merge(spike_ids, cluster_ids, to)
         undo_state = self.emit('request_undo_state', up)
@@ -386,6 +535,7 @@ class Clustering(EventEmitter):
                                                     self._spike_clusters,
                                                     spike_clusters_rel,
                                                     self.new_cluster_id(),
+                                                    self.spikes_in_clusters,
                                                     )
 
         up = self._do_assign(spike_ids, cluster_ids)
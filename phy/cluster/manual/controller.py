@@ -20,11 +20,18 @@ from phy.cluster.manual.views import (WaveformView,
                                       extract_spikes,
                                       )
 from phy.gui import GUI
-from phy.io.array import _get_data_lim, concat_per_cluster
+from phy.io.array import (_get_data_lim,
+                          concat_per_cluster,
+                          grouped_reduce,
+                          )
 from phy.io import Context, Selector
 from phy.plot.transform import _normalize
+from phy.stats import SpikeTrainStats
 from phy.stats.clusters import (mean,
                                 get_waveform_amplitude,
+                                get_masked_features_vectors,
+                                ClusterNeighbors,
+                                ClusterChannelIndex,
                                 )
 from phy.utils import Bunch, load_master_config, get_plugin, EventEmitter
 
@@ -113,28 +120,53 @@ class Controller(EventEmitter):
         self.context = Context(self.cache_dir)
         ctx = self.context
 
-        self.get_masks = concat_per_cluster(ctx.cache(self.get_masks))
-        self.get_features = concat_per_cluster(ctx.cache(self.get_features))
-        self.get_waveforms = concat_per_cluster(ctx.cache(self.get_waveforms))
-        self.get_background_features = ctx.cache(self.get_background_features)
-
-        self.get_mean_masks = ctx.memcache(self.get_mean_masks)
-        self.get_mean_features = ctx.memcache(self.get_mean_features)
-        self.get_mean_waveforms = ctx.memcache(self.get_mean_waveforms)
+        # The caches are cleared when their inputs change on disk.
+        for name in ('spike_clusters', 'all_masks', 'all_features',
+                     'all_waveforms', 'channel_positions'):
+            ctx.set_input(name, getattr(self, name))
+        # NOTE: the per-cluster caches do not depend on the spike clusters
+        # since cluster ids are never reused.
+        masks = ('all_masks',)
+        features = masks + ('all_features',)
+        waveforms = masks + ('all_waveforms',)
+        channels = waveforms + ('channel_positions',)
+
+        self.get_masks = concat_per_cluster(ctx.cache(self.get_masks,
+                                                      inputs=masks))
+        self.get_features = concat_per_cluster(ctx.cache(self.get_features,
+                                                         inputs=features))
+        self.get_waveforms = concat_per_cluster(ctx.cache(self.get_waveforms,
+                                                          inputs=waveforms))
+        self.get_background_features = ctx.cache(
+            self.get_background_features,
+            inputs=features + ('spike_clusters',))
+
+        self.get_mean_masks = ctx.memcache(self.get_mean_masks,
+                                           inputs=masks)
+        self.get_mean_features = ctx.memcache(self.get_mean_features,
+                                              inputs=features)
+        self.get_mean_waveforms = ctx.memcache(self.get_mean_waveforms,
+                                               inputs=waveforms)
         self.get_waveforms_amplitude = ctx.memcache(
-            self.get_waveforms_amplitude)
+            self.get_waveforms_amplitude, inputs=waveforms)
 
-        self.get_waveform_lims = ctx.memcache(self.get_waveform_lims)
-        self.get_feature_lim = ctx.memcache(self.get_feature_lim)
+        self.get_waveform_lims = ctx.memcache(self.get_waveform_lims,
+                                              inputs=waveforms)
+        self.get_feature_lim = ctx.memcache(self.get_feature_lim,
+                                            inputs=features)
 
-        self.get_close_clusters = ctx.memcache(
-            self.get_close_clusters)
         self.get_probe_depth = ctx.memcache(
-            self.get_probe_depth)
-
-        self.spikes_per_cluster = ctx.memcache(self.spikes_per_cluster)
+            self.get_probe_depth, inputs=channels)
 
     def _set_manual_clustering(self):
+        # Closest clusters in the mean masked feature space.
+        self.cluster_neighbors = ClusterNeighbors(
+            self.get_similarity_vectors,
+            n_neighbors=self.n_spikes_close_clusters)
+        # Clusters indexed by the position of their best channel.
+        self.cluster_channel_index = ClusterChannelIndex(
+            self.channel_positions, self.get_all_best_channels)
+
         # Load the new cluster id.
         new_cluster_id = self.context.load('new_cluster_id'). \
             get('new_cluster_id', None)
@@ -153,10 +185,23 @@ class Controller(EventEmitter):
             logger.debug("Save the new cluster id: %d", new_cluster_id)
             self.context.save('new_cluster_id',
                               dict(new_cluster_id=new_cluster_id))
+            # The cached data of deleted clusters are evicted first.
+            self.context.demote_clusters(up.deleted)
 
         self.manual_clustering = mc
         mc.add_column(self.get_probe_depth, name='depth')
 
+        # Spike train statistics of all clusters, computed in one pass.
+        self.spike_train_stats = SpikeTrainStats(
+            spike_times=self.spike_times,
+            spike_clusters=self.spike_clusters,
+            spikes_per_cluster=self.spikes_per_cluster,
+            duration=self.duration,
+        )
+        mc.add_column(self.spike_train_stats.firing_rate, name='firing_rate')
+        mc.add_column(self.spike_train_stats.refractory_violations,
+                      name='refractory_violations')
+
     def _select_spikes(self, cluster_id, n_max=None):
         assert isinstance(cluster_id, int)
         assert cluster_id >= 0
@@ -174,6 +219,18 @@ class Controller(EventEmitter):
     def _data_lim(self, arr, n_max=None):
         return _get_data_lim(arr, n_spikes=n_max)
 
+    def _cluster_means(self, arr, cluster_ids):
+        """Return the means of a spike-dependent array over all spikes of
+        some clusters."""
+        spike_ids = self.spikes_in_clusters(cluster_ids)
+        # Many clusters: a single pass over all spikes.
+        if len(spike_ids) > self.n_spikes // 2:
+            spike_ids = None
+        # NOTE: only the spikes of the clusters are read, chunk by chunk.
+        return grouped_reduce(arr, self.spike_clusters, 'mean',
+                              cluster_ids=cluster_ids,
+                              spike_ids=spike_ids).mean
+
     # Masks
     # -------------------------------------------------------------------------
 
@@ -240,6 +297,11 @@ class Controller(EventEmitter):
         data.data = _normalize(data.data.copy(), -m, +m)
         return data
 
+    def get_spike_features(self, spike_ids):
+        """Return the normalized features of some spikes."""
+        m = self.get_feature_lim()
+        return _normalize(self.all_features[spike_ids], -m, +m)
+
     def get_background_features(self):
         k = max(1, int(self.n_spikes // self.n_spikes_background_features))
         spike_ids = slice(None, None, k)
@@ -256,6 +318,24 @@ class Controller(EventEmitter):
     def get_feature_lim(self):
         return self._data_lim(self.all_features, self.n_spikes_features_lim)
 
+    def get_similarity_vectors(self, cluster_ids):
+        """Return the stacked normalized mean masked features of some
+        clusters, computed from all their spikes, and their normalized
+        mean masked waveforms."""
+        mf = self._cluster_means(self.all_features, cluster_ids)
+        mm = self._cluster_means(self.all_masks, cluster_ids)
+        m = self.get_feature_lim()
+        vectors = [get_masked_features_vectors(_normalize(mf, -m, +m), mm)]
+        if self.all_waveforms is not None:
+            # NOTE: the waveforms are loaded from the same subsets of spikes
+            # as in the waveform view.
+            mw = self._subset_means(self.all_waveforms, cluster_ids,
+                                    self.n_spikes_waveforms)
+            m, M = self.get_waveform_lims()
+            mw = mw * (2. / (M - m)) * mm[:, np.newaxis, :]
+            vectors.append(mw.reshape((len(mw), -1)))
+        return np.hstack(vectors)
+
     # Traces
     # -------------------------------------------------------------------------
 
@@ -301,29 +381,49 @@ class Controller(EventEmitter):
     def get_probe_depth(self, cluster_id):
         return self.get_best_channel_position(cluster_id)[1]
 
+    def _subset_means(self, arr, cluster_ids, n_max):
+        """Return the means of a spike-dependent array over the regular
+        subsets of the spikes of some clusters used by the views."""
+        spike_ids = np.sort(np.concatenate(
+            [self._select_spikes(int(c), n_max) for c in cluster_ids]))
+        return grouped_reduce(arr, self.spike_clusters, 'mean',
+                              cluster_ids=cluster_ids,
+                              spike_ids=spike_ids).mean
+
+    def get_all_best_channels(self, cluster_ids):
+        """Return the best channels of some clusters, as shown in the
+        cluster view, computed in a single pass."""
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        if not len(cluster_ids):
+            return np.array([], dtype=np.int64)
+        # Same spikes as get_mean_masks() and get_mean_waveforms().
+        mm = self._subset_means(self.all_masks, cluster_ids,
+                                self.n_spikes_masks)
+        mw = self._subset_means(self.all_waveforms, cluster_ids,
+                                self.n_spikes_waveforms)
+        # NOTE: the normalization of the waveforms does not change the
+        # best channels.
+        mw = mw * mm[:, np.newaxis, :]
+        wa = mw.max(axis=1) - mw.min(axis=1)
+        return wa.argmax(axis=1).astype(np.int64)
+
     def get_close_clusters(self, cluster_id):
         assert isinstance(cluster_id, int)
-        # Position of the cluster's best channel.
-        pos0 = self.get_best_channel_position(cluster_id)
-        n = len(pos0)
-        assert n in (2, 3)
-        # Positions of all clusters' best channels.
-        clusters = self.cluster_ids
-        pos = np.vstack([self.get_best_channel_position(int(clu))
-                         for clu in clusters])
-        assert pos.shape == (len(clusters), n)
-        # Distance of all clusters to the current cluster.
-        dist = (pos - pos0) ** 2
-        assert dist.shape == (len(clusters), n)
-        dist = np.sum(dist, axis=1) ** .5
-        assert dist.shape == (len(clusters),)
-        # Closest clusters.
-        ind = np.argsort(dist)
-        ind = ind[:self.n_spikes_close_clusters]
-        return [(int(clusters[i]), float(dist[i])) for i in ind]
+        # Only the best channels of the new clusters are computed.
+        index = self.cluster_channel_index
+        index.update(self.manual_clustering.clustering.cluster_ids)
+        return index.closest(cluster_id, self.n_spikes_close_clusters)
 
     def spikes_per_cluster(self, cluster_id):
-        return np.nonzero(self.spike_clusters == cluster_id)[0]
+        # NOTE: served by the spikes per cluster index of the Clustering
+        # instance, which is kept up-to-date after every clustering change.
+        clustering = self.manual_clustering.clustering
+        return clustering.spikes_per_cluster(cluster_id)
+
+    def spikes_in_clusters(self, cluster_ids):
+        """Return the sorted spike ids of several clusters."""
+        clustering = self.manual_clustering.clustering
+        return clustering.spikes_in_clusters(cluster_ids)
 
     # View methods
     # -------------------------------------------------------------------------
@@ -357,6 +457,8 @@ class Controller(EventEmitter):
                         n_features_per_channel=self.n_features_per_channel,
                         feature_lim=self.get_feature_lim(),
                         best_channels=self.get_channels_by_amplitude,
+                        spike_features=self.get_spike_features,
+                        spikes_in_clusters=self.spikes_in_clusters,
                         )
         return self._add_view(gui, v)
 
@@ -364,6 +466,7 @@ class Controller(EventEmitter):
         v = CorrelogramView(spike_times=self.spike_times,
                             spike_clusters=self.spike_clusters,
                             sample_rate=self.sample_rate,
+                            spikes_per_cluster=self.spikes_per_cluster,
                             )
         return self._add_view(gui, v)
 
@@ -371,7 +474,12 @@ class Controller(EventEmitter):
     # -------------------------------------------------------------------------
 
     def similarity(self, cluster_id):
-        return self.get_close_clusters(cluster_id)
+        if self.all_features is None:
+            return self.get_close_clusters(cluster_id)
+        # Only the new and deleted clusters are updated.
+        cluster_ids = self.manual_clustering.clustering.cluster_ids
+        self.cluster_neighbors.update(cluster_ids)
+        return self.cluster_neighbors.neighbors(cluster_id)
 
     def create_gui(self, name=None,
                    subtitle=None,
@@ -388,6 +496,16 @@ class Controller(EventEmitter):
         # Attach the ManualClustering component to the GUI.
         self.manual_clustering.attach(gui)
 
+        @gui.default_actions.add
+        def show_cache_stats():
+            """Log the cache statistics of all cached functions."""
+            self.context.log_cache_stats()
+
+        @gui.connect_
+        def on_close():
+            # Write the pending memcached values to disk.
+            self.context.save_memcache()
+
         # Add views.
         if add_default_views:
             self.add_correlogram_view(gui)
@@ -12,9 +12,7 @@ import numpy as np
 
 from phy.cluster.manual.controller import Controller
 from phy.electrode.mea import staggered_positions
-from phy.io.array import (get_closest_clusters,
-                          _spikes_in_clusters,
-                          )
+from phy.io.array import get_closest_clusters
 from phy.io.mock import (artificial_waveforms,
                          artificial_features,
                          artificial_masks,
@@ -77,8 +75,6 @@ class MockController(Controller):
         self.cluster_ids = np.unique(self.spike_clusters)
         self.channel_positions = staggered_positions(self.n_channels)
 
-        sc = self.spike_clusters
-        self.spikes_per_cluster = lambda c: _spikes_in_clusters(sc, [c])
         self.spike_count = lambda c: len(self.spikes_per_cluster(c))
         self.n_features_per_channel = n_features_per_channel
         self.cluster_groups = {c: None for c in range(self.n_clusters)}
@@ -15,7 +15,9 @@ from phy.io.array import (_spikes_in_clusters,)
 from ..clustering import (_extend_spikes,
                           _concatenate_spike_clusters,
                           _extend_assignment,
+                          SpikesPerCluster,
                           Clustering)
+from .._utils import UpdateInfo
 
 
 #------------------------------------------------------------------------------
@@ -100,6 +102,74 @@ def test_extend_assignment():
     ae(new_cluster_ids, [10, 11, 12])
 
 
+def test_extend_spikes_index():
+    spike_clusters = np.array([3, 5, 2, 9, 5, 5, 2])
+    spikes_in_clusters = SpikesPerCluster(spike_clusters).spikes_in_clusters
+    extended = _extend_spikes([2, 4, 0], spike_clusters,
+                              spikes_in_clusters=spikes_in_clusters)
+    ae(extended, [1, 5, 6])
+
+
+#------------------------------------------------------------------------------
+# Test spikes per cluster index
+#------------------------------------------------------------------------------
+
+def _assert_index(index, spike_clusters):
+    ae(index.cluster_ids, np.unique(spike_clusters))
+    for cluster in index.cluster_ids:
+        ae(index.spikes_per_cluster(cluster),
+           _spikes_in_clusters(spike_clusters, [cluster]))
+
+
+def test_spikes_per_cluster_index():
+    spike_clusters = np.array([2, 5, 3, 2, 7, 5, 2])
+    index = SpikesPerCluster(spike_clusters)
+    _assert_index(index, spike_clusters)
+    ae(index.counts, [3, 1, 2, 1])
+    ae(index.spikes_per_cluster(4), [])
+    ae(index.spikes_per_cluster(10), [])
+    ae(index.spikes_in_clusters([]), [])
+    ae(index.spikes_in_clusters([2, 4, 7]), [0, 3, 4, 6])
+
+    # Merge.
+    spike_clusters[[1, 2, 5]] = 8
+    index.update(UpdateInfo(spike_ids=[1, 2, 5], added=[8], deleted=[3, 5]),
+                 spike_clusters)
+    _assert_index(index, spike_clusters)
+
+    # Assign to an existing lower cluster, like in an undo.
+    spike_clusters[[1, 5]] = 5
+    spike_clusters[[2]] = 3
+    index.update(UpdateInfo(spike_ids=[1, 2, 5], added=[3, 5], deleted=[8]),
+                 spike_clusters)
+    _assert_index(index, spike_clusters)
+
+
+def test_spikes_per_cluster_index_random():
+    n_spikes = 1000
+    spike_clusters = artificial_spike_clusters(n_spikes, 10)
+    clustering = Clustering(spike_clusters)
+
+    for _ in range(10):
+        spike_ids = np.unique(np.random.randint(size=20, low=0,
+                                                high=n_spikes))
+        clustering.split(spike_ids)
+        _assert_index(clustering._spikes_per_cluster,
+                      clustering.spike_clusters)
+    clustering.merge(clustering.cluster_ids[:3])
+    _assert_index(clustering._spikes_per_cluster, clustering.spike_clusters)
+
+    for _ in range(5):
+        clustering.undo()
+        _assert_index(clustering._spikes_per_cluster,
+                      clustering.spike_clusters)
+    clustering.redo()
+    _assert_index(clustering._spikes_per_cluster, clustering.spike_clusters)
+
+    clustering.reset()
+    _assert_index(clustering._spikes_per_cluster, clustering.spike_clusters)
+
+
 #------------------------------------------------------------------------------
 # Test clustering
 #------------------------------------------------------------------------------
@@ -420,6 +490,7 @@ def test_clustering_long():
 
     # Test clustering.spikes_in_clusters() function.:
     assert np.all(spike_clusters[clustering.spikes_in_clusters([5])] == 5)
+    ae(clustering.spikes_per_cluster(5), clustering.spikes_in_clusters([5]))
 
     # Test cluster ids.
     ae(clustering.cluster_ids, np.arange(n_clusters))
@@ -433,6 +504,7 @@ def test_clustering_long():
     clustering.spike_clusters[:] = spike_clusters_new[:]
     # Need to update explicitely.
     clustering._new_cluster_id = 101
+    clustering._update_all_spikes_per_cluster()
     ae(clustering.cluster_ids, np.r_[np.arange(n_clusters), 100])
 
     # Updating a cluster, method 2.
@@ -440,6 +512,7 @@ def test_clustering_long():
     clustering.spike_clusters[:10] = 100
     # HACK: need to update manually here.
     clustering._new_cluster_id = 101
+    clustering._update_all_spikes_per_cluster()
     ae(clustering.cluster_ids, np.r_[np.arange(n_clusters), 100])
 
     # Assign.
@@ -459,6 +532,7 @@ def test_clustering_long():
     # Merge to a given cluster.
     clustering.spike_clusters[:] = spike_clusters_base[:]
     clustering._new_cluster_id = 11
+    clustering._update_all_spikes_per_cluster()
 
     my_spikes_0 = np.nonzero(np.in1d(clustering.spike_clusters, [4, 6]))[0]
     info = clustering.merge([4, 6], 11)
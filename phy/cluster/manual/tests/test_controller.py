@@ -9,6 +9,10 @@
 import os.path as op
 from textwrap import dedent
 
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+
 from .conftest import MockController
 
 
@@ -43,3 +47,72 @@ def test_controller_1(qtbot, tempdir):
 
     # qtbot.stop()
     gui.close()
+
+
+def test_controller_spikes_per_cluster(qtbot, tempdir):
+    controller = MockController(config_dir=tempdir)
+    n = controller.n_spikes_per_cluster
+    ae(controller.spikes_per_cluster(1), np.arange(n, 2 * n))
+
+    # The index of the clustering is updated after a merge and an undo.
+    mc = controller.manual_clustering
+    up = mc.clustering.merge([1, 2])
+    new = up.added[0]
+    ae(controller.spikes_per_cluster(new), np.arange(n, 3 * n))
+    assert len(controller.spikes_per_cluster(1)) == 0
+    ae(controller.spikes_in_clusters([0, new]), np.arange(3 * n))
+    assert controller.spike_count(new) == 2 * n
+
+    mc.clustering.undo()
+    ae(controller.spikes_per_cluster(1), np.arange(n, 2 * n))
+    ae(controller.spikes_per_cluster(2), np.arange(2 * n, 3 * n))
+    assert len(controller.spikes_per_cluster(new)) == 0
+
+
+def test_controller_similarity(qtbot, tempdir):
+    controller = MockController(config_dir=tempdir)
+    n = controller.n_clusters
+
+    # Mean masked features and waveforms.
+    vectors = controller.get_similarity_vectors(np.arange(n))
+    assert vectors.shape == (n, controller.all_features[0].size +
+                             controller.all_waveforms[0].size)
+    ac(controller.get_similarity_vectors([1]), vectors[[1]])
+
+    # The clusters are ranked by the distance between their vectors.
+    sim = controller.similarity(1)
+    assert sim[0][0] == 1
+    ac(sim[0][1], 0, atol=1e-6)
+    assert sorted(c for c, _ in sim) == list(range(n))
+    dist = np.sqrt(((vectors - vectors[1]) ** 2).sum(axis=1))
+    ac([d for _, d in sim], np.sort(dist), atol=1e-6)
+    assert [c for c, _ in sim][:2] == np.argsort(dist)[:2].tolist()
+
+    # After a merge, the new cluster replaces the merged ones.
+    up = controller.manual_clustering.clustering.merge([1, 2])
+    new = up.added[0]
+    sim = controller.similarity(new)
+    assert sim[0][0] == new
+    assert set(c for c, _ in sim) == set(range(n)) - {1, 2} | {new}
+
+
+def test_controller_close_clusters(qtbot, tempdir):
+    controller = MockController(config_dir=tempdir)
+    n = controller.n_clusters
+
+    # The best channels of all clusters are computed in a single pass.
+    get_waveforms = controller.get_waveforms
+    controller.get_waveforms = None
+    channels = controller.get_all_best_channels(np.arange(n))
+    controller.get_waveforms = get_waveforms
+
+    # The index uses the best channels shown in the cluster view.
+    ae(channels, [controller.get_best_channel(c) for c in range(n)])
+
+    close = controller.get_close_clusters(1)
+    ae(controller.cluster_channel_index.best_channel_positions([1]),
+       [controller.get_best_channel_position(1)])
+    assert close[0] == (1, 0.)
+    assert sorted(c for c, _ in close) == list(range(n))
+    dist = [d for _, d in close]
+    assert dist == sorted(dist)
@@ -224,6 +224,19 @@ def test_feature_view(qtbot, gui):
     v.clear_channels()
     v.toggle_automatic_channel_selection()
 
+    # Lasso selection, by chunks and with all features at once.
+    splits = []
+    for spike_features in (v.spike_features, None):
+        v.spike_features = spike_features
+        v.lasso.box = (0, 1)
+        for pos in [(-1, -1), (+1, -1), (+1, +1), (-1, +1)]:
+            v.lasso.add(pos)
+        splits.append(v.on_request_split())
+        assert v.lasso.count == 0
+    ae(splits[0], np.sort(splits[1]))
+    spike_clusters = gui.controller.spike_clusters[splits[0]]
+    assert np.all(np.in1d(spike_clusters, v.cluster_ids))
+
     # qtbot.stop()
     gui.close()
 
@@ -260,8 +273,23 @@ def test_correlogram_view(qtbot, gui):
 
     v.toggle_normalization()
 
+    # The correlograms of the selected pairs are stored.
+    n = len(v.cluster_ids)
+    assert len(v.store) == n * n
+    v.on_select(v.cluster_ids)
+    assert len(v.store) == n * n
+
+    # The excerpt spikes of the selected clusters are cached.
+    excerpts = v.store._excerpt_params(n)
+    spike_ids = v.store._cluster_spikes(v.cluster_ids[0], *excerpts)
+    assert len(spike_ids) > 0
+    ae(spike_ids, np.sort(spike_ids))
+    misses = v.store._spikes.misses
+
     v.set_bin(1)
     v.set_window(100)
+    assert len(v.store) == 2 * n * n
+    assert v.store._spikes.misses == misses
 
     # qtbot.stop()
     gui.close()
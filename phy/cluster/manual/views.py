@@ -15,11 +15,11 @@ import re
 import numpy as np
 from vispy.util.event import Event
 
-from phy.io.array import _index_of, _get_padded, get_excerpts
+from phy.io.array import _index_of, _get_padded, _spikes_in_polygon
 from phy.gui import Actions
 from phy.plot import View, _get_linear_x
 from phy.plot.utils import _get_boxes
-from phy.stats import correlograms
+from phy.stats import CorrelogramStore
 from phy.utils import Bunch
 from phy.utils._color import _spike_colors, ColorSelector, _colormap
 
@@ -957,6 +957,8 @@ class FeatureView(ManualClusteringView):
                  n_features_per_channel=None,
                  feature_lim=None,
                  best_channels=None,
+                 spike_features=None,
+                 spikes_in_clusters=None,
                  **kwargs):
         """
         features is a function :
@@ -967,6 +969,10 @@ class FeatureView(ManualClusteringView):
                                 spike_times)`
         background_features is a Bunch(...) like above.
 
+        spike_features and spikes_in_clusters are optional functions
+        `spike_ids: features` and `cluster_ids: spike_ids`. When they are
+        specified, the lasso selection is done by chunks of spikes.
+
         """
         self._scaling = 1.
 
@@ -974,6 +980,8 @@ class FeatureView(ManualClusteringView):
 
         assert features
         self.features = features
+        self.spike_features = spike_features
+        self.spikes_in_clusters = spikes_in_clusters
 
         # This is a tuple (spikes, features, masks).
         self.background_features = background_features
@@ -1232,18 +1240,29 @@ class FeatureView(ManualClusteringView):
         x_dim, y_dim = _dimensions_matrix(self.channels,
                                           n_cols=self.n_cols,
                                           top_left_attribute=tla)
-        data = self.features(self.cluster_ids, load_all=True)
-        spike_ids = data.spike_ids
-        f = data.data
         i, j = self.lasso.box
+        dims = x_dim[i, j], y_dim[i, j]
+        polygon = self.lasso.polygon
+        self.lasso.clear()
 
-        x = self._get_feature(x_dim[i, j], spike_ids, f)
-        y = self._get_feature(y_dim[i, j], spike_ids, f)
-        pos = np.c_[x, y].astype(np.float64)
+        if self.spike_features is None or self.spikes_in_clusters is None:
+            data = self.features(self.cluster_ids, load_all=True)
+            f = data.data
+            spike_ids = data.spike_ids
+            get_pos = lambda ids: [self._get_feature(dim, ids, f)
+                                   for dim in dims]
+            return _spikes_in_polygon(spike_ids, get_pos, polygon,
+                                      chunk_size=len(spike_ids))
 
-        ind = self.lasso.in_polygon(pos)
-        self.lasso.clear()
-        return spike_ids[ind]
+        # Only load the features of the spikes being tested.
+        load = any(isinstance(dim, tuple) for dim in dims)
+
+        def get_pos(ids):
+            f = self.spike_features(ids) if load else None
+            return [self._get_feature(dim, ids, f) for dim in dims]
+
+        spike_ids = self.spikes_in_clusters(self.cluster_ids)
+        return _spikes_in_polygon(spike_ids, get_pos, polygon)
 
     def toggle_automatic_channel_selection(self):
         """Toggle the automatic selection of channels when the cluster
@@ -1292,6 +1311,7 @@ class CorrelogramView(ManualClusteringView):
                  spike_times=None,
                  spike_clusters=None,
                  sample_rate=None,
+                 spikes_per_cluster=None,
                  **kwargs):
 
         assert sample_rate > 0
@@ -1309,6 +1329,15 @@ class CorrelogramView(ManualClusteringView):
         assert spike_clusters.shape == (self.n_spikes,)
         self.spike_clusters = spike_clusters
 
+        # Correlograms of pairs of clusters, computed on demand.
+        # `spikes_per_cluster` is an optional function cluster_id =>
+        # spike_ids.
+        self.store = CorrelogramStore(spike_times=self.spike_times,
+                                      spike_clusters=spike_clusters,
+                                      sample_rate=self.sample_rate,
+                                      spikes_per_cluster=spikes_per_cluster,
+                                      )
+
         # Set the default bin and window size.
         self.set_bin_window(bin_size=self.bin_size,
                             window_size=self.window_size)
@@ -1327,33 +1356,13 @@ class CorrelogramView(ManualClusteringView):
         self.set_status('Bin: {:.1f} ms. Window: {:.1f} ms.'.format(b, w))
 
     def _compute_correlograms(self, cluster_ids):
-
-        # Keep spikes belonging to the selected clusters.
-        ind = np.in1d(self.spike_clusters, cluster_ids)
-        st = self.spike_times[ind]
-        sc = self.spike_clusters[ind]
-
-        # Take excerpts of the spikes.
-        n_spikes_total = len(st)
-        st = get_excerpts(st, excerpt_size=self.excerpt_size,
-                          n_excerpts=self.n_excerpts)
-        sc = get_excerpts(sc, excerpt_size=self.excerpt_size,
-                          n_excerpts=self.n_excerpts)
-        n_spikes_exerpts = len(st)
-        logger.log(5, "Computing correlograms for clusters %s (%d/%d spikes).",
-                   ', '.join(map(str, cluster_ids)),
-                   n_spikes_exerpts, n_spikes_total,
-                   )
-
-        # Compute all pairwise correlograms.
-        ccg = correlograms(st, sc,
-                           cluster_ids=cluster_ids,
-                           sample_rate=self.sample_rate,
-                           bin_size=self.bin_size,
-                           window_size=self.window_size,
-                           )
-
-        return ccg
+        # Only the pairs missing from the store are computed.
+        self.store.excerpt_size = self.excerpt_size
+        self.store.n_excerpts = self.n_excerpts
+        return self.store.get(cluster_ids,
+                              bin_size=self.bin_size,
+                              window_size=self.window_size,
+                              )
 
     def on_select(self, cluster_ids=None):
         super(CorrelogramView, self).on_select(cluster_ids)
@@ -1385,6 +1394,10 @@ class CorrelogramView(ManualClusteringView):
                                         data_bounds=None,
                                         )
 
+    def on_cluster(self, up):
+        # The correlograms of merged clusters are derived from the store.
+        self.store.on_cluster(up)
+
     def toggle_normalization(self):
         """Change the normalization of the correlograms."""
         self.uniform_normalization = not self.uniform_normalization
@@ -1393,6 +1406,7 @@ class CorrelogramView(ManualClusteringView):
     def attach(self, gui):
         """Attach the view to the GUI."""
         super(CorrelogramView, self).attach(gui)
+        gui.connect_(self.on_cluster)
         self.actions.add(self.toggle_normalization, shortcut='n')
         self.actions.add(self.set_bin, alias='cb')
         self.actions.add(self.set_window, alias='cw')
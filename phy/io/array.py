@@ -6,8 +6,9 @@
 # Imports
 #------------------------------------------------------------------------------
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import wraps
+from itertools import count
 import logging
 import math
 from math import floor, exp
@@ -15,6 +16,7 @@ from operator import itemgetter
 import os.path as op
 
 import numpy as np
+from six import integer_types, string_types
 
 from phy.utils import Bunch, _as_scalar, _as_scalars
 from phy.utils._types import _as_array, _is_array_like
@@ -55,12 +57,22 @@ def _range_from_slice(myslice, start=None, stop=None, step=None, length=None):
     return myrange
 
 
+def _is_sparse(max_id, n):
+    """Whether a set of `n` non-negative integer ids up to `max_id` is
+    sparse, i.e. whether a dense lookup table of size `max_id` would be
+    much larger than the number of ids."""
+    return max_id >= 4 * n + 1024
+
+
 def _unique(x):
     """Faster version of np.unique().
 
     This version is restricted to 1D arrays of non-negative integers.
 
-    It is only faster if len(x) >> len(unique(x)).
+    It is only faster if len(x) >> len(unique(x)). When the ids are sparse
+    (very large ids compared to the number of elements), a sort-based
+    algorithm is used instead of `np.bincount()`, so that the cost does not
+    depend on the magnitude of the ids.
 
     """
     if x is None or len(x) == 0:
@@ -69,6 +81,10 @@ def _unique(x):
     # cluster=-1 means "unclustered".
     x = _as_array(x)
     x = x[x >= 0]
+    if not len(x):
+        return np.array([], dtype=np.int64)
+    if _is_sparse(x.max(), len(x)):
+        return np.unique(x).astype(np.int64)
     bc = np.bincount(x)
     return np.nonzero(bc)[0]
 
@@ -107,13 +123,16 @@ def _index_of(arr, lookup):
 
     This is not checked for performance reasons.
 
+    When the ids in the lookup table are sparse, a `np.searchsorted()`-based
+    algorithm is used: the memory and time do not depend on the largest id.
+
     """
     # Equivalent of np.digitize(arr, lookup) - 1, but much faster.
     # TODO: assertions to disable in production for performance reasons.
-    # TODO: np.searchsorted(lookup, arr) is faster on small arrays with large
-    # values
-    lookup = np.asarray(lookup, dtype=np.int32)
+    lookup = np.asarray(lookup, dtype=np.int64)
     m = (lookup.max() if len(lookup) else 0) + 1
+    if _is_sparse(m, len(lookup)):
+        return _index_of_sparse(arr, lookup)
     tmp = np.zeros(m + 1, dtype=np.int)
     # Ensure that -1 values are kept.
     tmp[-1] = -1
@@ -122,6 +141,18 @@ def _index_of(arr, lookup):
     return tmp[arr]
 
 
+def _index_of_sparse(arr, lookup):
+    """Sort-based version of `_index_of()` for sparse ids."""
+    arr = np.asarray(arr, dtype=np.int64)
+    # The lookup table does not need to be sorted.
+    order = np.argsort(lookup, kind='mergesort')
+    pos = np.searchsorted(lookup[order], arr)
+    out = order[np.clip(pos, 0, len(lookup) - 1)]
+    # Ensure that -1 values are kept.
+    out[arr == -1] = -1
+    return out
+
+
 def _pad(arr, n, dir='right'):
     """Pad an array with zeros along the first axis.
 
@@ -181,17 +212,72 @@ def _get_padded(data, start, end):
         return data[start:end]
 
 
+def _in_polygon_xy(x, y, polygon):
+    """Return a boolean mask of the points `(x, y)` that are inside
+    a polygon.
+
+    The points outside the bounding box of the polygon are rejected first,
+    and the remaining points are tested with an even-odd edge-crossing
+    test.
+
+    """
+    polygon = np.asarray(polygon, dtype=np.float64).reshape((-1, 2))
+    out = np.zeros(len(x), dtype=np.bool)
+    if len(polygon) < 3 or not len(x):
+        return out
+
+    # Bounding box rejection.
+    (xmin, ymin), (xmax, ymax) = polygon.min(axis=0), polygon.max(axis=0)
+    idx = np.nonzero((x >= xmin) & (x <= xmax) &
+                     (y >= ymin) & (y <= ymax))[0]
+    if not len(idx):
+        return out
+    x = np.asarray(x[idx], dtype=np.float64)
+    y = np.asarray(y[idx], dtype=np.float64)
+
+    # Count the crossings between the polygon edges and a horizontal
+    # half-line starting at every point. The comparisons are the same as
+    # in matplotlib's `Path.contains_points()`, so that points on the
+    # boundary are classified in the same way.
+    inside = np.zeros(len(idx), dtype=np.bool)
+    xj, yj = polygon[-1]
+    for xi, yi in polygon:
+        flag = yi >= y
+        k = np.nonzero((yj >= y) != flag)[0]
+        if len(k):
+            cross = ((yi - y[k]) * (xj - xi) >=
+                     (xi - x[k]) * (yj - yi)) == flag[k]
+            inside[k[cross]] ^= True
+        xj, yj = xi, yi
+    out[idx] = inside
+    return out
+
+
 def _in_polygon(points, polygon):
     """Return the points that are inside a polygon."""
-    from matplotlib.path import Path
     points = _as_array(points)
     polygon = _as_array(polygon)
     assert points.ndim == 2
     assert polygon.ndim == 2
-    if len(polygon):
-        polygon = np.vstack((polygon, polygon[0]))
-    path = Path(polygon, closed=True)
-    return path.contains_points(points)
+    return _in_polygon_xy(points[:, 0], points[:, 1], polygon)
+
+
+def _spikes_in_polygon(spike_ids, get_pos, polygon, chunk_size=None):
+    """Return the spikes that are inside a polygon.
+
+    `get_pos(spike_ids)` returns the `(x, y)` coordinates of some spikes.
+    The spikes are processed by chunks so that the memory usage is
+    bounded.
+
+    """
+    spike_ids = _as_array(spike_ids)
+    chunk_size = chunk_size or 2 ** 16
+    out = [spike_ids[:0]]
+    for i in range(0, len(spike_ids), chunk_size):
+        ids = spike_ids[i:i + chunk_size]
+        x, y = get_pos(ids)
+        out.append(ids[_in_polygon_xy(x, y, polygon)])
+    return np.concatenate(out)
 
 
 def _get_data_lim(arr, n_spikes=None):
@@ -237,67 +323,428 @@ def concat_per_cluster(f):
 # I/O functions
 # -----------------------------------------------------------------------------
 
-def read_array(path, mmap_mode=None):
-    """Read a .npy array."""
+_RAW_EXTENSIONS = ('.dat', '.bin', '.raw')
+
+
+def _read_raw(path, dtype=None, n_channels=None, offset=0, mmap_mode='r'):
+    """Memory-map a headerless binary file with interleaved channels.
+
+    The returned array has shape `(n_samples, n_channels)`, where
+    `n_samples` is inferred from the file size.
+
+    """
+    if dtype is None or n_channels is None:
+        raise ValueError("'dtype' and 'n_channels' must be specified to "
+                         "read a raw binary file.")
+    dtype = np.dtype(dtype)
+    n_channels = int(n_channels)
+    assert n_channels > 0
+    offset = int(offset)
+    item_size = dtype.itemsize * n_channels
+    n_bytes = op.getsize(path) - offset
+    if n_bytes % item_size:
+        logger.warn("The size of `%s` is not a multiple of the sample "
+                    "size: the last incomplete sample is ignored.", path)
+    n_samples = n_bytes // item_size
+    if n_samples <= 0:
+        return np.zeros((0, n_channels), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode=mmap_mode or 'r',
+                     offset=offset, shape=(n_samples, n_channels))
+
+
+def read_array(path, mmap_mode=None, **kwargs):
+    """Read a .npy array, or memory-map a raw binary file.
+
+    Raw binary files (`.dat`, `.bin`, `.raw`) require the `dtype` and
+    `n_channels` keyword arguments, and optionally `offset` (the size of
+    the header in bytes). They are always memory-mapped.
+
+    """
     file_ext = op.splitext(path)[1]
     if file_ext == '.npy':
         return np.load(path, mmap_mode=mmap_mode)
+    elif file_ext in _RAW_EXTENSIONS:
+        return _read_raw(path, mmap_mode=mmap_mode, **kwargs)
     raise NotImplementedError("The file extension `{}` ".format(file_ext) +
                               "is not currently supported.")
 
 
 def write_array(path, arr):
-    """Write an array to a .npy file."""
+    """Write an array to a .npy file, or to a raw binary file."""
     file_ext = op.splitext(path)[1]
     if file_ext == '.npy':
         return np.save(path, arr)
+    elif file_ext in _RAW_EXTENSIONS:
+        return np.ascontiguousarray(arr).tofile(path)
     raise NotImplementedError("The file extension `{}` ".format(file_ext) +
                               "is not currently supported.")
 
 
+def _npy_header(dtype, shape, size=None):
+    """Return a version 1.0 .npy header, padded with spaces to a given
+    total size in bytes."""
+    from numpy.lib.format import dtype_to_descr, magic
+    d = {'descr': dtype_to_descr(dtype),
+         'fortran_order': False,
+         'shape': tuple(int(n) for n in shape),
+         }
+    header = repr(d).encode('latin1')
+    prefix = magic(1, 0)
+    # magic string, header length (2 bytes), header, final newline
+    n = len(prefix) + 2 + len(header) + 1
+    if size is None:
+        # Align the data on 64 bytes.
+        size = 64 * ((n + 63) // 64)
+    if n > size or size - len(prefix) - 2 >= 2 ** 16:
+        raise ValueError("The .npy header does not fit in "
+                         "{} bytes.".format(size))
+    header += b' ' * (size - n) + b'\n'
+    hlen = np.array(len(header), dtype='<u2').tobytes()
+    return prefix + hlen + header
+
+
+class NpyWriter(object):
+    """Write a .npy file incrementally, chunk by chunk.
+
+    The chunks are concatenated along the first dimension and streamed to
+    disk. A header with room for the largest possible shape is written
+    first, and it is patched with the actual shape when the writer is
+    closed. The array never needs to fit in memory.
+
+    Example
+    -------
+
+    ```python
+    with NpyWriter(path) as w:
+        for chunk in chunks:
+            w.append(chunk)
+    ```
+
+    """
+    # Used to reserve enough space for the final shape in the header.
+    _max_n = 2 ** 63 - 1
+
+    def __init__(self, path, dtype=None, shape=None):
+        self.path = path
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        # Shape of the array, except the first dimension.
+        self.shape = tuple(shape) if shape is not None else None
+        self.n = 0
+        self._header_size = None
+        self._f = open(path, 'wb')
+
+    def _write_header(self, n):
+        shape = (n,) + self.shape
+        self._f.write(_npy_header(self.dtype, shape, self._header_size))
+
+    def append(self, chunk):
+        """Append a chunk to the array."""
+        chunk = np.asarray(chunk)
+        if self.dtype is None:
+            self.dtype = chunk.dtype
+        if self.shape is None:
+            self.shape = chunk.shape[1:]
+        if chunk.shape[1:] != self.shape:
+            raise ValueError("The chunk shape {} is not ".format(chunk.shape) +
+                             "compatible with {}.".format(self.shape))
+        if self._header_size is None:
+            header = _npy_header(self.dtype, (self._max_n,) + self.shape)
+            self._header_size = len(header)
+            self._f.write(header)
+        self._f.write(np.ascontiguousarray(chunk, dtype=self.dtype).data)
+        self.n += chunk.shape[0]
+
+    def close(self):
+        """Patch the header with the final shape and close the file."""
+        if self._f is None:
+            return
+        if self.dtype is None:
+            self.dtype = np.dtype(np.float64)
+        if self.shape is None:
+            self.shape = ()
+        if self._header_size is None:
+            self._write_header(0)
+        else:
+            self._f.seek(0)
+            self._write_header(self.n)
+        self._f.close()
+        self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 # -----------------------------------------------------------------------------
-# Virtual concatenation
+# Block cache
 # -----------------------------------------------------------------------------
 
-def _start_stop(item):
-    """Find the start and stop indices of a __getitem__ item.
+def _split_item(item):
+    """Split a __getitem__ item into the index along the first dimension
+    and the index along the other dimensions."""
+    if isinstance(item, tuple):
+        return item[0], item[1:]
+    return item, ()
+
+
+def _index_array(item, n):
+    """Convert an array-like index along the first dimension to an array
+    of non-negative integers."""
+    item = np.asarray(item)
+    if item.dtype == np.bool_:
+        if item.shape != (n,):
+            raise IndexError("The boolean mask should have "
+                             "{} elements.".format(n))
+        return np.nonzero(item)[0]
+    item = item.astype(np.int64).ravel()
+    if len(item) and (item.min() < -n or item.max() >= n):
+        raise IndexError("Index out of bounds.")
+    return np.where(item < 0, item + n, item)
 
-    This is used only by ConcatenatedArrays.
 
-    Only two cases are supported currently:
+def _nbytes(value):
+    """Size in bytes of an array, or of a tuple/list/dict of arrays.
 
-    * Single integer.
-    * Contiguous slice in the first dimension only.
+    Python scalars are counted as 8 bytes.
 
     """
-    if isinstance(item, tuple):
-        item = item[0]
-    if isinstance(item, slice):
-        # Slice.
-        if item.step not in (None, 1):
-            return NotImplementedError()
-        return item.start, item.stop
-    elif isinstance(item, (list, np.ndarray)):
-        # List or array of indices.
-        return np.min(item), np.max(item)
-    else:
-        # Integer.
-        return item, item + 1
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    elif isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    elif isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    elif isinstance(value, string_types):
+        return len(value)
+    elif isinstance(value, integer_types + (float, complex)):
+        return 8
+    return 0
+
+
+class LRUCache(object):
+    """Least-recently-used cache with a byte budget.
+
+    The size of every value is measured with its `nbytes` attribute. The
+    least recently used items are evicted when the total size exceeds
+    `max_bytes`.
 
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._data
 
-def _fill_index(arr, item):
-    if isinstance(item, tuple):
-        item = (slice(None, None, None),) + item[1:]
-        return arr[item]
-    else:
-        return arr
+    def __len__(self):
+        return len(self._data)
+
+    def keys(self):
+        """List of keys, from the least to the most recently used."""
+        return list(self._data.keys())
+
+    def items(self):
+        """List of `(key, value)` pairs, from the least to the most recently
+        used. The order is not modified."""
+        return list(self._data.items())
+
+    def get(self, key, default=None):
+        """Return a value and mark it as recently used."""
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        """Add a value and evict the least recently used items if
+        needed."""
+        self.pop(key)
+        size = _nbytes(value)
+        self._data[key] = value
+        self._sizes[key] = size
+        self.nbytes += size
+        self._evict()
+
+    def pop(self, key, default=None):
+        """Remove an item."""
+        if key not in self._data:
+            return default
+        self.nbytes -= self._sizes.pop(key)
+        return self._data.pop(key)
+
+    def evict(self):
+        """Remove the least recently used item and return its key."""
+        if not self._data:
+            return
+        key = next(iter(self._data))
+        self.pop(key)
+        self.evictions += 1
+        return key
+
+    def demote(self, keys):
+        """Mark some items as the least recently used ones, so that they
+        are evicted first."""
+        keys = [key for key in keys if key in self._data]
+        if not keys:
+            return
+        first = [(key, self._data.pop(key)) for key in keys]
+        self._data = OrderedDict(first + list(self._data.items()))
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        # NOTE: we always keep the most recent item.
+        while self.nbytes > self.max_bytes and len(self._data) > 1:
+            self.evict()
+
+    def clear(self):
+        """Remove all items."""
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+
+_CACHED_ARRAY_IDS = count()
+
+
+class CachedArray(object):
+    """Wrap an array (typically memory-mapped) and keep the most recently
+    read blocks of rows in RAM.
+
+    The array is split into aligned blocks of `block_size` rows along the
+    first dimension. Every read loads the blocks it needs from the
+    underlying array, unless they are already in the LRU cache.
+
+    Parameters
+    ----------
+
+    arr : array-like
+        The underlying array.
+    block_size : int
+        Number of rows in every block.
+    cache : LRUCache instance
+        The cache may be shared among several arrays.
+    cache_size : int
+        Byte budget of the cache, if no cache is specified.
+
+    """
+    def __init__(self, arr, block_size=None, cache=None, cache_size=None):
+        self.arr = arr
+        self.block_size = int(block_size or 2 ** 14)
+        assert self.block_size > 0
+        self.cache = cache if cache is not None else LRUCache(cache_size)
+        # Unique key of the array in the (possibly shared) cache.
+        self._key = next(_CACHED_ARRAY_IDS)
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+        self.ndim = len(self.shape)
 
+    def __len__(self):
+        return self.shape[0]
+
+    def _block(self, block):
+        key = (self._key, block)
+        data = self.cache.get(key)
+        if data is None:
+            i = block * self.block_size
+            data = np.array(self.arr[i:i + self.block_size])
+            # The cached blocks are shared by all readers.
+            data.flags.writeable = False
+            self.cache.set(key, data)
+        return data
+
+    def _get_range(self, start, stop):
+        """Read a contiguous range of rows."""
+        bs = self.block_size
+        if start >= stop:
+            return np.array(self.arr[0:0])
+        blocks = range(start // bs, (stop - 1) // bs + 1)
+        if len(blocks) == 1:
+            b = blocks[0]
+            return self._block(b)[start - b * bs:stop - b * bs].copy()
+        out = np.empty((stop - start,) + self.shape[1:], dtype=self.dtype)
+        for b in blocks:
+            i, j = max(start, b * bs), min(stop, (b + 1) * bs)
+            out[i - start:j - start] = self._block(b)[i - b * bs:j - b * bs]
+        return out
+
+    def _get_indices(self, indices):
+        """Read arbitrary rows."""
+        bs = self.block_size
+        order = np.argsort(indices, kind='mergesort')
+        indices = indices[order]
+        blocks = indices // bs
+        out = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        for b in _unique(blocks):
+            i, j = np.searchsorted(blocks, [b, b + 1])
+            out[order[i:j]] = self._block(b)[indices[i:j] - b * bs]
+        return out
+
+    def __getitem__(self, item):
+        item, rest = _split_item(item)
+        n = self.shape[0]
+        if isinstance(item, slice):
+            start, stop, step = item.indices(n)
+            if step == 1:
+                out = self._get_range(start, stop)
+            else:
+                out = self._get_indices(np.arange(start, stop, step))
+        elif isinstance(item, (list, np.ndarray)):
+            out = self._get_indices(_index_array(item, n))
+        else:
+            if item < 0:
+                item += n
+            if not 0 <= item < n:
+                raise IndexError("Index {} out of bounds.".format(item))
+            out = self._get_range(item, item + 1)[0]
+            return out[rest] if rest else out
+        if rest:
+            out = out[(slice(None, None, None),) + rest]
+        return out
+
+
+# -----------------------------------------------------------------------------
+# Virtual concatenation
+# -----------------------------------------------------------------------------
 
 class ConcatenatedArrays(object):
     """This object represents a concatenation of several memory-mapped
-    arrays."""
-    def __init__(self, arrs, cols=None, scaling=None):
+    arrays.
+
+    The following indexing modes are supported along the first dimension:
+
+    * Integer: a single row (with the first dimension kept).
+    * Slice, with an optional step.
+    * Array of indices, or boolean mask.
+
+    Every requested row is routed to its recording, the rows are read in
+    one batch per recording, and the result is scattered into a
+    preallocated output array. Whole recordings are never loaded unless
+    all their rows are requested.
+
+    An optional block cache can be enabled with `cache_size` (a byte
+    budget shared by all recordings). Repeated reads of the same regions
+    are then served from RAM.
+
+    """
+    def __init__(self, arrs, cols=None, scaling=None,
+                 cache_size=None, block_size=None):
         assert isinstance(arrs, list)
+        self.cache = None
+        if cache_size:
+            self.cache = LRUCache(cache_size)
+            arrs = [CachedArray(arr, block_size=block_size, cache=self.cache)
+                    for arr in arrs]
         self.arrs = arrs
         # Reordering of the columns.
         self.cols = cols
@@ -328,63 +775,94 @@ class ConcatenatedArrays(object):
     def _get_recording(self, index):
         """Return the recording that contains a given index."""
         assert index >= 0
-        recs = np.nonzero((index - self.offsets[:-1]) >= 0)[0]
-        if len(recs) == 0:
-            # If the index is greater than the total size,
-            # return the last recording.
-            return len(self.arrs) - 1
         # Return the last recording such that the index is greater than
-        # its offset.
-        return recs[-1]
+        # its offset. If the index is greater than the total size,
+        # return the last recording.
+        rec = np.searchsorted(self.offsets[:-1], index, side='right') - 1
+        return int(min(rec, len(self.arrs) - 1))
+
+    def _read(self, rec, index, rest):
+        """Read some rows of a recording, and apply the rest of the index
+        and the column selection."""
+        cols = self.cols if self.cols is not None else slice(None, None, None)
+        chunk = self.arrs[rec][index]
+        if rest:
+            chunk = chunk[(slice(None, None, None),) + rest]
+        return chunk[..., cols]
+
+    def _get_slice(self, item, rest):
+        """Read a slice with a positive step, one strided view per
+        recording."""
+        n = self.offsets[-1]
+        start, stop, step = item.indices(n)
+        chunks = []
+        for rec in range(len(self.arrs)):
+            rec_start, rec_stop = self.offsets[rec], self.offsets[rec + 1]
+            if rec_stop <= start or rec_start >= stop:
+                continue
+            # First index in the recording that belongs to the slice.
+            i = max(start, start + -(-(rec_start - start) // step) * step)
+            j = min(stop, rec_stop)
+            if i >= j:
+                continue
+            rel = slice(i - rec_start, j - rec_start, step)
+            chunks.append(self._read(rec, rel, rest))
+        if not chunks:
+            return self._read(0, slice(0, 0), rest)
+        elif len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks, axis=0)
+
+    def _get_indices(self, indices, rest):
+        """Gather arbitrary rows, reading one batch per recording."""
+        # Sort the indices so that every recording is read sequentially.
+        order = np.argsort(indices, kind='mergesort')
+        indices = indices[order]
+        # Position of the recording boundaries in the sorted indices.
+        bounds = np.searchsorted(indices, self.offsets)
+        out = None
+        for rec in range(len(self.arrs)):
+            i, j = bounds[rec], bounds[rec + 1]
+            if i == j:
+                continue
+            chunk = self._read(rec, indices[i:j] - self.offsets[rec], rest)
+            if out is None:
+                out = np.empty((len(indices),) + chunk.shape[1:],
+                               dtype=chunk.dtype)
+            out[order[i:j]] = chunk
+        if out is None:
+            return self._read(0, slice(0, 0), rest)
+        return out
 
     def __getitem__(self, item):
-        cols = self.cols if self.cols is not None else slice(None, None, None)
-        # Get the start and stop indices of the requested item.
-        start, stop = _start_stop(item)
-        # Return the concatenation of all arrays.
-        if start is None and stop is None:
-            return np.concatenate(self.arrs, axis=0)[..., cols]
-        if start is None:
-            start = 0
-        if stop is None:
-            stop = self.offsets[-1]
-        if stop < 0:
-            stop = self.offsets[-1] + stop
-        # Get the recording indices of the first and last item.
-        rec_start = self._get_recording(start)
-        rec_stop = self._get_recording(stop)
-        assert 0 <= rec_start <= rec_stop < len(self.arrs)
-        # Find the start and stop relative to the arrays.
-        start_rel = start - self.offsets[rec_start]
-        stop_rel = stop - self.offsets[rec_stop]
-        # Single array case.
-        if rec_start == rec_stop:
-            # Apply the rest of the index.
-            return _fill_index(self.arrs[rec_start][start_rel:stop_rel],
-                               item)[..., cols]
-        chunk_start = self.arrs[rec_start][start_rel:]
-        chunk_stop = self.arrs[rec_stop][:stop_rel]
-        # Concatenate all chunks.
-        l = [chunk_start]
-        if rec_stop - rec_start >= 2:
-            logger.warn("Loading a full virtual array: this might be slow "
-                        "and something might be wrong.")
-            l += [self.arrs[r][...] for r in range(rec_start + 1,
-                                                   rec_stop)]
-        l += [chunk_stop]
-        # Apply the rest of the index.
-        return _fill_index(np.concatenate(l, axis=0), item)[..., cols]
+        item, rest = _split_item(item)
+        n = self.offsets[-1]
+        if isinstance(item, slice):
+            if item.step is None or item.step > 0:
+                return self._get_slice(item, rest)
+            # Negative steps are handled as an array of indices.
+            return self._get_indices(np.arange(*item.indices(n)), rest)
+        elif isinstance(item, (list, np.ndarray)):
+            return self._get_indices(_index_array(item, n), rest)
+        # Integer: we keep the first dimension.
+        if item < 0:
+            item += n
+        if not 0 <= item < n:
+            raise IndexError("Index {} out of bounds.".format(item))
+        return self._get_slice(slice(item, item + 1), rest)
 
     def __len__(self):
         return self.shape[0]
 
 
-def _concatenate_virtual_arrays(arrs, cols=None, scaling=None):
+def _concatenate_virtual_arrays(arrs, cols=None, scaling=None,
+                                cache_size=None, block_size=None):
     """Return a virtual concatenate of several NumPy arrays."""
     n = len(arrs)
     if n == 0:
         return None
-    return ConcatenatedArrays(arrs, cols, scaling=scaling)
+    return ConcatenatedArrays(arrs, cols, scaling=scaling,
+                              cache_size=cache_size, block_size=block_size)
 
 
 # -----------------------------------------------------------------------------
@@ -466,19 +944,191 @@ def data_chunk(data, chunk, with_overlap=False):
     return data[i:j, ...]
 
 
-def get_excerpts(data, n_excerpts=None, excerpt_size=None):
+def _n_workers(n_workers=None):
+    """Number of workers, by default the number of CPUs."""
+    if n_workers is None:
+        from multiprocessing import cpu_count
+        n_workers = cpu_count()
+    return max(1, int(n_workers))
+
+
+def _executor(n_workers=None, backend='thread'):
+    """Return a concurrent.futures executor, or None if the computation
+    should be serial."""
+    assert backend in ('thread', 'process')
+    n_workers = _n_workers(n_workers)
+    if n_workers <= 1:
+        return None
+    try:
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    except ImportError:  # pragma: no cover
+        logger.warn("concurrent.futures is not available: install it with "
+                    "`pip install futures`. Falling back to serial mode.")
+        return None
+    if backend == 'thread':
+        return ThreadPoolExecutor(max_workers=n_workers)
+    return ProcessPoolExecutor(max_workers=n_workers)
+
+
+def _apply_chunk(func, data, bounds, is_chunk=False):
+    """Apply a function on a data chunk and trim the result to the keep
+    region.
+
+    `data` is the whole data, or the chunk itself if `is_chunk` is True.
+
+    """
+    s_start, s_end, keep_start, keep_end = bounds
+    if not is_chunk:
+        data = data[s_start:s_end, ...]
+    assert data.shape[0] == s_end - s_start
+    out = np.asarray(func(data))
+    if out.shape[0] != s_end - s_start:
+        raise ValueError("The function should return an array with "
+                         "{} rows, not {}.".format(s_end - s_start,
+                                                   out.shape[0]))
+    return out[keep_start - s_start:keep_end - s_start, ...]
+
+
+def _write_chunk(out, n_samples, bounds, res):
+    """Write a trimmed chunk result, and allocate the output array with the
+    first chunk if needed."""
+    if out is None:
+        out = np.empty((n_samples,) + res.shape[1:], dtype=res.dtype)
+    out[bounds[2]:bounds[3], ...] = res
+    return out
+
+
+def map_chunks(func, data, chunk_size, overlap=0, n_workers=None,
+               backend='thread', out=None):
+    """Apply a function on overlapping chunks of data, in parallel.
+
+    Parameters
+    ----------
+
+    func : function
+        A function `(chunk_size, ...) -> (chunk_size, ...)` that preserves
+        the first dimension. With the `process` backend, it must be
+        picklable.
+    data : array-like
+        The data, typically a memory-mapped `(n_samples, n_channels)`
+        array.
+    chunk_size : int
+        Number of samples in every chunk, including the overlap.
+    overlap : int
+        Number of samples overlapping between successive chunks. Half of it
+        is trimmed on each side of every result (see `chunk_bounds()`).
+    n_workers : int
+        Number of workers. The computation is serial if it is 0 or 1. By
+        default, this is the number of CPUs.
+    backend : str
+        Either `thread` or `process`.
+    out : array-like
+        Optional preallocated or memory-mapped output array. By default, an
+        array is allocated in memory after the first chunk.
+
+    Returns
+    -------
+
+    out : array
+        The concatenation of the trimmed results, written in order. With
+        empty data, this is the result of the function on the empty data,
+        or `out` if it is given.
+
+    Notes
+    -----
+
+    At most a few chunks per worker are in flight at any time, so that the
+    memory usage is bounded even for very long recordings.
+
+    """
+    n_samples = data.shape[0]
+    if n_samples == 0:
+        # NOTE: the function gives the shape and dtype of the empty output.
+        return out if out is not None else np.asarray(func(data[:0]))
+    chunks = []
+    for s_start, s_end, keep_start, keep_end in chunk_bounds(n_samples,
+                                                             chunk_size,
+                                                             overlap=overlap):
+        s_end, keep_end = min(s_end, n_samples), min(keep_end, n_samples)
+        if keep_start < keep_end:
+            chunks.append((s_start, s_end, keep_start, keep_end))
+
+    executor = _executor(n_workers, backend)
+    if executor is None:
+        for bounds in chunks:
+            res = _apply_chunk(func, data, bounds)
+            out = _write_chunk(out, n_samples, bounds, res)
+        return out
+
+    # Maximum number of chunks processed at the same time.
+    n_pending = 2 * _n_workers(n_workers)
+    pending = []
+    with executor:
+        for i, bounds in enumerate(chunks):
+            # NOTE: worker processes cannot read from the data, which
+            # might not be picklable cheaply (memmaps are copied).
+            if backend == 'thread':
+                future = executor.submit(_apply_chunk, func, data, bounds)
+            else:
+                future = executor.submit(_apply_chunk, func,
+                                         data[bounds[0]:bounds[1]], bounds,
+                                         is_chunk=True)
+            pending.append((bounds, future))
+            # Write the results in order when too many chunks are pending.
+            while len(pending) >= n_pending or (i == len(chunks) - 1 and
+                                                pending):
+                bounds, future = pending.pop(0)
+                out = _write_chunk(out, n_samples, bounds, future.result())
+    return out
+
+
+def excerpt_bounds(n_samples, n_excerpts=None, excerpt_size=None):
+    """Return the `(start, end)` bounds of the excerpts taken by
+    `get_excerpts()`, as a `(n, 2)` array.
+
+    This is an index plan: the bounds refer to the rows of the data, which
+    can then be read as views without concatenating the excerpts.
+
+    """
     assert n_excerpts is not None
     assert excerpt_size is not None
-    if len(data) < n_excerpts * excerpt_size:
-        return data
+    if n_samples < n_excerpts * excerpt_size:
+        bounds = [(0, n_samples)]
     elif n_excerpts == 0:
-        return data[:0]
+        bounds = []
     elif n_excerpts == 1:
-        return data[:excerpt_size]
-    out = np.concatenate([data_chunk(data, chunk)
-                          for chunk in excerpts(len(data),
-                                                n_excerpts=n_excerpts,
-                                                excerpt_size=excerpt_size)])
+        bounds = [(0, excerpt_size)]
+    else:
+        bounds = list(excerpts(n_samples,
+                               n_excerpts=n_excerpts,
+                               excerpt_size=excerpt_size))
+    return np.array(bounds, dtype=np.int64).reshape((-1, 2))
+
+
+def _excerpt_index(bounds):
+    """Return the concatenated indices of excerpts given by their bounds."""
+    bounds = np.asarray(bounds, dtype=np.int64).reshape((-1, 2))
+    sizes = bounds[:, 1] - bounds[:, 0]
+    n = sizes.sum()
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Offsets of every excerpt in the output array.
+    offsets = np.cumsum(sizes) - sizes
+    return (np.arange(n, dtype=np.int64) +
+            np.repeat(bounds[:, 0] - offsets, sizes))
+
+
+def get_excerpts(data, n_excerpts=None, excerpt_size=None):
+    bounds = excerpt_bounds(len(data),
+                            n_excerpts=n_excerpts,
+                            excerpt_size=excerpt_size)
+    if len(bounds) == 0:
+        return data[:0]
+    elif len(bounds) == 1:
+        start, end = bounds[0]
+        return data[start:end]
+    out = np.concatenate([data_chunk(data, (start, end))
+                          for start, end in bounds])
     assert len(out) <= n_excerpts * excerpt_size
     return out
 
@@ -536,14 +1186,230 @@ def grouped_mean(arr, spike_clusters):
     spike_clusters = np.asarray(spike_clusters)
     assert arr.ndim == 1
     assert arr.shape[0] == len(spike_clusters)
-    cluster_ids = _unique(spike_clusters)
-    spike_clusters_rel = _index_of(spike_clusters, cluster_ids)
-    spike_counts = np.bincount(spike_clusters_rel)
-    assert len(spike_counts) == len(cluster_ids)
-    t = np.zeros(len(cluster_ids))
-    # Compute the sum with possible repetitions.
-    np.add.at(t, spike_clusters_rel, arr)
-    return t / spike_counts
+    return grouped_reduce(arr, spike_clusters, 'mean').mean
+
+
+# -----------------------------------------------------------------------------
+# Grouped reductions
+# -----------------------------------------------------------------------------
+
+_GROUPED_REDUCTIONS = ('count', 'sum', 'mean', 'var', 'min', 'max',
+                       'quantiles')
+
+
+def _segments(spike_clusters_rel):
+    """Sort relative cluster indices and return the segments of every
+    cluster.
+
+    Return `(order, clusters, starts, counts)` where `order` sorts the
+    spikes by cluster, and `clusters`, `starts` and `counts` are the
+    relative index, first position, and size of every non-empty segment.
+
+    """
+    order = np.argsort(spike_clusters_rel, kind='mergesort')
+    rel = spike_clusters_rel[order]
+    starts = np.flatnonzero(np.r_[True, rel[1:] != rel[:-1]])
+    counts = np.diff(np.r_[starts, len(rel)])
+    return order, rel[starts], starts, counts
+
+
+def _chunk_rows(arr, chunk_bytes=2 ** 26):
+    """Number of rows in a chunk of about `chunk_bytes` bytes."""
+    row_bytes = 8 * int(np.prod(arr.shape[1:]))
+    return max(1, chunk_bytes // max(1, row_bytes))
+
+
+def _grouped_quantiles(arr, spike_ids, spike_clusters_rel, n_clusters,
+                       quantiles, n_samples_max):
+    """Approximate per-cluster quantiles from a regular subset of at most
+    `n_samples_max` spikes per cluster."""
+    order, clusters, starts, counts = _segments(spike_clusters_rel)
+    # Number of samples kept in every cluster, and the regular step.
+    n_kept = np.minimum(counts, n_samples_max)
+    steps = counts // n_kept
+    # Position of every kept sample within its segment.
+    offsets = np.r_[0, np.cumsum(n_kept)[:-1]]
+    within = np.arange(n_kept.sum()) - np.repeat(offsets, n_kept)
+    positions = np.repeat(starts, n_kept) + within * np.repeat(steps, n_kept)
+    spike_ids = spike_ids[order[positions]]
+    # NOTE: sorted spike ids for efficient reads in memory-mapped arrays.
+    sort = np.argsort(spike_ids, kind='mergesort')
+    values = np.empty((len(spike_ids),) + arr.shape[1:])
+    values[sort] = arr[spike_ids[sort]]
+    values = values.reshape((len(values), -1))
+    # Sort the values within every segment, independently in every column.
+    rel = np.repeat(np.arange(len(clusters)), n_kept)
+    by_value = np.argsort(values, axis=0, kind='mergesort')
+    by_segment = np.argsort(rel[by_value], axis=0, kind='mergesort')
+    values = np.take_along_axis(values,
+                                np.take_along_axis(by_value, by_segment, 0),
+                                axis=0)
+    # Linear interpolation between the closest ranks in every segment,
+    # like `np.percentile()`. Shape: (n_segments, n_quantiles).
+    rank = np.outer(n_kept - 1, np.asarray(quantiles, dtype=np.float64))
+    below = np.floor(rank).astype(np.int64)
+    above = np.minimum(below + 1, (n_kept - 1)[:, np.newaxis])
+    w_above = (rank - below)[..., np.newaxis]
+    offsets = offsets[:, np.newaxis]
+    q = (values[offsets + below] * (1 - w_above) +
+         values[offsets + above] * w_above)
+    # Shape: (n_clusters, n_quantiles, ...)
+    out = np.empty((n_clusters, len(quantiles), values.shape[1]))
+    # Empty clusters have NaN quantiles.
+    out.fill(np.nan)
+    out[clusters] = q
+    return out.reshape((n_clusters, len(quantiles)) + arr.shape[1:])
+
+
+def grouped_reduce(arr, spike_clusters, reductions=None, cluster_ids=None,
+                   quantiles=(.05, .5, .95), n_samples_quantiles=1000,
+                   chunk_size=None, spike_ids=None):
+    """Compute several per-cluster reductions of a spike-dependent array in
+    a single sort-based pass.
+
+    Parameters
+    ----------
+
+    arr : array-like
+        A `(n_spikes, ...)` array, for example `(n_spikes, n_channels)`
+        masks or `(n_spikes, n_channels, n_features)` features. It may be
+        memory-mapped: it is read in chunks of `chunk_size` spikes.
+    spike_clusters : array-like
+        The cluster of every spike.
+    reductions : str or list
+        Any of `count`, `sum`, `mean`, `var`, `min`, `max`, `quantiles`.
+        By default, all reductions except the quantiles are computed.
+    cluster_ids : array-like
+        The clusters to consider, in order. By default, all non-negative
+        clusters appearing in `spike_clusters`. Spikes from other clusters
+        are ignored.
+    quantiles : list
+        Quantiles in `[0, 1]`.
+    n_samples_quantiles : int
+        The quantiles are approximate: they are computed from a regular
+        subset of at most that number of spikes per cluster.
+    chunk_size : int
+        Number of spikes in every chunk.
+    spike_ids : array-like
+        The sorted ids of the spikes to consider, all spikes by default.
+        Only the rows of these spikes are read, chunk by chunk.
+
+    Returns
+    -------
+
+    out : Bunch
+        Contains `cluster_ids`, and one `(n_clusters, ...)` array per
+        requested reduction. The quantiles have a shape
+        `(n_clusters, n_quantiles, ...)`. Empty clusters have a count of
+        0 and NaN statistics.
+
+    """
+    if reductions is None:
+        reductions = _GROUPED_REDUCTIONS[:-1]
+    if isinstance(reductions, string_types):
+        reductions = (reductions,)
+    for name in reductions:
+        if name not in _GROUPED_REDUCTIONS:
+            raise ValueError("Unknown reduction `{}`.".format(name))
+    spike_clusters = np.asarray(spike_clusters)
+    assert arr.shape[0] == len(spike_clusters)
+    if spike_ids is not None:
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        spike_clusters = spike_clusters[spike_ids]
+    n_spikes = len(spike_clusters)
+
+    # Relative cluster indices, -1 for ignored spikes.
+    if cluster_ids is None:
+        cluster_ids = _unique(spike_clusters)
+        rel = np.where(spike_clusters >= 0,
+                       _index_of(spike_clusters, cluster_ids), -1)
+    else:
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        rel = _index_of_sparse(spike_clusters, cluster_ids) \
+            if len(cluster_ids) else -np.ones(n_spikes, dtype=np.int64)
+        rel[~np.in1d(spike_clusters, cluster_ids)] = -1
+    n_clusters = len(cluster_ids)
+    shape = (n_clusters,) + arr.shape[1:]
+
+    count = np.zeros(n_clusters, dtype=np.int64)
+    total = np.zeros(shape)
+    m2 = np.zeros(shape)
+    mins = np.empty(shape)
+    mins.fill(np.inf)
+    maxs = np.empty(shape)
+    maxs.fill(-np.inf)
+    need_var = 'var' in reductions
+    need_min = 'min' in reductions
+    need_max = 'max' in reductions
+
+    chunk_size = chunk_size or _chunk_rows(arr)
+    for i in range(0, n_spikes, chunk_size):
+        rel_chunk = rel[i:i + chunk_size]
+        valid = rel_chunk >= 0
+        if not np.any(valid):
+            continue
+        rel_chunk = rel_chunk[valid]
+        rows = (spike_ids[i:i + chunk_size] if spike_ids is not None
+                else slice(i, i + chunk_size))
+        x = np.asarray(arr[rows], dtype=np.float64)[valid]
+        order, idx, starts, counts = _segments(rel_chunk)
+        x = x[order]
+        sums = np.add.reduceat(x, starts, axis=0)
+        if need_var:
+            # Combine the chunk statistics with the previous ones
+            # (parallel algorithm by Chan et al.).
+            n_a = count[idx].reshape((-1,) + (1,) * (x.ndim - 1))
+            n_b = counts.reshape(n_a.shape)
+            mean_b = sums / n_b
+            dev = x - np.repeat(mean_b, counts, axis=0)
+            m2_b = np.add.reduceat(dev ** 2, starts, axis=0)
+            mean_a = total[idx] / np.maximum(n_a, 1)
+            delta = mean_b - mean_a
+            m2[idx] += m2_b + delta ** 2 * n_a * n_b / (n_a + n_b)
+        if need_min:
+            mins[idx] = np.minimum(mins[idx],
+                                   np.minimum.reduceat(x, starts, axis=0))
+        if need_max:
+            maxs[idx] = np.maximum(maxs[idx],
+                                   np.maximum.reduceat(x, starts, axis=0))
+        total[idx] += sums
+        count[idx] += counts
+
+    out = Bunch(cluster_ids=cluster_ids)
+    empty = count == 0
+    denom = np.maximum(count, 1).reshape((-1,) + (1,) * (len(shape) - 1))
+    for name in reductions:
+        if name == 'count':
+            out.count = count
+        elif name == 'sum':
+            out.sum = total
+        elif name == 'mean':
+            out.mean = total / denom
+            out.mean[empty] = np.nan
+        elif name == 'var':
+            out.var = m2 / denom
+            out.var[empty] = np.nan
+        elif name == 'min':
+            out.min = mins
+            out.min[empty] = np.nan
+        elif name == 'max':
+            out.max = maxs
+            out.max[empty] = np.nan
+        elif name == 'quantiles':
+            rel_ids = np.flatnonzero(rel >= 0)
+            if len(rel_ids):
+                out.quantiles = _grouped_quantiles(arr,
+                                                   (spike_ids[rel_ids]
+                                                    if spike_ids is not None
+                                                    else rel_ids),
+                                                   rel[rel_ids],
+                                                   n_clusters, quantiles,
+                                                   n_samples_quantiles)
+            else:
+                out.quantiles = np.empty((n_clusters, len(quantiles)) +
+                                         arr.shape[1:])
+                out.quantiles.fill(np.nan)
+    return out
 
 
 def regular_subset(spikes, n_spikes_max=None, offset=0):
@@ -657,3 +1523,91 @@ def _accumulate(data_list, no_concat=()):
     # doesn't support ragged arrays).
     out.update({name: acc.get(name) for name in no_concat})
     return out
+
+
+def _repeat_into(out, arr, repeats=None):
+    """Write `np.repeat(arr, repeats, axis=0)` into the array `out`.
+
+    When all repeats are equal, the rows are broadcast directly into `out`
+    and no temporary array is created.
+
+    """
+    arr = np.asarray(arr)
+    if repeats is None:
+        out[...] = arr.reshape(out.shape)
+        return out
+    repeats = np.asarray(repeats, dtype=np.int64)
+    n = len(repeats)
+    if n == 0 or not len(out):
+        return out
+    if np.all(repeats == repeats[0]):
+        # NOTE: setting the shape raises an error instead of silently
+        # returning a copy.
+        view = out.view()
+        view.shape = (n, repeats[0]) + out.shape[1:]
+        view[...] = arr.reshape((n, 1) + out.shape[1:])
+    else:
+        out[...] = np.repeat(arr.reshape((n,) + out.shape[1:]),
+                             repeats, axis=0)
+    return out
+
+
+class ArrayBuilder(object):
+    """Build arrays with a known number of rows by writing items directly
+    into preallocated buffers.
+
+    There is one 2D buffer per name, allocated on first use. Every name
+    has its own write position that moves forward as items are added.
+
+    """
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self._buffers = {}
+        self._offsets = {}
+        self._counters = defaultdict(int)
+
+    def next(self, name, n, n_cols=1, dtype=np.float32):
+        """Return a writable view on the next `n` rows of a buffer."""
+        if name not in self._buffers:
+            self._buffers[name] = np.empty((self.n_rows, n_cols), dtype=dtype)
+            self._offsets[name] = 0
+        buf = self._buffers[name]
+        assert buf.shape[1] == n_cols
+        i = self._offsets[name]
+        if i + n > self.n_rows:
+            raise ValueError("The buffer `{}` has only {} rows.".format(
+                             name, self.n_rows))
+        self._offsets[name] = i + n
+        return buf[i:i + n]
+
+    def add(self, name, arr, repeats=None, dtype=np.float32):
+        """Write an array, with every row optionally repeated a given number
+        of times."""
+        arr = np.asarray(arr)
+        n = len(arr) if repeats is None else int(np.sum(repeats))
+        n_cols = int(np.prod(arr.shape[1:])) if arr.ndim >= 2 else 1
+        return _repeat_into(self.next(name, n, n_cols, dtype), arr, repeats)
+
+    def add_index(self, name, repeats, dtype=np.float32):
+        """Write consecutive item indices, each repeated a given number of
+        times. The indices continue across successive calls."""
+        k = len(repeats)
+        i = self._counters[name]
+        self._counters[name] += k
+        index = np.arange(i, i + k).reshape((k, 1))
+        return self.add(name, index, repeats, dtype=dtype)
+
+    @property
+    def names(self):
+        """List of names."""
+        return set(self._buffers)
+
+    def __contains__(self, name):
+        return name in self._buffers
+
+    def __getitem__(self, name):
+        """Return the full buffer with a given name."""
+        if self._offsets[name] != self.n_rows:
+            raise ValueError("The buffer `{}` has {} rows out of {}.".format(
+                             name, self._offsets[name], self.n_rows))
+        return self._buffers[name]
@@ -7,28 +7,464 @@
 #------------------------------------------------------------------------------
 
 from functools import wraps
+import hashlib
 import inspect
 import logging
+import mmap
 import os
 import os.path as op
+from threading import Lock, current_thread, local
+from timeit import default_timer
 
-from six.moves.cPickle import dump, load
+import numpy as np
+from six import integer_types, string_types
+from six.moves.cPickle import dump, dumps, load, loads, PicklingError
 
 from phy.utils import (_save_json, _load_json,
-                       _ensure_dir_exists, _fullname,)
+                       _ensure_dir_exists, _fullname, Bunch,)
 from phy.utils.config import phy_config_dir
+from .array import LRUCache, _executor, _nbytes, _unique
 
 logger = logging.getLogger(__name__)
 
 
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+_MISSING = object()
+
+
+def _cluster_arg(args, kwargs):
+    """Return the cluster id if a function is called with a single integer
+    argument, None otherwise."""
+    if len(args) == 1 and not kwargs and \
+            isinstance(args[0], integer_types + (np.integer,)):
+        return int(args[0])
+
+
+#------------------------------------------------------------------------------
+# Argument hashing
+#------------------------------------------------------------------------------
+
+# Tuples and lists longer than this are hashed by joblib.
+_MAX_FAST_LENGTH = 16
+
+
+def _is_file_memmap(obj):
+    """Whether an object is a read-only memmap of a whole file mapping,
+    i.e. not a view."""
+    return (isinstance(obj, np.memmap) and
+            isinstance(obj.base, mmap.mmap) and
+            obj.mode in ('r', 'c') and
+            bool(obj.filename) and op.exists(obj.filename))
+
+
+def _fast_key(obj):
+    """Return a cheap representation of an argument, or None if the
+    argument is not supported.
+
+    Scalars, strings, small tuples and lists of those, and read-only
+    memmaps are supported. Memmaps are represented by their file path,
+    offset, shape, dtype, file size and modification time, instead of
+    their contents.
+
+    """
+    if obj is None or isinstance(obj, (bool, np.bool_)):
+        return ('b', obj if obj is None else bool(obj))
+    elif isinstance(obj, integer_types + (np.integer,)):
+        return ('i', int(obj))
+    elif isinstance(obj, (float, np.floating)):
+        return ('f', repr(float(obj)))
+    elif isinstance(obj, string_types):
+        return ('s', obj)
+    elif isinstance(obj, (tuple, list)) and len(obj) <= _MAX_FAST_LENGTH:
+        keys = tuple(_fast_key(item) for item in obj)
+        if any(key is None for key in keys):
+            return
+        return ('t' if isinstance(obj, tuple) else 'l',) + keys
+    elif _is_file_memmap(obj):
+        st = os.stat(obj.filename)
+        return ('m', op.realpath(obj.filename), obj.offset, obj.shape,
+                obj.dtype.str, obj.strides, st.st_size, st.st_mtime)
+
+
+def _has_memmap(args, kwargs):
+    return any(isinstance(arg, np.memmap)
+               for arg in tuple(args) + tuple(kwargs.values()))
+
+
+def _hash_args(args, kwargs):
+    """Hash function arguments, without reading the contents of memmaps
+    and with a fast path for small arguments."""
+    key = _fast_key((tuple(args), sorted(kwargs.items())))
+    if key is None:
+        from joblib import hash
+        return hash((args, kwargs))
+    return hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+
+
+#------------------------------------------------------------------------------
+# Fingerprints
+#------------------------------------------------------------------------------
+
+def _file_stat(path, h):
+    st = os.stat(path)
+    h.update(repr((op.realpath(path), st.st_size,
+                   st.st_mtime)).encode('utf-8'))
+
+
+def _sample_rows(obj, n_rows, h, n_samples=16):
+    """Hash a fixed sample of evenly spaced rows of an array-like object."""
+    rows = _unique(np.linspace(0, n_rows - 1, n_samples).astype(np.int64))
+    h.update(np.ascontiguousarray(np.asarray(obj[rows])).view(np.uint8))
+
+
+def _fingerprint(obj):
+    """Return a cheap fingerprint of a file or an array.
+
+    For files and memory-mapped arrays, the fingerprint depends on the
+    path, the size, and the modification time of the file. For in-memory
+    arrays, it depends on the shape, the dtype, and the whole contents.
+    Other array-like objects, which may load their data lazily, are
+    fingerprinted from their shape, their dtype, and a fixed sample of
+    rows.
+
+    """
+    h = hashlib.sha1()
+    if obj is None:
+        h.update(b'None')
+        return h.hexdigest()[:16]
+    if isinstance(obj, string_types):
+        _file_stat(obj, h)
+        return h.hexdigest()[:16]
+    shape = tuple(obj.shape if hasattr(obj, 'shape') else (len(obj),))
+    dtype = str(getattr(obj, 'dtype', ''))
+    h.update(repr((shape, dtype)).encode('utf-8'))
+    filename = getattr(obj, 'filename', None)
+    if isinstance(obj, np.memmap) and filename and op.exists(filename):
+        h.update(repr(obj.offset).encode('utf-8'))
+        _file_stat(filename, h)
+    elif isinstance(obj, np.ndarray):
+        h.update(np.ascontiguousarray(obj).view(np.uint8))
+    elif shape and shape[0]:
+        _sample_rows(obj, shape[0], h)
+    return h.hexdigest()[:16]
+
+
+#------------------------------------------------------------------------------
+# Memcache store
+#------------------------------------------------------------------------------
+
+def _replace(src, dst):
+    """Atomically replace a file."""
+    try:
+        os.replace(src, dst)
+    except AttributeError:  # pragma: no cover
+        # Python 2: rename() is atomic on POSIX.
+        os.rename(src, dst)
+
+
+class MemcacheStore(object):
+    """Persistent append-only store of the results of a memcached function.
+
+    Every value is saved in its own file within the store directory: arrays
+    as `.npy` files that are memory-mapped when loaded, other values as
+    pickles. The index file has one line `key filename` per entry. Values
+    are loaded on first access.
+
+    New values are written in batches, when `batch_size` values or
+    `max_pending_bytes` bytes are pending, or when `flush()` is called.
+
+    Several processes can share a store: the value files are written to
+    a temporary file and atomically renamed, and the index lines of a batch
+    are appended with a single write. The index is read again when a key is
+    missing.
+
+    """
+    def __init__(self, path, batch_size=32, max_pending_bytes=2 ** 26):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_pending_bytes = max_pending_bytes
+        _ensure_dir_exists(path)
+        self._index_path = op.join(path, 'index.txt')
+        # {key: filename}
+        self._files = {}
+        # {key: value} values not written yet.
+        self._pending = {}
+        self._pending_bytes = 0
+        # Position in the index file up to which it has been read, and
+        # inode of this file.
+        self._offset = 0
+        self._inode = None
+        self._lock = Lock()
+        self._read_index()
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self._lock = Lock()
+
+    def _read_index(self):
+        """Read the new complete lines of the index file."""
+        if not op.exists(self._index_path):
+            return
+        with self._lock:
+            with open(self._index_path, 'rb') as f:
+                # The store has been cleared by another instance.
+                st = os.fstat(f.fileno())
+                if st.st_ino != self._inode or st.st_size < self._offset:
+                    self._files = {}
+                    self._offset = 0
+                    self._inode = st.st_ino
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].decode('utf-8').splitlines():
+                key, _, filename = line.partition(' ')
+                if key and filename:
+                    self._files[key] = filename
+            self._offset += end
+
+    def keys(self):
+        """List of keys in the store."""
+        self._read_index()
+        with self._lock:
+            return list(set(self._files) | set(self._pending))
+
+    def __contains__(self, key):
+        if key not in self._files and key not in self._pending:
+            self._read_index()
+        return key in self._files or key in self._pending
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        """Load a value from disk."""
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+        if key not in self:
+            return default
+        path = op.join(self.path, self._files[key])
+        try:
+            if path.endswith('.npy'):
+                # NOTE: copy-on-write, the file is never modified.
+                return np.load(path, mmap_mode='c')
+            with open(path, 'rb') as f:
+                return load(f)
+        except (IOError, OSError, ValueError, EOFError) as e:
+            # The store may have been cleared by another instance.
+            self._read_index()
+            if key in self._files:
+                logger.warn("Unable to load `%s`: %s.", path, str(e))
+            return default
+
+    def set(self, key, value):
+        """Add a value to the store. It is written with the next batch."""
+        with self._lock:
+            if key not in self._pending:
+                self._pending_bytes += _nbytes(value)
+            self._pending[key] = value
+            full = (len(self._pending) >= self.batch_size or
+                    self._pending_bytes >= self.max_pending_bytes)
+        if full:
+            self.flush()
+
+    def _write(self, key, value):
+        """Write a value file and return its name."""
+        # NOTE: empty arrays cannot be memory-mapped.
+        is_array = (isinstance(value, np.ndarray) and
+                    value.dtype != np.object and value.size)
+        filename = str(key) + ('.npy' if is_array else '.pkl')
+        path = op.join(self.path, filename)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), current_thread().ident)
+        with open(tmp, 'wb') as f:
+            if is_array:
+                np.save(f, np.asarray(value))
+            else:
+                dump(value, f, protocol=2)
+        _replace(tmp, path)
+        return filename
+
+    def flush(self):
+        """Write the pending values to disk and append them to the index."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pending_bytes = 0
+            if not pending:
+                return
+            files = {key: self._write(key, value)
+                     for key, value in pending.items()}
+            lines = ''.join('{} {}\n'.format(key, filename)
+                            for key, filename in files.items())
+            with open(self._index_path, 'ab') as f:
+                f.write(lines.encode('utf-8'))
+            self._files.update(files)
+
+    def clear(self):
+        """Remove all values of the store."""
+        self._read_index()
+        with self._lock:
+            self._pending = {}
+            self._pending_bytes = 0
+            # Empty the index first, so that no reader sees a removed file.
+            tmp = '{}.{}.{}.tmp'.format(self._index_path, os.getpid(),
+                                        current_thread().ident)
+            open(tmp, 'wb').close()
+            _replace(tmp, self._index_path)
+            for filename in set(self._files.values()):
+                try:
+                    os.remove(op.join(self.path, filename))
+                except OSError:
+                    pass
+            self._files = {}
+            self._offset = 0
+            self._inode = None
+
+
+#------------------------------------------------------------------------------
+# Cache statistics
+#------------------------------------------------------------------------------
+
+def _format_bytes(n):
+    for unit in ('B', 'KB', 'MB'):
+        if n < 1024:
+            return '%d %s' % (n, unit)
+        n /= 1024.
+    return '%.1f GB' % n
+
+
+def _format_cache_stats(stats):
+    """Format the statistics of the cached functions as a table, the most
+    expensive functions first."""
+    header = ('function', 'kind', 'hits', 'store', 'misses', 'time',
+              'stored', 'memory', 'evictions')
+    rows = [header]
+    for name, s in sorted(stats.items(),
+                          key=lambda item: -item[1].compute_time):
+        rows.append((name, s.kind, str(s.hits), str(s.store_hits),
+                     str(s.misses), '%.3f s' % s.compute_time,
+                     _format_bytes(s.bytes_stored),
+                     _format_bytes(s.nbytes), str(s.evictions)))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = ['  '.join([row[0].ljust(widths[0])] +
+                       [value.rjust(width)
+                        for value, width in zip(row[1:], widths[1:])])
+             for row in rows]
+    return '\n'.join(lines)
+
+
+#------------------------------------------------------------------------------
+# Parallel map
+#------------------------------------------------------------------------------
+
+def _map_chunk(f, items):
+    return [f(item) for item in items]
+
+
+def _map_pickled(f_pickled, items):
+    return _map_chunk(loads(f_pickled), items)
+
+
+def _pickle_function(f):
+    """Pickle a function to send it to processes, or raise a ValueError."""
+    try:
+        return dumps(f, -1)
+    except (PicklingError, TypeError, AttributeError) as e:
+        raise ValueError("The function {} cannot be pickled, use the "
+                         "`thread` backend instead: {}.".format(f, e))
+
+
+def _map(f, items, backend='thread', n_workers=None, chunksize=1,
+         ordered=True, progress=None):
+    """Yield `(index, f(item))` for all items, computed by a pool of
+    threads or processes."""
+    chunksize = max(1, int(chunksize or 1))
+    chunks = [(i, items[i:i + chunksize])
+              for i in range(0, len(items), chunksize)]
+    executor = _executor(n_workers, backend=backend) if len(chunks) > 1 \
+        else None
+
+    def _computed(out):
+        if progress is not None:
+            for _ in out:
+                progress.increment()
+        return out
+
+    if executor is None:
+        for i, chunk in chunks:
+            for j, res in enumerate(_computed(_map_chunk(f, chunk))):
+                yield i + j, res
+        return
+
+    # NOTE: with processes, the function is pickled once, and not with
+    # every chunk.
+    call = _map_chunk
+    if backend == 'process':
+        try:
+            f, call = _pickle_function(f), _map_pickled
+        except ValueError:
+            executor.shutdown()
+            raise
+
+    from concurrent.futures import as_completed
+    with executor:
+        futures = {executor.submit(call, f, chunk): i
+                   for i, chunk in chunks}
+        # The progress is reported as soon as a chunk is computed, even
+        # if the results are yielded in order.
+        results = {}
+        next_index = 0
+        for future in as_completed(futures):
+            i = futures[future]
+            results[i] = _computed(future.result())
+            if not ordered:
+                for j, res in enumerate(results.pop(i)):
+                    yield i + j, res
+                continue
+            while next_index in results:
+                for j, res in enumerate(results.pop(next_index)):
+                    yield next_index + j, res
+                next_index += chunksize
+
+
 #------------------------------------------------------------------------------
 # Context
 #------------------------------------------------------------------------------
 
 class Context(object):
-    """Handle function cacheing and parallel map with ipyparallel."""
-    def __init__(self, cache_dir, ipy_view=None, verbose=0):
+    """Handle function cacheing and parallel map with local thread or
+    process pools.
+
+    The memcache has a byte budget per function and a global byte budget.
+    The least recently used items are evicted first. Set the budgets to
+    None to disable the eviction.
+
+    """
+
+    # Byte budget of all memcached functions together.
+    memcache_max_bytes = 2 ** 30
+    # Byte budget of every memcached function.
+    memcache_max_bytes_per_function = 2 ** 28
+
+    def __init__(self, cache_dir, ipy_view=None, verbose=0,
+                 memcache_max_bytes=_MISSING,
+                 memcache_max_bytes_per_function=_MISSING,
+                 ):
         self.verbose = verbose
+        if memcache_max_bytes is not _MISSING:
+            self.memcache_max_bytes = memcache_max_bytes
+        if memcache_max_bytes_per_function is not _MISSING:
+            self.memcache_max_bytes_per_function = \
+                memcache_max_bytes_per_function
         # Make sure the cache directory exists.
         self.cache_dir = op.realpath(op.expanduser(cache_dir))
         if not op.exists(self.cache_dir):
@@ -41,8 +477,23 @@ class Context(object):
             os.mkdir(path)
 
         self._set_memory(self.cache_dir)
-        self.ipy_view = ipy_view if ipy_view else None
+        if ipy_view:  # pragma: no cover
+            logger.warn("ipyparallel views are not supported anymore: "
+                        "use `Context.map()` instead.")
+        # Lock of the in-memory caches, which are shared among threads.
+        self._lock = Lock()
+        # {name: LRUCache}
         self._memcache = {}
+        # {name: MemcacheStore}
+        self._memcache_stores = {}
+        # {name: MemcacheStore} for the cached calls with memmaps.
+        self._memmap_stores = {}
+        # {name: {key: cluster_id}} for the functions of a single cluster.
+        self._memcache_clusters = {}
+        # {input_name: (obj, fingerprint)}
+        self._inputs = {}
+        # {name: Bunch} statistics of the cached functions.
+        self._stats = {}
 
     def _set_memory(self, cache_dir):
         # Try importing joblib.
@@ -59,58 +510,404 @@ class Context(object):
                         "Install it with `conda install joblib`.")
             self._memory = None
 
-    def cache(self, f):
-        """Cache a function using the context's cache directory."""
+    # Input fingerprints
+    # -------------------------------------------------------------------------
+
+    def set_input(self, name, obj):
+        """Register a dataset input (file path or array) that cached
+        functions may depend on, and compute its fingerprint."""
+        self._inputs[name] = (obj, _fingerprint(obj))
+
+    def update_input(self, name):
+        """Recompute the fingerprint of an input that has been modified in
+        a way that keeps the cached results valid.
+
+        The caches depending on this input are not invalidated at the next
+        session if the input is saved and loaded again.
+
+        """
+        obj, _ = self._inputs[name]
+        self.set_input(name, obj)
+        fp = self._inputs[name][1]
+        fingerprints = self.load('fingerprints')
+        for inputs in fingerprints.values():
+            if name in inputs:
+                inputs[name] = fp
+        self.save('fingerprints', fingerprints)
+
+    def _check_inputs(self, name, inputs):
+        """Return whether the cache of a function is still valid given the
+        fingerprints of its inputs, and save the current fingerprints."""
+        if not inputs:
+            return True
+        current = {input: self._inputs[input][1] for input in inputs}
+        fingerprints = self.load('fingerprints')
+        previous = fingerprints.get(name, None)
+        if previous == current:
+            return True
+        fingerprints[name] = current
+        self.save('fingerprints', fingerprints)
+        if previous is None:
+            return True
+        logger.debug("The inputs of `%s` have changed: clear its cache.",
+                     name)
+        return False
+
+    # Cache statistics
+    # -------------------------------------------------------------------------
+
+    def _init_stats(self, name, kind):
+        if name not in self._stats:
+            self._stats[name] = Bunch(kind=kind, hits=0, store_hits=0,
+                                      misses=0, compute_time=0.,
+                                      bytes_stored=0)
+
+    def _record(self, name, hits=0, store_hits=0, misses=0,
+                compute_time=0., bytes_stored=0):
+        with self._lock:
+            s = self._stats[name]
+            s.hits += hits
+            s.store_hits += store_hits
+            s.misses += misses
+            s.compute_time += compute_time
+            s.bytes_stored += bytes_stored
+
+    def _compute(self, name, f, args, kwargs):
+        """Call a cached function on a cache miss, and record the time."""
+        t0 = default_timer()
+        out = f(*args, **kwargs)
+        self._record(name, misses=1, compute_time=default_timer() - t0,
+                     bytes_stored=_nbytes(out))
+        return out
+
+    def cache_stats(self):
+        """Return the statistics of all cached functions.
+
+        Returns
+        -------
+
+        stats : dict
+            A `{name: Bunch}` dictionary with the following fields:
+
+            * `kind`: `disk` for `cache()`, `memory` for `memcache()`
+            * `hits`: calls returned from the cache (the in-memory cache
+              with `memcache()`)
+            * `store_hits`: memcache values loaded from the persistent store
+            * `misses`: calls that have been computed
+            * `compute_time`: total time spent in the computed calls,
+              in seconds
+            * `bytes_stored`: total size of the computed values
+            * `nbytes`: current size of the in-memory cache
+            * `evictions`: number of values evicted from the in-memory cache
+
+        """
+        stats = {}
+        with self._lock:
+            for name, s in self._stats.items():
+                cache = self._memcache.get(name, None)
+                stats[name] = Bunch(s,
+                                    nbytes=cache.nbytes if cache else 0,
+                                    evictions=cache.evictions if cache else 0,
+                                    )
+        return stats
+
+    def reset_cache_stats(self):
+        """Reset the statistics of all cached functions."""
+        with self._lock:
+            for name, s in self._stats.items():
+                self._stats[name] = Bunch(kind=s.kind, hits=0, store_hits=0,
+                                          misses=0, compute_time=0.,
+                                          bytes_stored=0)
+            for cache in self._memcache.values():
+                cache.hits = cache.misses = cache.evictions = 0
+
+    def log_cache_stats(self):
+        """Log the statistics of all cached functions."""
+        stats = self.cache_stats()
+        if not stats:
+            logger.info("No cached function.")
+            return
+        logger.info("Cache statistics:\n%s", _format_cache_stats(stats))
+
+    # Cache
+    # -------------------------------------------------------------------------
+
+    def cache(self, f, inputs=None):
+        """Cache a function using the context's cache directory.
+
+        `inputs` is an optional list of input names registered with
+        `set_input()`. The cache is cleared when any of their fingerprints
+        changes.
+
+        """
         if self._memory is None:  # pragma: no cover
             logger.debug("Joblib is not installed: skipping cacheing.")
             return f
         assert f
+        # NOTE: joblib calls this function on a cache miss only. It has the
+        # same name, code and signature as `f`, so that joblib hashes the
+        # same arguments and uses the same cache directory.
+        miss = local()
+
+        @wraps(f)
+        def computed(*args, **kwargs):
+            miss.value = True
+            return f(*args, **kwargs)
+        # NOTE: on Python 2, joblib reads the arguments of the function with
+        # getargspec(), which does not see through the wrapper: `f` is
+        # cached directly, and the hits and misses are not recorded.
+        detect_misses = hasattr(inspect, 'signature')
+        if detect_misses:
+            computed.__signature__ = inspect.signature(f)
+            arg_names = computed.__signature__.parameters
+        else:
+            computed = f
+            arg_names = inspect.getargspec(f).args
+
         # NOTE: discard self in instance methods.
-        if 'self' in inspect.getargspec(f).args:  # noqa
+        if 'self' in arg_names:
             ignore = ['self']
         else:
             ignore = None
-        disk_cached = self._memory.cache(f, ignore=ignore)
-        return disk_cached
+        disk_cached = self._memory.cache(computed, ignore=ignore)
+        # NOTE: joblib hashes the full contents of memmap arguments, so the
+        # calls with memmaps are cached in a store with a cheap key instead.
+        name = _fullname(f)
+        store = MemcacheStore(op.join(self.cache_dir, 'memmap', name))
+        self._memmap_stores[name] = store
+        if not self._check_inputs(name, inputs):
+            disk_cached.clear(warn=False)
+            store.clear()
+        self._init_stats(name, 'disk')
+
+        @wraps(f)
+        def cached(*args, **kwargs):
+            if not _has_memmap(args, kwargs):
+                miss.value = False
+                t0 = default_timer()
+                out = disk_cached(*args, **kwargs)
+                if miss.value:
+                    self._record(name, misses=1,
+                                 compute_time=default_timer() - t0,
+                                 bytes_stored=_nbytes(out))
+                elif detect_misses:
+                    self._record(name, hits=1)
+                return out
+            h = _hash_args(args, kwargs)
+            out = store.get(h, _MISSING)
+            if out is _MISSING:
+                out = self._compute(name, f, args, kwargs)
+                store.set(h, out)
+            else:
+                self._record(name, hits=1)
+            return out
+        return cached
 
-    def load_memcache(self, name):
-        # Load the memcache from disk, if it exists.
+    def load_memcache(self, name, max_bytes=_MISSING):
+        """Create the in-memory cache of a memcached function, and open its
+        persistent store. The values are loaded lazily from the store."""
+        if max_bytes is _MISSING:
+            max_bytes = self.memcache_max_bytes_per_function
+        cache = LRUCache(max_bytes=max_bytes)
+        store = MemcacheStore(op.join(self.cache_dir, 'memcache', name))
+        self._init_stats(name, 'memory')
+        # Import the memcache pickle saved by older versions.
         path = op.join(self.cache_dir, 'memcache', name + '.pkl')
         if op.exists(path):
-            logger.debug("Load memcache for `%s`.", name)
+            logger.debug("Import memcache for `%s`.", name)
             with open(path, 'rb') as fd:
-                cache = load(fd)
-        else:
-            cache = {}
+                for key, value in load(fd).items():
+                    if key not in store:
+                        store.set(key, value)
+            store.flush()
+            os.remove(path)
         self._memcache[name] = cache
+        self._memcache_stores[name] = store
+        self._memcache_clusters[name] = {}
         return cache
 
     def save_memcache(self):
+        """Make sure that all memcached values are saved on disk.
+
+        The values are normally saved in batches after they are computed.
+
+        """
         for name, cache in self._memcache.items():
-            path = op.join(self.cache_dir, 'memcache', name + '.pkl')
-            logger.debug("Save memcache for `%s`.", name)
-            with open(path, 'wb') as fd:
-                dump(cache, fd)
+            store = self._memcache_stores[name]
+            for key, value in cache.items():
+                if key not in store:
+                    store.set(key, value)
+        for store in (list(self._memcache_stores.values()) +
+                      list(self._memmap_stores.values())):
+            store.flush()
 
-    def memcache(self, f):
-        from joblib import hash
+    @property
+    def memcache_nbytes(self):
+        """Total size in bytes of the memcache."""
+        return sum(cache.nbytes for cache in self._memcache.values())
+
+    def _evict_memcache(self, keep=None):
+        """Evict items of the largest memcaches until the global byte budget
+        is met. The most recent item of `keep` is always kept."""
+        if self.memcache_max_bytes is None:
+            return
+        while self.memcache_nbytes > self.memcache_max_bytes:
+            caches = [cache for cache in self._memcache.values()
+                      if len(cache) > (1 if cache is keep else 0)]
+            if not caches:
+                break
+            max(caches, key=lambda cache: cache.nbytes).evict()
+
+    def demote_clusters(self, cluster_ids):
+        """Make the memcache entries of some clusters the first to be
+        evicted.
+
+        This is typically called with the clusters deleted by a clustering
+        action. The entries are not removed because an undo may bring
+        these clusters back.
+
+        """
+        cluster_ids = set(int(c) for c in cluster_ids)
+        if not cluster_ids:
+            return
+        for name, cache in self._memcache.items():
+            clusters = self._memcache_clusters.get(name, {})
+            # Forget the evicted entries.
+            for key in [key for key in clusters if key not in cache]:
+                del clusters[key]
+            cache.demote([key for key, cluster in clusters.items()
+                          if cluster in cluster_ids])
+
+    def memcache(self, f, max_bytes=_MISSING, inputs=None):
         name = _fullname(f)
-        cache = self.load_memcache(name)
+        valid = self._check_inputs(name, inputs)
+        self.load_memcache(name, max_bytes=max_bytes)
+        if not valid:
+            self._memcache_stores[name].clear()
 
         @wraps(f)
         def memcached(*args, **kwargs):
             """Cache the function in memory."""
-            h = hash((args, kwargs))
-            if h in cache:
-                # logger.debug("Get %s(%s) from memcache.", name, str(args))
-                return cache[h]
-            else:
+            h = _hash_args(args, kwargs)
+            cluster_id = _cluster_arg(args, kwargs)
+            out = self._memcache_get(name, h, cluster_id=cluster_id)
+            if out is _MISSING:
                 # logger.debug("Compute %s(%s).", name, str(args))
-                out = f(*args, **kwargs)
-                cache[h] = out
-                return out
+                out = self._compute(name, f, args, kwargs)
+                self._memcache_set(name, h, out, cluster_id=cluster_id)
+            return out
+        # Used by `Context.map()`.
+        memcached._memcache_name = name
+        memcached.__wrapped__ = f
         return memcached
 
+    def _memcache_get(self, name, h, cluster_id=None):
+        """Get a value from the in-memory cache, or from the store."""
+        with self._lock:
+            out = self._memcache[name].get(h, _MISSING)
+        if out is not _MISSING:
+            self._record(name, hits=1)
+            return out
+        out = self._memcache_stores[name].get(h, _MISSING)
+        if out is not _MISSING:
+            self._record(name, store_hits=1)
+            self._memcache_set(name, h, out, cluster_id=cluster_id,
+                               save=False)
+        return out
+
+    def _memcache_set(self, name, h, out, cluster_id=None, save=True):
+        """Save a value in the store and in the in-memory cache."""
+        if save:
+            self._memcache_stores[name].set(h, out)
+        with self._lock:
+            cache = self._memcache[name]
+            cache.set(h, out)
+            if cluster_id is not None:
+                self._memcache_clusters[name][h] = cluster_id
+            self._evict_memcache(keep=cache)
+
+    # Parallel map
+    # -------------------------------------------------------------------------
+
+    def map(self, f, iterable, backend='thread', n_workers=None,
+            chunksize=1, ordered=True, progress=None):
+        """Apply a function to all items of an iterable with a local pool of
+        threads or processes.
+
+        Parameters
+        ----------
+
+        f : function
+            A function with a single argument. With processes, it must be
+            picklable: a module-level function, or a method of a picklable
+            instance. Methods of objects holding Qt objects or large
+            arrays, like the GUI controller, must use threads.
+        iterable : iterable
+            The arguments.
+        backend : str
+            `thread` or `process`.
+        n_workers : int
+            Number of workers, the number of CPUs by default. The map is
+            serial with a single worker.
+        chunksize : int
+            Number of items sent to a worker at once.
+        ordered : bool
+            Whether the results are in the order of the arguments, or in
+            the order in which they have been computed.
+        progress : ProgressReporter instance
+            Incremented after every computed item.
+
+        Returns
+        -------
+
+        results : list
+
+        Notes
+        -----
+
+        With processes, the results of a memcached function are cached in
+        this process: cached items are not sent to the workers, and the
+        computed results are added to the memcache.
+
+        """
+        items = list(iterable)
+        if progress is not None:
+            progress.reset(len(items))
+        name = getattr(f, '_memcache_name', None)
+        if backend != 'process' or name not in self._memcache:
+            return [out for _, out in
+                    _map(f, items, backend=backend, n_workers=n_workers,
+                         chunksize=chunksize, ordered=ordered,
+                         progress=progress)]
+
+        # Only send the missing items to the workers.
+        keys = [_hash_args((item,), {}) for item in items]
+        done = []
+        missing = []
+        for i, (item, h) in enumerate(zip(items, keys)):
+            out = self._memcache_get(name, h,
+                                     cluster_id=_cluster_arg((item,), {}))
+            if out is _MISSING:
+                missing.append(i)
+            else:
+                done.append((i, out))
+                if progress is not None:
+                    progress.increment()
+        computed = _map(f.__wrapped__, [items[i] for i in missing],
+                        backend=backend, n_workers=n_workers,
+                        chunksize=chunksize, ordered=ordered,
+                        progress=progress)
+        for j, out in computed:
+            i = missing[j]
+            # NOTE: the computation time in the workers is not recorded.
+            self._record(name, misses=1, bytes_stored=_nbytes(out))
+            self._memcache_set(name, keys[i], out,
+                               cluster_id=_cluster_arg((items[i],), {}))
+            done.append((i, out))
+        if ordered:
+            done = sorted(done, key=lambda x: x[0])
+        return [out for _, out in done]
+
     def _get_path(self, name, location):
         if location == 'local':
             return op.join(self.cache_dir, name + '.json')
@@ -136,10 +933,19 @@ class Context(object):
         """Make sure that this class is picklable."""
         state = self.__dict__.copy()
         state['_memory'] = None
+        del state['_lock']
+        # NOTE: only keep the fingerprints of the inputs.
+        state['_inputs'] = {name: (None, fp)
+                            for name, (_, fp) in self._inputs.items()}
+        # NOTE: the in-memory caches are not copied, the values are loaded
+        # from the stores.
+        state['_memcache'] = {name: LRUCache(max_bytes=cache.max_bytes)
+                              for name, cache in self._memcache.items()}
         return state
 
     def __setstate__(self, state):
         """Make sure that this class is picklable."""
         self.__dict__ = state
+        self._lock = Lock()
         # Recreate the joblib Memory instance.
         self._set_memory(state['cache_dir'])
@@ -15,6 +15,7 @@ from ..array import (_unique,
                      _normalize,
                      _index_of,
                      _in_polygon,
+                     _spikes_in_polygon,
                      _spikes_in_clusters,
                      _spikes_per_cluster,
                      _flatten_per_cluster,
@@ -22,17 +23,27 @@ from ..array import (_unique,
                      select_spikes,
                      Selector,
                      chunk_bounds,
+                     map_chunks,
+                     _apply_chunk,
                      regular_subset,
                      excerpts,
                      data_chunk,
                      grouped_mean,
+                     grouped_reduce,
                      get_excerpts,
+                     excerpt_bounds,
+                     _excerpt_index,
                      _concatenate_virtual_arrays,
+                     LRUCache,
+                     CachedArray,
                      _range_from_slice,
                      _pad,
                      _get_padded,
                      read_array,
                      write_array,
+                     NpyWriter,
+                     ArrayBuilder,
+                     _repeat_into,
                      )
 from phy.utils._types import _as_array
 from phy.utils.testing import _assert_equal as ae
@@ -145,6 +156,12 @@ def test_unique():
     ae(_unique(spike_clusters), np.arange(n_clusters))
 
 
+def test_unique_sparse():
+    x = np.array([2 ** 31 + 5, 3, -1, 10 ** 6, 3, 2 ** 31 + 5])
+    ae(_unique(x), [3, 10 ** 6, 2 ** 31 + 5])
+    ae(_unique([-1, -1]), [])
+
+
 def test_normalize():
     """Test _normalize() function."""
 
@@ -181,6 +198,18 @@ def test_index_of():
     ae(_index_of(arr, lookup), [1, 2, 2, 1, 1, 0, 2])
 
 
+def test_index_of_sparse():
+    arr = [10 ** 6, 42, -1, 2 ** 31 + 5, 10 ** 6]
+    # Unsorted lookup table.
+    lookup = [42, 2 ** 31 + 5, 10 ** 6]
+    ae(_index_of(arr, lookup), [2, 0, -1, 1, 2])
+
+    # Same result as the dense version.
+    arr = np.random.randint(size=100, low=0, high=3000)
+    lookup = _unique(arr)
+    ae(_index_of(arr, lookup), np.searchsorted(lookup, arr))
+
+
 def test_as_array():
     ae(_as_array(3), [3])
     ae(_as_array([3]), [3])
@@ -201,6 +230,29 @@ def test_in_polygon():
     idx = np.nonzero(_in_polygon(points, polygon))[0]
     ae(idx, idx_expected)
 
+    # Points on the boundary.
+    polygon = [[-1, 1], [1, -1], [1, 1]]
+    points = [[-1, -1], [+1, -1], [+1, +1], [-1, +1]]
+    ae(_in_polygon(points, polygon), [False, False, True, True])
+
+    # Degenerate polygon.
+    ae(_in_polygon(points, polygon[:2]), [False] * 4)
+
+
+def test_spikes_in_polygon():
+    n = 1000
+    pos = np.random.uniform(size=(n, 2), low=-1, high=1)
+    polygon = [[0, 0], [1, 0], [1, 1], [0, 1]]
+    spike_ids = np.arange(0, n, 2)
+
+    def get_pos(ids):
+        assert len(ids) <= 100
+        return pos[ids, 0], pos[ids, 1]
+
+    out = _spikes_in_polygon(spike_ids, get_pos, polygon, chunk_size=100)
+    ae(out, spike_ids[_in_polygon(pos[spike_ids], polygon)])
+    assert len(_spikes_in_polygon([], get_pos, polygon)) == 0
+
 
 #------------------------------------------------------------------------------
 # Test read/save
@@ -215,6 +267,56 @@ def test_read_write(tempdir):
     ae(read_array(path), arr)
     ae(read_array(path, mmap_mode='r'), arr)
 
+    with raises(NotImplementedError):
+        read_array(op.join(tempdir, 'test.xyz'))
+
+
+def test_read_write_raw(tempdir):
+    arr = np.random.randint(size=(100, 3), low=-100, high=100).astype(np.int16)
+    path = op.join(tempdir, 'test.dat')
+    write_array(path, arr)
+
+    with raises(ValueError):
+        read_array(path)
+    traces = read_array(path, dtype=np.int16, n_channels=3)
+    assert isinstance(traces, np.memmap)
+    assert traces.shape == (100, 3)
+    ae(traces[10:20, 1], arr[10:20, 1])
+
+    # Header to skip.
+    with open(path, 'wb') as f:
+        f.write(b'\0' * 12)
+        f.write(arr.tobytes())
+    traces = read_array(path, dtype=np.int16, n_channels=3, offset=12)
+    ae(traces[::7], arr[::7])
+
+    # Channel count not compatible with the file size.
+    assert read_array(path, dtype=np.int16, n_channels=1000).shape == (0, 1000)
+
+
+def test_npy_writer(tempdir):
+    path = op.join(tempdir, 'test.npy')
+    chunks = [np.random.rand(n, 2, 3) for n in (10, 0, 7, 1)]
+    with NpyWriter(path) as w:
+        for chunk in chunks:
+            w.append(chunk)
+        with raises(ValueError):
+            w.append(np.zeros((2, 3, 2)))
+    ae(read_array(path), np.concatenate(chunks, axis=0))
+    ae(read_array(path, mmap_mode='r')[5:12], np.concatenate(chunks)[5:12])
+
+    # Explicit dtype.
+    with NpyWriter(path, dtype=np.int16) as w:
+        w.append(np.arange(5))
+        w.append([5, 6])
+    arr = read_array(path)
+    assert arr.dtype == np.int16
+    ae(arr, np.arange(7))
+
+    # Empty array.
+    NpyWriter(path, dtype=np.float32, shape=(4,)).close()
+    assert read_array(path).shape == (0, 4)
+
 
 #------------------------------------------------------------------------------
 # Test virtual concatenation
@@ -248,6 +350,134 @@ def test_concatenate_virtual_arrays_2():
     ae(c[0:4, 0], [0, 0, 1, 1])
 
 
+def test_concatenate_virtual_arrays_fancy():
+    arrs = [np.random.rand(5, 3), np.random.rand(2, 3), np.random.rand(1, 3),
+            np.random.rand(4, 3)]
+    full = np.concatenate(arrs, axis=0)
+    c = _concatenate_virtual_arrays(arrs)
+    assert c.shape == (12, 3)
+
+    # Integers.
+    ae(c[-1], full[-1:])
+    with raises(IndexError):
+        c[12]
+
+    # Step slices.
+    for item in (slice(None, None, 2), slice(1, 11, 3), slice(6, 7, 5),
+                 slice(None, None, -1), slice(10, 2, -3), slice(3, 3)):
+        ae(c[item], full[item])
+    ae(c[::2, 1], full[::2, 1])
+
+    # Arrays of indices, not sorted, with repetitions and negative indices.
+    indices = [11, 0, 7, 3, 3, -2, 5]
+    ae(c[indices], full[indices])
+    ae(c[np.array(indices), 1:], full[indices, 1:])
+    assert c[[]].shape == (0, 3)
+    with raises(IndexError):
+        c[[0, 12]]
+
+    # Boolean masks.
+    mask = np.random.rand(12) < .5
+    ae(c[mask], full[mask])
+    with raises(IndexError):
+        c[mask[:-1]]
+
+    # Column selection.
+    c = _concatenate_virtual_arrays(arrs, cols=[2, 0])
+    assert c.shape == (12, 2)
+    ae(c[[1, 9, 6]], full[[1, 9, 6]][:, [2, 0]])
+    ae(c[2:10:3], full[2:10:3][:, [2, 0]])
+
+
+#------------------------------------------------------------------------------
+# Test block cache
+#------------------------------------------------------------------------------
+
+def test_lru_cache():
+    cache = LRUCache(max_bytes=100)
+    cache.set('a', np.zeros(5))  # 40 bytes
+    cache.set('b', np.zeros(5))
+    assert cache.nbytes == 80
+    assert cache.get('a') is not None
+    assert (cache.hits, cache.misses) == (1, 0)
+
+    # 'b' is the least recently used.
+    cache.set('c', np.zeros(5))
+    assert cache.keys() == ['a', 'c']
+    assert cache.nbytes == 80
+    assert cache.evictions == 1
+    assert cache.get('b') is None
+    assert cache.misses == 1
+
+    # Values larger than the budget are kept until the next insertion.
+    cache.set('d', np.zeros(20))
+    assert cache.keys() == ['d']
+
+    assert cache.pop('d') is not None
+    assert cache.nbytes == 0
+    assert len(cache) == 0
+
+    # Demoted items are evicted first.
+    for key in 'abc':
+        cache.set(key, np.zeros(4))
+    cache.demote(['c', 'z'])
+    assert cache.keys() == ['c', 'a', 'b']
+    assert [key for key, _ in cache.items()] == ['c', 'a', 'b']
+    assert cache.evict() == 'c'
+    assert cache.nbytes == 64
+
+
+def test_cached_array():
+    arr = np.random.rand(103, 3)
+    c = CachedArray(arr, block_size=10, cache_size=10 * 3 * 8 * 4)
+    assert c.shape == arr.shape
+    assert len(c) == 103
+
+    ae(c[5], arr[5])
+    ae(c[-1, 1], arr[-1, 1])
+    ae(c[8:27], arr[8:27])
+    assert c.cache.misses == 4
+    ae(c[8:12, 1:], arr[8:12, 1:])
+    assert c.cache.misses == 4
+    assert c.cache.hits >= 2
+
+    ae(c[::7], arr[::7])
+    ae(c[3:95:40], arr[3:95:40])
+    ae(c[90:10:-4], arr[90:10:-4])
+    ae(c[[100, 3, 3, 57]], arr[[100, 3, 3, 57]])
+    ae(c[:0], arr[:0])
+    assert len(c.cache) <= 4
+
+    with raises(IndexError):
+        c[103]
+
+    # The cached blocks cannot be modified by the readers.
+    c = CachedArray(arr, block_size=10)
+    x = c[2:5]
+    x[...] = -1
+    c[12][:] = -1
+    ae(c[2:5], arr[2:5])
+    ae(c[12], arr[12])
+    assert c.cache.hits == 2
+
+    # Strided reads only load the blocks of the requested rows.
+    c = CachedArray(arr, block_size=10)
+    ae(c[5:100:40], arr[5:100:40])
+    assert c.cache.misses == 3
+
+
+def test_concatenate_virtual_arrays_cache():
+    arrs = [np.random.rand(25, 2), np.random.rand(12, 2)]
+    full = np.concatenate(arrs, axis=0)
+    c = _concatenate_virtual_arrays(arrs, cache_size=1000, block_size=8)
+    ae(c[3:30], full[3:30])
+    misses = c.cache.misses
+    ae(c[10:20], full[10:20])
+    assert c.cache.misses == misses
+    ae(c[[36, 0, 24]], full[[36, 0, 24]])
+    assert c.cache.nbytes <= 1000
+
+
 #------------------------------------------------------------------------------
 # Test chunking
 #------------------------------------------------------------------------------
@@ -286,6 +516,59 @@ def test_chunk():
     ae(d, data[90:170])
 
 
+def _smooth(x):
+    # Depends on the neighbors: the overlap matters.
+    return x + np.roll(x, 1, axis=0) + np.roll(x, -1, axis=0)
+
+
+def test_map_chunks():
+    data = np.random.rand(1000, 3)
+    # The edges are not relevant with np.roll().
+    expected = _smooth(data)[1:-1]
+
+    for n_workers in (0, 1, 4):
+        for chunk_size in (100, 333, 2000):
+            out = map_chunks(_smooth, data, chunk_size, overlap=10,
+                             n_workers=n_workers)
+            assert out.shape == data.shape
+            ae(out[1:-1], expected)
+
+    # Preallocated output.
+    out = np.zeros((1000, 3))
+    assert map_chunks(_smooth, data, 100, overlap=4, n_workers=2,
+                      out=out) is out
+    ae(out[1:-1], expected)
+
+    # Processes.
+    out = map_chunks(_smooth, data, 250, overlap=4, n_workers=2,
+                     backend='process')
+    ae(out[1:-1], expected)
+
+    # The function must preserve the first dimension.
+    with raises(ValueError):
+        map_chunks(lambda x: x[:-1], data, 100, n_workers=0)
+
+    # Empty data.
+    for n_workers in (0, 2):
+        out = map_chunks(lambda x: x[:, :2].astype(np.float32),
+                         np.zeros((0, 3)), 100, overlap=4,
+                         n_workers=n_workers)
+        assert out.shape == (0, 2)
+        assert out.dtype == np.float32
+    out = np.zeros((0, 3))
+    assert map_chunks(_smooth, np.zeros((0, 3)), 100, out=out) is out
+
+
+def test_apply_chunk():
+    data = np.arange(20)
+    bounds = (10, 20, 12, 18)
+    ae(_apply_chunk(lambda x: x * 2, data, bounds), data[12:18] * 2)
+    ae(_apply_chunk(lambda x: x * 2, data[10:20], bounds, is_chunk=True),
+       data[12:18] * 2)
+    # The whole data is sliced even if it has the size of a chunk.
+    ae(_apply_chunk(lambda x: x, data[:10], (0, 10, 2, 8)), data[2:8])
+
+
 def test_excerpts_1():
     bounds = [(start, end) for (start, end) in excerpts(100,
                                                         n_excerpts=3,
@@ -318,6 +601,22 @@ def test_get_excerpts():
     assert len(get_excerpts(data, n_excerpts=0, excerpt_size=10)) == 0
 
 
+def test_excerpt_bounds():
+    ae(excerpt_bounds(100, n_excerpts=3, excerpt_size=10),
+       [[0, 10], [45, 55], [90, 100]])
+    ae(excerpt_bounds(10, n_excerpts=3, excerpt_size=10), [[0, 10]])
+    ae(excerpt_bounds(100, n_excerpts=1, excerpt_size=10), [[0, 10]])
+    assert excerpt_bounds(100, n_excerpts=0, excerpt_size=10).shape == (0, 2)
+
+    # The index plan gives the same rows as get_excerpts().
+    data = np.random.rand(100, 2)
+    bounds = excerpt_bounds(len(data), n_excerpts=10, excerpt_size=5)
+    ae(data[_excerpt_index(bounds)],
+       get_excerpts(data, n_excerpts=10, excerpt_size=5))
+    ae(_excerpt_index(np.zeros((0, 2))), [])
+    ae(_excerpt_index([[2, 4], [4, 4], [7, 8]]), [2, 3, 7])
+
+
 def test_regular_subset():
     spikes = [2, 3, 5, 7, 11, 13, 17]
     ae(regular_subset(spikes), spikes)
@@ -379,6 +678,90 @@ def test_grouped_mean():
     ae(grouped_mean(arr, spike_clusters), [20, 30, 50])
 
 
+def test_grouped_reduce():
+    n_spikes = 1000
+    spike_clusters = artificial_spike_clusters(n_spikes, 10)
+    spike_clusters[::17] = -1
+    arr = np.random.rand(n_spikes, 3, 2)
+
+    for chunk_size in (None, 7, 100):
+        out = grouped_reduce(arr, spike_clusters, chunk_size=chunk_size)
+        ae(out.cluster_ids, _unique(spike_clusters))
+        for i, cluster in enumerate(out.cluster_ids):
+            x = arr[spike_clusters == cluster]
+            assert out.count[i] == len(x)
+            ae(out.sum[i], x.sum(axis=0))
+            ae(out.mean[i], x.mean(axis=0))
+            ae(out.var[i], x.var(axis=0))
+            ae(out.min[i], x.min(axis=0))
+            ae(out.max[i], x.max(axis=0))
+
+    # Explicit clusters, with an empty one.
+    out = grouped_reduce(arr[:, 0, 0], spike_clusters, ('count', 'mean'),
+                         cluster_ids=[5, 100, 2])
+    assert set(out) == {'cluster_ids', 'count', 'mean'}
+    ae(out.count, [np.sum(spike_clusters == 5), 0,
+                   np.sum(spike_clusters == 2)])
+    assert np.isnan(out.mean[1])
+    ae(out.mean[2], arr[spike_clusters == 2, 0, 0].mean())
+
+    # Only the rows of some spikes are read.
+    spike_ids = np.flatnonzero(np.in1d(spike_clusters, [2, 5]))
+
+    class _Rows(object):
+        def __init__(self, arr):
+            self.arr = arr
+            self.shape = arr.shape
+            self.read = []
+
+        def __getitem__(self, item):
+            rows = np.arange(len(self.arr))[item]
+            self.read.extend(rows.tolist())
+            return self.arr[item]
+
+    rows = _Rows(arr)
+    out = grouped_reduce(rows, spike_clusters, ('mean', 'quantiles'),
+                         cluster_ids=[5, 2], chunk_size=10,
+                         spike_ids=spike_ids)
+    ae(out.mean, [arr[spike_clusters == 5].mean(axis=0),
+                  arr[spike_clusters == 2].mean(axis=0)])
+    ae(out.quantiles[:, 1], [np.median(arr[spike_clusters == 5], axis=0),
+                             np.median(arr[spike_clusters == 2], axis=0)])
+    assert set(rows.read) == set(spike_ids)
+
+    with raises(ValueError):
+        grouped_reduce(arr, spike_clusters, 'unknown')
+
+
+def test_grouped_quantiles():
+    spike_clusters = np.repeat([3, 1, 7], [100, 51, 3])
+    arr = np.random.rand(len(spike_clusters), 2)
+
+    # Exact quantiles when there are fewer spikes than n_samples_quantiles.
+    out = grouped_reduce(arr, spike_clusters, 'quantiles',
+                         cluster_ids=[1, 3, 7, 8], quantiles=[0, .5, 1])
+    assert out.quantiles.shape == (4, 3, 2)
+    for i, cluster in enumerate([1, 3, 7]):
+        x = arr[spike_clusters == cluster]
+        ae(out.quantiles[i], np.percentile(x, [0, 50, 100], axis=0))
+    assert np.all(np.isnan(out.quantiles[3]))
+
+    # Approximate quantiles.
+    out = grouped_reduce(arr, spike_clusters, 'quantiles',
+                         quantiles=[.5], n_samples_quantiles=10)
+    ae(out.quantiles[:, 0, :].shape, (3, 2))
+    assert np.all(out.quantiles[:, 0, :] >= 0)
+
+    # Several dimensions, and one large cluster among small ones.
+    spike_clusters = np.r_[np.zeros(5000, dtype=np.int64), np.arange(1, 50)]
+    arr = np.random.rand(len(spike_clusters), 3, 2)
+    out = grouped_reduce(arr, spike_clusters, 'quantiles',
+                         quantiles=[.1, .5], n_samples_quantiles=10000)
+    assert out.quantiles.shape == (50, 2, 3, 2)
+    ae(out.quantiles[0], np.percentile(arr[:5000], [10, 50], axis=0))
+    ae(out.quantiles[7], np.repeat(arr[5006][np.newaxis], 2, axis=0))
+
+
 def test_select_spikes():
     with raises(AssertionError):
         select_spikes()
@@ -397,3 +780,60 @@ def test_select_spikes():
     assert sel.select_spikes() is None
     ae(sel.select_spikes([2, 5]), spc(2))
     ae(sel.select_spikes([2, 5], 2), [2])
+
+
+#------------------------------------------------------------------------------
+# Test array builder
+#------------------------------------------------------------------------------
+
+def test_repeat_into():
+    arr = np.arange(6).reshape((3, 2))
+
+    out = np.zeros((3, 2))
+    ae(_repeat_into(out, arr), arr)
+
+    # Uniform repeats: broadcasting.
+    out = np.zeros((6, 2))
+    ae(_repeat_into(out, arr, [2, 2, 2]), np.repeat(arr, 2, axis=0))
+
+    # Non-uniform repeats.
+    out = np.zeros((6, 2))
+    ae(_repeat_into(out, arr, [1, 0, 5]),
+       np.repeat(arr, [1, 0, 5], axis=0))
+
+    # Non-contiguous output.
+    out = np.zeros((6, 3))
+    _repeat_into(out[:, 2:], arr[:, :1], [2, 2, 2])
+    ae(out[:, 2], [0, 0, 2, 2, 4, 4])
+    ae(out[:, :2], 0)
+
+    # Empty arrays.
+    _repeat_into(np.zeros((0, 2)), np.zeros((0, 2)), [])
+
+
+def test_array_builder():
+    b = ArrayBuilder(7)
+
+    b.add('a', np.ones((2, 3)))
+    b.add('a', np.zeros((1, 3)), [5])
+    b.add_index('i', [3])
+    b.add_index('i', [2, 2])
+    b.next('p', 7, 2, dtype=np.float64)[:] = 1
+
+    assert b.names == {'a', 'i', 'p'}
+    assert 'a' in b
+    assert 'b' not in b
+
+    assert b['a'].dtype == np.float32
+    ae(b['a'], np.r_[np.ones((2, 3)), np.zeros((5, 3))])
+    ae(b['i'][:, 0], [0, 0, 0, 1, 1, 2, 2])
+    assert b['p'].dtype == np.float64
+
+    # Too many rows.
+    with raises(ValueError):
+        b.add('a', np.ones((1, 3)))
+
+    # Incomplete buffer.
+    b.add('c', np.ones(3))
+    with raises(ValueError):
+        b['c']
@@ -6,15 +6,20 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import os
 import os.path as op
+from threading import Lock
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
-from pytest import yield_fixture
+from pytest import raises, yield_fixture
 from six.moves import cPickle
 
+from phy.utils import Bunch, ProgressReporter
 from ..array import write_array, read_array
-from ..context import Context, _fullname
+from ..context import (Context, MemcacheStore, _fullname, _fingerprint,
+                       _hash_args, _fast_key,
+                       )
 
 
 #------------------------------------------------------------------------------
@@ -89,6 +94,52 @@ def test_context_cache(context):
     assert len(_res) == 2
 
 
+def test_hash_args(tempdir):
+    assert _hash_args((1,), {}) == _hash_args((np.int64(1),), {})
+    assert _hash_args((1,), {}) != _hash_args((1.,), {})
+    assert _hash_args((1,), {}) != _hash_args(((1,),), {})
+    assert _hash_args((), {'a': 1, 'b': 2}) == _hash_args((), {'b': 2, 'a': 1})
+    assert _hash_args((None,), {}) != _hash_args((False,), {})
+    assert _hash_args(('1',), {}) != _hash_args((1,), {})
+
+    # Arrays are hashed by joblib.
+    assert _fast_key(np.arange(3)) is None
+    assert _hash_args((np.arange(3),), {}) == _hash_args((np.arange(3),), {})
+    assert _hash_args((np.arange(3),), {}) != _hash_args((np.arange(4),), {})
+
+    # Memmaps are hashed from their metadata.
+    path = op.join(tempdir, 'arr.npy')
+    np.save(path, np.arange(10))
+    m = np.load(path, mmap_mode='r')
+    assert _fast_key(m)[0] == 'm'
+    m2 = np.load(path, mmap_mode='r')
+    assert _hash_args((m,), {}) == _hash_args((m2,), {})
+    # Views are not supported.
+    assert _fast_key(m[1:]) is None
+
+
+def test_context_cache_memmap(tempdir, context):
+    _res = []
+
+    def f(x):
+        _res.append(x)
+        return x.sum()
+
+    path = op.join(tempdir, 'arr.npy')
+    np.save(path, np.arange(10))
+    m = np.load(path, mmap_mode='r')
+
+    f = context.cache(f)
+    assert f(m) == 45
+    assert f(np.load(path, mmap_mode='r')) == 45
+    assert len(_res) == 1
+
+    # Other arguments still go through joblib.
+    assert f(np.arange(3)) == 3
+    assert f(np.arange(3)) == 3
+    assert len(_res) == 2
+
+
 def test_context_memcache(tempdir, context):
 
     _res = []
@@ -125,3 +176,470 @@ def test_pickle_cache(tempdir, context):
         ctx = cPickle.load(f)
     assert isinstance(ctx, Context)
     assert ctx.cache_dir == context.cache_dir
+
+
+def test_context_memcache_budget(tempdir):
+    context = Context(op.join(tempdir, 'cache'),
+                      memcache_max_bytes=300,
+                      memcache_max_bytes_per_function=200,
+                      )
+
+    @context.memcache
+    def f(x):
+        return np.zeros(x // 8)
+
+    @context.memcache
+    def g(x):
+        return np.zeros(x // 8)
+
+    name_f, name_g = _fullname(f), _fullname(g)
+    cache_f, cache_g = context._memcache[name_f], context._memcache[name_g]
+
+    # Per-function budget.
+    f(80)
+    f(96)
+    assert cache_f.nbytes == 176
+    f(88)
+    assert cache_f.nbytes == 184
+    assert len(cache_f) == 2
+    assert cache_f.evictions == 1
+
+    # Global budget: the largest cache is evicted first.
+    g(160)
+    assert context.memcache_nbytes <= 300
+    assert cache_f.nbytes == 88
+    assert cache_g.nbytes == 160
+
+    # The most recent item is always kept.
+    g(400)
+    assert len(cache_g) == 1
+    assert len(cache_f) == 0
+
+    # The evicted values are still on disk.
+    assert len(context._memcache_stores[name_f]) == 3
+    assert len(context._memcache_stores[name_g]) == 2
+
+
+def test_context_memcache_demote(tempdir):
+    context = Context(op.join(tempdir, 'cache'),
+                      memcache_max_bytes=None,
+                      memcache_max_bytes_per_function=400,
+                      )
+
+    _res = []
+
+    @context.memcache
+    def f(cluster_id):
+        _res.append(cluster_id)
+        return np.zeros(10)
+
+    for cluster_id in range(5):
+        f(cluster_id)
+    cache = context._memcache[_fullname(f)]
+    assert len(cache) == 5
+
+    # The deleted clusters are evicted first.
+    context.demote_clusters([3, 4])
+    f(5)
+    assert len(cache) == 5
+    clusters = context._memcache_clusters[_fullname(f)]
+    assert [clusters[key] for key in cache.keys()] == [4, 0, 1, 2, 5]
+
+    # The evicted values are loaded from disk.
+    f(3)
+    assert _res == [0, 1, 2, 3, 4, 5]
+
+
+#------------------------------------------------------------------------------
+# Test fingerprints
+#------------------------------------------------------------------------------
+
+def test_fingerprint(tempdir):
+    arr = np.random.rand(10000, 3)
+    fp = _fingerprint(arr)
+    assert _fingerprint(arr.copy()) == fp
+    assert _fingerprint(arr[:-1]) != fp
+    assert _fingerprint(arr.astype(np.float32)) != fp
+    arr[0, 0] += 1
+    assert _fingerprint(arr) != fp
+
+    # Any modified byte changes the fingerprint.
+    fp = _fingerprint(arr)
+    arr[5001, 1] += 1
+    assert _fingerprint(arr) != fp
+
+    assert _fingerprint(np.zeros((0, 3))) != _fingerprint(np.zeros((0, 2)))
+    assert _fingerprint(None) == _fingerprint(None)
+
+    # Lazy array-like objects without __len__: only a few rows are read.
+    class Lazy(object):
+        def __init__(self, arr):
+            self.arr = arr
+            self.shape = arr.shape
+            self.dtype = arr.dtype
+            self.n_read = 0
+
+        def __getitem__(self, item):
+            out = self.arr[item]
+            self.n_read += len(out)
+            return out
+
+    lazy = Lazy(arr)
+    fp = _fingerprint(lazy)
+    assert lazy.n_read <= 16
+    assert _fingerprint(Lazy(arr)) == fp
+    assert _fingerprint(Lazy(arr[::-1])) != fp
+
+    # Files.
+    path = op.join(tempdir, 'data.npy')
+    np.save(path, arr)
+    fp = _fingerprint(path)
+    assert _fingerprint(path) == fp
+    mm = np.load(path, mmap_mode='r+')
+    fp_mm = _fingerprint(mm)
+    assert fp_mm != _fingerprint(arr)
+
+    # Modify a single byte in the middle of the file.
+    st = os.stat(path)
+    mm[5001, 1] += 1
+    mm.flush()
+    del mm
+    os.utime(path, (st.st_atime, st.st_mtime + 1))
+    assert _fingerprint(path) != fp
+    assert _fingerprint(np.load(path, mmap_mode='r')) != fp_mm
+
+
+def test_context_inputs(tempdir):
+    _res = []
+    arr = np.arange(100)
+    other = np.arange(10)
+
+    def f(x):
+        _res.append(x)
+        return x ** 2
+
+    def g(x):
+        _res.append(x)
+        return x ** 3
+
+    def _wrap():
+        ctx = Context(op.join(tempdir, 'cache'))
+        ctx.set_input('arr', arr)
+        ctx.set_input('other', other)
+        return (ctx, ctx.cache(f, inputs=('arr',)),
+                ctx.memcache(g, inputs=('other',)))
+
+    ctx, fc, gc = _wrap()
+    fc(2)
+    gc(2)
+    assert _res == [2, 2]
+    ctx.save_memcache()
+
+    # Same inputs: the caches are used.
+    ctx, fc, gc = _wrap()
+    fc(2)
+    gc(2)
+    assert _res == [2, 2]
+
+    # Only the caches depending on modified inputs are cleared.
+    arr[0] = -1
+    ctx, fc, gc = _wrap()
+    fc(2)
+    gc(2)
+    assert _res == [2, 2, 2]
+    ctx.save_memcache()
+
+    # A modification that keeps the caches valid.
+    other[0] = -1
+    ctx.update_input('other')
+    ctx, fc, gc = _wrap()
+    gc(2)
+    assert _res == [2, 2, 2]
+
+
+#------------------------------------------------------------------------------
+# Test memcache store
+#------------------------------------------------------------------------------
+
+def test_memcache_store(tempdir):
+    path = op.join(tempdir, 'store')
+    store = MemcacheStore(path)
+    assert len(store) == 0
+    assert store.get('a') is None
+
+    store.set('a', np.arange(10))
+    store.set('b', [(1, 2.)])
+    store.set('c', np.zeros(0))
+    assert len(store) == 3
+    assert 'a' in store
+
+    # The values are written in batches.
+    assert len(MemcacheStore(path)) == 0
+    ae(store.get('a'), np.arange(10))
+    store.flush()
+    assert len(MemcacheStore(path)) == 3
+
+    # Arrays are memory-mapped, with copy-on-write.
+    a = store.get('a')
+    assert isinstance(a, np.memmap)
+    ae(a, np.arange(10))
+    a[0] = -1
+    ae(store.get('a'), np.arange(10))
+    assert store.get('b') == [(1, 2.)]
+    assert store.get('c').shape == (0,)
+
+    # Another store on the same directory sees the new values.
+    other = MemcacheStore(path)
+    assert sorted(other.keys()) == ['a', 'b', 'c']
+    other.set('d', 4)
+    other.flush()
+    assert store.get('d') == 4
+
+    # A batch is written when it is full.
+    other.batch_size = 2
+    other.set('e', 5)
+    other.set('f', 6)
+    assert store.get('f') == 6
+
+    # Incomplete index lines are skipped.
+    with open(op.join(path, 'index.txt'), 'ab') as f:
+        f.write(b'g g.p')
+    assert 'g' not in MemcacheStore(path)
+
+    # Only the files of the store are removed.
+    with open(op.join(path, 'other.txt'), 'w') as f:
+        f.write('other')
+    store.clear()
+    assert len(store) == 0
+    assert len(MemcacheStore(path)) == 0
+    assert sorted(os.listdir(path)) == ['index.txt', 'other.txt']
+
+    # Other instances see that the store has been cleared.
+    assert other.get('a') is None
+    assert 'a' not in other
+    store.set('a', 1)
+    store.flush()
+    assert other.get('a') == 1
+
+
+def test_context_memcache_shared(tempdir):
+    _res = []
+
+    def f(x):
+        _res.append(x)
+        return np.arange(x)
+
+    ctx0 = Context(op.join(tempdir, 'cache'))
+    ctx1 = Context(op.join(tempdir, 'cache'))
+    f0 = ctx0.memcache(f)
+    f1 = ctx1.memcache(f)
+
+    # The value computed in one context is used by the other one.
+    ae(f0(3), np.arange(3))
+    ctx0.save_memcache()
+    ae(f1(3), np.arange(3))
+    assert _res == [3]
+
+
+def test_context_cache_stats(tempdir, context):
+
+    def f(x):
+        return np.arange(x)
+
+    def g(x):
+        return x * 2
+
+    f = context.memcache(f)
+    g = context.cache(g)
+
+    f(3)
+    f(3)
+    f(4)
+    g(1)
+    g(1)
+
+    stats = context.cache_stats()
+    s = stats[_fullname(f)]
+    assert s.kind == 'memory'
+    assert (s.hits, s.store_hits, s.misses) == (1, 0, 2)
+    assert s.bytes_stored == s.nbytes == 7 * 8
+    assert s.compute_time >= 0
+    assert s.evictions == 0
+
+    s = stats[_fullname(g)]
+    assert s.kind == 'disk'
+    assert (s.hits, s.misses) == (1, 1)
+    assert s.bytes_stored == 8
+
+    # Values loaded from the persistent store.
+    context.save_memcache()
+    ctx = Context(op.join(tempdir, 'cache'))
+    f = ctx.memcache(f.__wrapped__)
+    f(3)
+    s = ctx.cache_stats()[_fullname(f)]
+    assert (s.hits, s.store_hits, s.misses) == (0, 1, 0)
+    ctx.log_cache_stats()
+
+    context.reset_cache_stats()
+    s = context.cache_stats()[_fullname(g)]
+    assert (s.hits, s.misses) == (0, 0)
+
+
+def test_context_cache_method(tempdir):
+    _res = []
+
+    class A(object):
+        def __init__(self, ctx):
+            self.f = ctx.cache(self.f)
+
+        def f(self, x, y=1):
+            _res.append(x)
+            return x + y
+
+    ctx = Context(op.join(tempdir, 'cache'))
+    a = A(ctx)
+    assert a.f(1) == 2
+    assert a.f(1, y=1) == 2
+    assert a.f(x=1) == 2
+    assert a.f(1, y=2) == 3
+    assert _res == [1, 1]
+    s = ctx.cache_stats()[_fullname(a.f)]
+    assert (s.hits, s.misses) == (2, 2)
+
+    # Another instance in another session shares the cache.
+    ctx = Context(op.join(tempdir, 'cache'))
+    assert A(ctx).f(1) == 2
+    assert _res == [1, 1]
+
+
+def test_context_cache_no_signature(tempdir, monkeypatch):
+    # Python 2: no inspect.signature().
+    import inspect
+    from .. import context
+    monkeypatch.setattr(context, 'inspect',
+                        Bunch(getargspec=inspect.getargspec))
+    _res = []
+
+    class A(object):
+        def __init__(self, ctx):
+            self.f = ctx.cache(self.f)
+
+        def f(self, x):
+            _res.append(x)
+            return x * x
+
+    ctx = Context(op.join(tempdir, 'cache'))
+    a = A(ctx)
+    assert a.f(3) == 9
+    assert a.f(3) == 9
+    assert _res == [3]
+    assert A(ctx).f(3) == 9
+    assert _res == [3]
+
+
+#------------------------------------------------------------------------------
+# Test parallel map
+#------------------------------------------------------------------------------
+
+def _square(x):
+    return x * x
+
+
+class _Power(object):
+    def __init__(self, arr, n):
+        self.arr = arr
+        self.n = n
+        self._lock = Lock()
+        self.n_pickled = 0
+
+    def __getstate__(self):
+        self.n_pickled += 1
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+    def power(self, i):
+        return self.arr[i] ** self.n
+
+
+def test_context_map(context):
+    items = list(range(20))
+    expected = [x * x for x in items]
+
+    # Serial.
+    assert context.map(_square, items, n_workers=1) == expected
+
+    # Threads.
+    assert context.map(_square, items, n_workers=4, chunksize=3) == expected
+    out = context.map(_square, items, n_workers=4, ordered=False)
+    assert sorted(out) == expected
+
+    # Processes.
+    assert context.map(_square, iter(items), backend='process',
+                       n_workers=2, chunksize=5) == expected
+
+    # Progress.
+    pr = ProgressReporter()
+    _values = []
+
+    @pr.connect
+    def on_progress(value, value_max):
+        _values.append((value, value_max))
+
+    context.map(_square, items, n_workers=2, chunksize=4, progress=pr)
+    assert len(_values) == 20
+    assert _values[-1] == (20, 20)
+
+    assert context.map(_square, []) == []
+
+
+def test_context_map_method(context):
+    p = _Power(np.arange(10), 3)
+    assert context.map(p.power, range(10), backend='process',
+                       n_workers=2, chunksize=3) == [i ** 3 for i in range(10)]
+    # The instance is pickled once, and not with every chunk.
+    assert p.n_pickled == 1
+
+    # Memcached method.
+    f = context.memcache(p.power)
+    assert f(2) == 8
+    assert context.map(f, range(4), backend='process',
+                       n_workers=2) == [0, 1, 8, 27]
+
+    # Methods of unpicklable instances must use threads.
+    class Unpicklable(object):
+        def __init__(self):
+            self._lock = Lock()
+
+        def square(self, x):
+            return x * x
+
+    u = Unpicklable()
+    with raises(ValueError):
+        context.map(u.square, range(4), backend='process', n_workers=2)
+    assert context.map(u.square, range(4), n_workers=2) == [0, 1, 4, 9]
+
+
+def test_context_map_memcache(tempdir, context):
+    f = context.memcache(_square)
+    name = _fullname(_square)
+    assert f(3) == 9
+
+    out = context.map(f, range(6), backend='process', n_workers=2)
+    assert out == [0, 1, 4, 9, 16, 25]
+    assert len(context._memcache[name]) == 6
+    assert len(context._memcache_stores[name]) == 6
+
+    # With threads, the memcached function is called in the workers.
+    out = context.map(f, range(8), n_workers=4, chunksize=2)
+    assert out == [x * x for x in range(8)]
+    assert len(context._memcache[name]) == 8
+
+    # The context is picklable without its in-memory caches.
+    ctx = cPickle.loads(cPickle.dumps(context))
+    assert len(ctx._memcache[name]) == 0
+    assert ctx._memcache_get(name, _hash_args((7,), {})) == 49
@@ -15,7 +15,7 @@ import logging
 
 import numpy as np
 
-from phy.io.array import _accumulate, _in_polygon
+from phy.io.array import ArrayBuilder, _accumulate, _in_polygon
 from phy.utils._types import _as_tuple
 from .base import BaseCanvas
 from .interact import Grid, Boxed, Stacked
@@ -185,18 +185,30 @@ class View(BaseCanvas):
 
         """
         for cls, data_list in self._items.items():
-            # Some variables are not concatenated. They are specified
-            # in `allow_list`.
-            data = _accumulate(data_list, cls.allow_list)
-            box_index = data.pop('box_index')
             visual = cls()
             self.add_visual(visual)
-            visual.set_data(**data)
+            if hasattr(cls, 'add_to_builder'):
+                # The items are written directly into preallocated vertex
+                # buffers which are passed to the visual.
+                n = sum(cls.vertex_count(**data) for data in data_list)
+                builder = ArrayBuilder(n)
+                for data in data_list:
+                    cls.add_to_builder(builder, data)
+                    builder.add('box_index', data['box_index'])
+                box_index = builder['box_index']
+                visual.set_builder_data(builder)
+            else:
+                # Some variables are not concatenated. They are specified
+                # in `allow_list`.
+                data = _accumulate(data_list, cls.allow_list)
+                box_index = data.pop('box_index')
+                visual.set_data(**data)
             # NOTE: visual.program.__contains__ is implemented in vispy master
             # so we can replace this with `if 'a_box_index' in visual.program`
             # after the next VisPy release.
             if 'a_box_index' in visual.program._code_variables:
-                visual.program['a_box_index'] = box_index.astype(np.float32)
+                visual.program['a_box_index'] = np.asarray(box_index,
+                                                           dtype=np.float32)
         # TODO: refactor this when there is the possibility to update existing
         # visuals without recreating the whole scene.
         if self.lasso:
@@ -23,6 +23,7 @@ from .utils import (_tesselate_histogram,
                     _get_pos,
                     _get_index,
                     )
+from phy.io.array import ArrayBuilder, _repeat_into
 from phy.utils import Bunch
 
 
@@ -111,17 +112,33 @@ class ScatterVisual(BaseVisual):
         return Bunch(pos=pos, color=color, size=size,
                      depth=depth, data_bounds=data_bounds)
 
+    @staticmethod
+    def add_to_builder(builder, data):
+        """Write the vertices of an item returned by validate()."""
+        n = len(data.pos)
+        builder.add('pos', data.pos, dtype=np.float64)
+        builder.next('a_position', n, 3)[:, 2:] = data.depth
+        builder.add('a_size', data.size)
+        builder.add('a_color', data.color)
+        if data.data_bounds is not None:
+            builder.add('data_bounds', data.data_bounds, dtype=np.float64)
+
+    def set_builder_data(self, builder):
+        pos = builder['pos']
+        if 'data_bounds' in builder:
+            self.data_range.from_bounds = builder['data_bounds']
+            pos = self.transforms.apply(pos)
+        position = builder['a_position']
+        position[:, :2] = pos
+        self.program['a_position'] = position
+        self.program['a_size'] = builder['a_size']
+        self.program['a_color'] = builder['a_color']
+
     def set_data(self, *args, **kwargs):
         data = self.validate(*args, **kwargs)
-        if data.data_bounds is not None:
-            self.data_range.from_bounds = data.data_bounds
-            pos_tr = self.transforms.apply(data.pos)
-        else:
-            pos_tr = data.pos
-        pos_tr = np.c_[pos_tr, data.depth]
-        self.program['a_position'] = pos_tr.astype(np.float32)
-        self.program['a_size'] = data.size.astype(np.float32)
-        self.program['a_color'] = data.color.astype(np.float32)
+        builder = ArrayBuilder(self.vertex_count(**data))
+        self.add_to_builder(builder, data)
+        self.set_builder_data(builder)
 
 
 class UniformScatterVisual(BaseVisual):
@@ -200,23 +217,35 @@ class UniformScatterVisual(BaseVisual):
                      data_bounds=data_bounds,
                      )
 
-    def set_data(self, *args, **kwargs):
-        data = self.validate(*args, **kwargs)
+    @staticmethod
+    def add_to_builder(builder, data):
+        """Write the vertices of an item returned by validate()."""
+        builder.add('pos', data.pos, dtype=np.float64)
+        builder.add('a_mask', data.masks)
         if data.data_bounds is not None:
-            self.data_range.from_bounds = data.data_bounds
-            pos_tr = self.transforms.apply(data.pos)
-        else:
-            pos_tr = data.pos
+            builder.add('data_bounds', data.data_bounds, dtype=np.float64)
 
-        masks = data.masks
+    def set_builder_data(self, builder):
+        pos = builder['pos']
+        if 'data_bounds' in builder:
+            self.data_range.from_bounds = builder['data_bounds']
+            pos = self.transforms.apply(pos)
 
-        self.program['a_position'] = pos_tr.astype(np.float32)
-        self.program['a_mask'] = masks.astype(np.float32)
+        masks = builder['a_mask']
+
+        self.program['a_position'] = pos.astype(np.float32)
+        self.program['a_mask'] = masks
 
         self.program['u_size'] = self.marker_size
         self.program['u_color'] = self.color
         self.program['u_mask_max'] = _max(masks)
 
+    def set_data(self, *args, **kwargs):
+        data = self.validate(*args, **kwargs)
+        builder = ArrayBuilder(self.vertex_count(**data))
+        self.add_to_builder(builder, data)
+        self.set_builder_data(builder)
+
 
 #------------------------------------------------------------------------------
 # Plot visuals
@@ -240,6 +269,18 @@ def _max(arr):
     return arr.max() if len(arr) else 1
 
 
+def _fill_pos(pos, x, y):
+    """Write lists of signals into the two columns of a position array."""
+    i = 0
+    for xs, ys in zip(x, y):
+        k = len(ys)
+        pos[i:i + k, 0] = xs
+        pos[i:i + k, 1] = ys
+        i += k
+    assert i == len(pos)
+    return pos
+
+
 class PlotVisual(BaseVisual):
     _default_color = DEFAULT_COLOR
     allow_list = ('x', 'y')
@@ -305,44 +346,45 @@ class PlotVisual(BaseVisual):
         """Take the output of validate() as input."""
         return y.size if isinstance(y, np.ndarray) else sum(len(_) for _ in y)
 
-    def set_data(self, *args, **kwargs):
-        data = self.validate(*args, **kwargs)
-
+    @staticmethod
+    def add_to_builder(builder, data):
+        """Write the vertices of an item returned by validate()."""
         assert isinstance(data.y, list)
-        n_signals = len(data.y)
         n_samples = [len(_) for _ in data.y]
         n = sum(n_samples)
-        x = np.concatenate(data.x) if len(data.x) else np.array([])
-        y = np.concatenate(data.y) if len(data.y) else np.array([])
 
         # Generate the position array.
-        pos = np.empty((n, 2), dtype=np.float64)
-        pos[:, 0] = x.ravel()
-        pos[:, 1] = y.ravel()
-        assert pos.shape == (n, 2)
-
-        # Generate the color attribute.
-        color = data.color
-        assert color.shape == (n_signals, 4)
-        color = np.repeat(color, n_samples, axis=0)
-        assert color.shape == (n, 4)
-
-        # Generate signal index.
-        signal_index = np.repeat(np.arange(n_signals), n_samples)
-        signal_index = _get_array(signal_index, (n, 1))
-        assert signal_index.shape == (n, 1)
+        pos = builder.next('pos', n, 2, dtype=np.float64)
+        _fill_pos(pos, data.x, data.y)
+
+        # Depth, color, and signal index are repeated for every sample.
+        _repeat_into(builder.next('a_position', n, 3)[:, 2:],
+                     data.depth, n_samples)
+        builder.add('a_color', data.color, n_samples)
+        builder.add_index('a_signal_index', n_samples)
+        if data.data_bounds is not None:
+            builder.add('data_bounds', data.data_bounds, n_samples,
+                        dtype=np.float64)
 
+    def set_builder_data(self, builder):
         # Transform the positions.
-        if data.data_bounds is not None:
-            data_bounds = np.repeat(data.data_bounds, n_samples, axis=0)
-            self.data_range.from_bounds = data_bounds
+        pos = builder['pos']
+        if 'data_bounds' in builder:
+            self.data_range.from_bounds = builder['data_bounds']
             pos = self.transforms.apply(pos)
 
         # Position and depth.
-        depth = np.repeat(data.depth, n_samples, axis=0)
-        self.program['a_position'] = np.c_[pos, depth].astype(np.float32)
-        self.program['a_color'] = color.astype(np.float32)
-        self.program['a_signal_index'] = signal_index.astype(np.float32)
+        position = builder['a_position']
+        position[:, :2] = pos
+        self.program['a_position'] = position
+        self.program['a_color'] = builder['a_color']
+        self.program['a_signal_index'] = builder['a_signal_index']
+
+    def set_data(self, *args, **kwargs):
+        data = self.validate(*args, **kwargs)
+        builder = ArrayBuilder(self.vertex_count(**data))
+        self.add_to_builder(builder, data)
+        self.set_builder_data(builder)
 
 
 class UniformPlotVisual(BaseVisual):
@@ -404,48 +446,46 @@ class UniformPlotVisual(BaseVisual):
         """Take the output of validate() as input."""
         return y.size if isinstance(y, np.ndarray) else sum(len(_) for _ in y)
 
-    def set_data(self, *args, **kwargs):
-        data = self.validate(*args, **kwargs)
-
+    @staticmethod
+    def add_to_builder(builder, data):
+        """Write the vertices of an item returned by validate()."""
         assert isinstance(data.y, list)
-        n_signals = len(data.y)
         n_samples = [len(_) for _ in data.y]
         n = sum(n_samples)
-        x = np.concatenate(data.x) if len(data.x) else np.array([])
-        y = np.concatenate(data.y) if len(data.y) else np.array([])
 
         # Generate the position array.
-        pos = np.empty((n, 2), dtype=np.float64)
-        pos[:, 0] = x.ravel()
-        pos[:, 1] = y.ravel()
-        assert pos.shape == (n, 2)
+        pos = builder.next('pos', n, 2, dtype=np.float64)
+        _fill_pos(pos, data.x, data.y)
 
-        # Generate signal index.
-        signal_index = np.repeat(np.arange(n_signals), n_samples)
-        signal_index = _get_array(signal_index, (n, 1))
-        assert signal_index.shape == (n, 1)
-
-        # Masks.
-        masks = np.repeat(data.masks, n_samples, axis=0)
+        # Masks and signal index are repeated for every sample.
+        builder.add('a_mask', data.masks, n_samples)
+        builder.add_index('a_signal_index', n_samples)
+        if data.data_bounds is not None:
+            builder.add('data_bounds', data.data_bounds, n_samples,
+                        dtype=np.float64)
 
+    def set_builder_data(self, builder):
         # Transform the positions.
-        if data.data_bounds is not None:
-            data_bounds = np.repeat(data.data_bounds, n_samples, axis=0)
-            self.data_range.from_bounds = data_bounds
+        pos = builder['pos']
+        if 'data_bounds' in builder:
+            self.data_range.from_bounds = builder['data_bounds']
             pos = self.transforms.apply(pos)
 
-        assert pos.shape == (n, 2)
-        assert signal_index.shape == (n, 1)
-        assert masks.shape == (n, 1)
+        masks = builder['a_mask']
 
-        # Position and depth.
         self.program['a_position'] = pos.astype(np.float32)
-        self.program['a_signal_index'] = signal_index.astype(np.float32)
-        self.program['a_mask'] = masks.astype(np.float32)
+        self.program['a_signal_index'] = builder['a_signal_index']
+        self.program['a_mask'] = masks
 
         self.program['u_color'] = self.color
         self.program['u_mask_max'] = _max(masks)
 
+    def set_data(self, *args, **kwargs):
+        data = self.validate(*args, **kwargs)
+        builder = ArrayBuilder(self.vertex_count(**data))
+        self.add_to_builder(builder, data)
+        self.set_builder_data(builder)
+
 
 #------------------------------------------------------------------------------
 # Other visuals
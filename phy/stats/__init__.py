@@ -3,4 +3,8 @@
 
 """Statistics functions."""
 
-from .ccg import correlograms
+from .ccg import (correlograms, autocorrelograms, pair_correlograms,
+                  CorrelogramStore)
+from .spiketrains import (isi_histograms, refractory_violations,
+                          firing_rates, firing_rates_over_time,
+                          spike_train_stats, SpikeTrainStats)
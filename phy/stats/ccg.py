@@ -6,10 +6,17 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from itertools import product
+import logging
+
 import numpy as np
 
 from phy.utils._types import _as_array
-from phy.io.array import _index_of, _unique
+from phy.io.array import (_index_of, _unique, _executor, _n_workers,
+                          _spikes_in_clusters, _excerpt_index,
+                          excerpt_bounds, LRUCache)
+
+logger = logging.getLogger(__name__)
 
 
 #------------------------------------------------------------------------------
@@ -54,6 +61,248 @@ def _symmetrize_correlograms(correlograms):
     return np.dstack((sym, correlograms))
 
 
+def _correlograms_shift(spike_samples, spike_clusters_i, n_clusters,
+                        binsize, winsize_bins):
+    """Reference algorithm: compare every spike with the spike `shift`
+    positions later, for increasing shifts, until no spike has a matching
+    spike within the window."""
+
+    # Shift between the two copies of the spike trains.
+    shift = 1
+
+    # At a given shift, the mask precises which spikes have matching spikes
+    # within the correlogram time window.
+    mask = np.ones_like(spike_samples, dtype=np.bool)
+
+    correlograms = _create_correlograms_array(n_clusters, winsize_bins)
+
+    # The loop continues as long as there is at least one spike with
+    # a matching spike.
+    while mask[:-shift].any():
+        # Number of time samples between spike i and spike i+shift.
+        spike_diff = _diff_shifted(spike_samples, shift)
+
+        # Binarize the delays between spike i and spike i+shift.
+        spike_diff_b = spike_diff // binsize
+
+        # Spikes with no matching spikes are masked.
+        mask[:-shift][spike_diff_b > (winsize_bins // 2)] = False
+
+        # Cache the masked spike delays.
+        m = mask[:-shift].copy()
+        d = spike_diff_b[m]
+
+        # # Update the masks given the clusters to update.
+        # m0 = np.in1d(spike_clusters[:-shift], clusters)
+        # m = m & m0
+        # d = spike_diff_b[m]
+        d = spike_diff_b[m]
+
+        # Find the indices in the raveled correlograms array that need
+        # to be incremented, taking into account the spike clusters.
+        indices = np.ravel_multi_index((spike_clusters_i[:-shift][m],
+                                        spike_clusters_i[+shift:][m],
+                                        d),
+                                       correlograms.shape)
+
+        # Increment the matching spikes in the correlograms array.
+        _increment(correlograms.ravel(), indices)
+
+        shift += 1
+
+    return correlograms
+
+
+def _accumulate(arr, indices):
+    """Add the number of occurrences of every index to a 1D array.
+
+    `bincount()` allocates an array as large as `arr`: with large arrays,
+    the indices are counted with `unique()` instead.
+
+    """
+    if len(indices) == 0:
+        return arr
+    if len(arr) <= 4 * len(indices):
+        arr += np.bincount(indices, minlength=len(arr)).astype(arr.dtype)
+    else:
+        u, counts = np.unique(indices, return_counts=True)
+        arr[u] += counts.astype(arr.dtype)
+    return arr
+
+
+def _iter_pairs(spike_samples, n_bins, binsize, batch_size=2 ** 20,
+                n_first=None):
+    """Yield `(i, j, d)` for all pairs of spikes `i < j` such that
+    `d = (t[j] - t[i]) // binsize` is less than `n_bins`, by batches of at
+    most `batch_size` pairs.
+
+    The window neighbours of every spike are found with `searchsorted()` on
+    the sorted spike samples. If `n_first` is set, only the pairs with
+    `i < n_first` are yielded.
+
+    """
+    n_spikes = len(spike_samples) if n_first is None else n_first
+    if n_spikes == 0:
+        return
+
+    # The neighbours of spike i are the spikes i + 1 ... end[i] - 1.
+    end = np.searchsorted(spike_samples,
+                          spike_samples[:n_spikes] + n_bins * binsize,
+                          side='left')
+    n_pairs = end - np.arange(1, n_spikes + 1)
+    # Number of pairs of the spikes before every spike.
+    cum = np.concatenate(([0], np.cumsum(n_pairs)))
+
+    batch_size = max(1, int(batch_size))
+    a = 0
+    while a < n_spikes:
+        # Batch of spikes with at most `batch_size` pairs, or a single spike
+        # with more neighbours than that.
+        b = np.searchsorted(cum, cum[a] + batch_size, side='right') - 1
+        b = min(max(b, a + 1), n_spikes)
+        n = n_pairs[a:b]
+        spikes = np.arange(a, b)
+        # First spike of every pair.
+        i = np.repeat(spikes, n)
+        # Second spike of every pair: the k-th pair of spike i is
+        # (i, i + 1 + k - cum[i]).
+        j = np.arange(cum[a], cum[b]) - np.repeat(cum[a:b] - spikes - 1, n)
+        d = (spike_samples[j] - spike_samples[i]) // binsize
+        yield i, j, d
+        a = b
+
+
+def _correlograms_sort(spike_samples, spike_clusters_i, n_clusters,
+                       binsize, winsize_bins, batch_size=2 ** 20,
+                       n_first=None):
+    """Count the spike pairs found by `_iter_pairs()`.
+
+    Every pair of spikes `i < j` such that `(t[j] - t[i]) // binsize` is at
+    most `winsize_bins // 2` is counted once, like in the reference
+    algorithm.
+
+    """
+    n_bins = winsize_bins // 2 + 1
+    correlograms = _create_correlograms_array(n_clusters, winsize_bins)
+    flat = correlograms.ravel()
+    for i, j, d in _iter_pairs(spike_samples, n_bins, binsize,
+                               batch_size=batch_size, n_first=n_first):
+        indices = ((spike_clusters_i[i] * n_clusters +
+                    spike_clusters_i[j]) * n_bins + d)
+        _accumulate(flat, indices)
+    return correlograms
+
+
+def _time_blocks(spike_samples, n_blocks, n_bins, binsize):
+    """Split the spikes into blocks of consecutive spikes.
+
+    Return a list of `(start, stop, end)` tuples. The pairs whose first
+    spike is in `start:stop` only involve the spikes in `start:end`: the
+    blocks overlap by one correlogram window, and every pair is assigned
+    to the block of its first spike, so that it is counted exactly once.
+
+    """
+    n_spikes = len(spike_samples)
+    bounds = np.unique(np.linspace(0, n_spikes, n_blocks + 1).astype(np.int64))
+    blocks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        end = np.searchsorted(spike_samples,
+                              spike_samples[stop - 1] + n_bins * binsize,
+                              side='left')
+        blocks.append((int(start), int(stop), int(end)))
+    return blocks
+
+
+def _correlograms_parallel(spike_samples, spike_clusters_i, n_clusters,
+                           binsize, winsize_bins, batch_size=2 ** 20,
+                           n_workers=None, backend='thread'):
+    """Sum the partial correlograms of time blocks computed in a pool of
+    threads or processes."""
+    n_bins = winsize_bins // 2 + 1
+    executor = _executor(n_workers, backend=backend)
+    if executor is None:
+        return _correlograms_sort(spike_samples, spike_clusters_i,
+                                  n_clusters, binsize, winsize_bins,
+                                  batch_size=batch_size)
+    # Several blocks per worker to balance the load.
+    blocks = _time_blocks(spike_samples, 4 * _n_workers(n_workers),
+                          n_bins, binsize)
+    correlograms = _create_correlograms_array(n_clusters, winsize_bins)
+    from concurrent.futures import as_completed
+    with executor:
+        futures = [executor.submit(_correlograms_sort,
+                                   spike_samples[start:end],
+                                   spike_clusters_i[start:end],
+                                   n_clusters, binsize, winsize_bins,
+                                   batch_size=batch_size,
+                                   n_first=stop - start,
+                                   )
+                   for start, stop, end in blocks]
+        for future in as_completed(futures):
+            correlograms += future.result()
+    return correlograms
+
+
+def _autocorrelograms_sort(spike_samples, spike_clusters_i, n_clusters,
+                           binsize, winsize_bins, batch_size=2 ** 20):
+    """Count the pairs of spikes within every cluster only, and return a
+    `(n_clusters, winsize_bins // 2 + 1)` array."""
+    n_bins = winsize_bins // 2 + 1
+    acgs = np.zeros((n_clusters, n_bins), dtype=np.int32)
+    if len(spike_samples) == 0:
+        return acgs
+    # Sort the spikes by cluster, then by time, and shift the spike samples
+    # of every cluster so that there is no pair between two clusters.
+    order = np.argsort(spike_clusters_i, kind='mergesort')
+    clusters = spike_clusters_i[order]
+    samples = spike_samples[order] - spike_samples.min()
+    samples += clusters * (samples.max() + n_bins * binsize + 1)
+    flat = acgs.ravel()
+    for i, j, d in _iter_pairs(samples, n_bins, binsize,
+                               batch_size=batch_size):
+        _accumulate(flat, clusters[i] * n_bins + d)
+    return acgs
+
+
+def _bin_params(sample_rate, bin_size, window_size):
+    """Return the bin size in samples, and the number of bins of the
+    symmetrized correlograms."""
+    # Find `binsize`.
+    bin_size = np.clip(bin_size, 1e-5, 1e5)  # in seconds
+    binsize = int(sample_rate * bin_size)  # in samples
+    assert binsize >= 1
+
+    # Find `winsize_bins`.
+    window_size = np.clip(window_size, 1e-5, 1e5)  # in seconds
+    winsize_bins = 2 * int(.5 * window_size / bin_size) + 1
+
+    assert winsize_bins >= 1
+    assert winsize_bins % 2 == 1
+
+    return binsize, winsize_bins
+
+
+def _ccg_params(spike_times, spike_clusters, sample_rate,
+                bin_size, window_size):
+    """Return the spike samples, the bin size in samples, and the number of
+    bins of the symmetrized correlograms."""
+    assert sample_rate > 0.
+    assert np.all(np.diff(spike_times) >= 0), ("The spike times must be "
+                                               "increasing.")
+
+    # Get the spike samples.
+    spike_times = np.asarray(spike_times, dtype=np.float64)
+    spike_samples = (spike_times * sample_rate).astype(np.int64)
+
+    spike_clusters = _as_array(spike_clusters)
+
+    assert spike_samples.ndim == 1
+    assert spike_samples.shape == spike_clusters.shape
+
+    binsize, winsize_bins = _bin_params(sample_rate, bin_size, window_size)
+    return spike_samples, spike_clusters, binsize, winsize_bins
+
+
 def correlograms(spike_times,
                  spike_clusters,
                  cluster_ids=None,
@@ -61,6 +310,10 @@ def correlograms(spike_times,
                  bin_size=None,
                  window_size=None,
                  symmetrize=True,
+                 method='sort',
+                 batch_size=2 ** 20,
+                 n_workers=1,
+                 backend='thread',
                  ):
     """Compute all pairwise cross-correlograms among the clusters appearing
     in `spike_clusters`.
@@ -79,6 +332,18 @@ def correlograms(spike_times,
         Size of the bin, in seconds.
     window_size : float
         Size of the window, in seconds.
+    method : str
+        `sort` (default) finds the neighbours of every spike with a binary
+        search and counts the pairs by batches. `shift` is the original
+        algorithm, kept as a reference. Both give identical results.
+    batch_size : int
+        Maximum number of spike pairs counted at once with the `sort`
+        method.
+    n_workers : int
+        With the `sort` method, number of workers computing the
+        correlograms of time blocks in parallel. All CPUs are used if None.
+    backend : str
+        `thread` or `process`.
 
     Returns
     -------
@@ -88,90 +353,438 @@ def correlograms(spike_times,
         CCGs.
 
     """
-    assert sample_rate > 0.
-    assert np.all(np.diff(spike_times) >= 0), ("The spike times must be "
-                                               "increasing.")
+    assert method in ('sort', 'shift')
+    spike_samples, spike_clusters, binsize, winsize_bins = _ccg_params(
+        spike_times, spike_clusters, sample_rate, bin_size, window_size)
 
-    # Get the spike samples.
-    spike_times = np.asarray(spike_times, dtype=np.float64)
-    spike_samples = (spike_times * sample_rate).astype(np.int64)
+    # Take the cluster oder into account.
+    if cluster_ids is None:
+        clusters = _unique(spike_clusters)
+    else:
+        clusters = _as_array(cluster_ids)
+    n_clusters = len(clusters)
 
-    spike_clusters = _as_array(spike_clusters)
+    # Like spike_clusters, but with 0..n_clusters-1 indices.
+    spike_clusters_i = _index_of(spike_clusters, clusters)
 
-    assert spike_samples.ndim == 1
-    assert spike_samples.shape == spike_clusters.shape
+    if method == 'sort':
+        correlograms = _correlograms_parallel(spike_samples,
+                                              spike_clusters_i,
+                                              n_clusters, binsize,
+                                              winsize_bins,
+                                              batch_size=batch_size,
+                                              n_workers=n_workers,
+                                              backend=backend,
+                                              )
+    else:
+        correlograms = _correlograms_shift(spike_samples, spike_clusters_i,
+                                           n_clusters, binsize, winsize_bins)
 
-    # Find `binsize`.
-    bin_size = np.clip(bin_size, 1e-5, 1e5)  # in seconds
-    binsize = int(sample_rate * bin_size)  # in samples
-    assert binsize >= 1
+    # Remove ACG peaks.
+    correlograms[np.arange(n_clusters),
+                 np.arange(n_clusters),
+                 0] = 0
 
-    # Find `winsize_bins`.
-    window_size = np.clip(window_size, 1e-5, 1e5)  # in seconds
-    winsize_bins = 2 * int(.5 * window_size / bin_size) + 1
+    if symmetrize:
+        return _symmetrize_correlograms(correlograms)
+    else:
+        return correlograms
 
-    assert winsize_bins >= 1
-    assert winsize_bins % 2 == 1
 
-    # Take the cluster oder into account.
+def autocorrelograms(spike_times,
+                     spike_clusters,
+                     cluster_ids=None,
+                     sample_rate=1.,
+                     bin_size=None,
+                     window_size=None,
+                     symmetrize=True,
+                     batch_size=2 ** 20,
+                     ):
+    """Compute the autocorrelograms of all clusters in a single pass.
+
+    This is equivalent to the diagonal of `correlograms()`, without
+    computing nor storing the cross-correlograms.
+
+    Parameters
+    ----------
+
+    spike_times : array-like
+        Spike times in seconds.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    cluster_ids : array-like
+        The list of unique clusters, in any order. That order will be used
+        in the output array.
+    bin_size : float
+        Size of the bin, in seconds.
+    window_size : float
+        Size of the window, in seconds.
+    batch_size : int
+        Maximum number of spike pairs counted at once.
+
+    Returns
+    -------
+
+    autocorrelograms : array
+        A `(n_clusters, winsize_samples)` array.
+
+    """
+    spike_samples, spike_clusters, binsize, winsize_bins = _ccg_params(
+        spike_times, spike_clusters, sample_rate, bin_size, window_size)
+
     if cluster_ids is None:
         clusters = _unique(spike_clusters)
     else:
         clusters = _as_array(cluster_ids)
+        # Discard the spikes of the other clusters.
+        keep = np.in1d(spike_clusters, clusters)
+        spike_samples = spike_samples[keep]
+        spike_clusters = spike_clusters[keep]
     n_clusters = len(clusters)
-
-    # Like spike_clusters, but with 0..n_clusters-1 indices.
     spike_clusters_i = _index_of(spike_clusters, clusters)
 
-    # Shift between the two copies of the spike trains.
-    shift = 1
+    acgs = _autocorrelograms_sort(spike_samples, spike_clusters_i,
+                                  n_clusters, binsize, winsize_bins,
+                                  batch_size=batch_size)
 
-    # At a given shift, the mask precises which spikes have matching spikes
-    # within the correlogram time window.
-    mask = np.ones_like(spike_samples, dtype=np.bool)
+    # Remove ACG peaks.
+    acgs[:, 0] = 0
 
-    correlograms = _create_correlograms_array(n_clusters, winsize_bins)
+    if symmetrize:
+        return np.hstack((acgs[:, 1:][:, ::-1], acgs))
+    else:
+        return acgs
 
-    # The loop continues as long as there is at least one spike with
-    # a matching spike.
-    while mask[:-shift].any():
-        # Number of time samples between spike i and spike i+shift.
-        spike_diff = _diff_shifted(spike_samples, shift)
 
-        # Binarize the delays between spike i and spike i+shift.
-        spike_diff_b = spike_diff // binsize
+def pair_correlograms(spike_times,
+                      spike_clusters,
+                      pairs,
+                      sample_rate=1.,
+                      bin_size=None,
+                      window_size=None,
+                      symmetrize=True,
+                      batch_size=2 ** 20,
+                      ):
+    """Compute the correlograms of an explicit list of cluster pairs.
 
-        # Spikes with no matching spikes are masked.
-        mask[:-shift][spike_diff_b > (winsize_bins // 2)] = False
+    Only the spikes of the clusters appearing in `pairs` are considered,
+    and only the requested pairs are stored. The result is identical to
+    the corresponding items of `correlograms()`.
 
-        # Cache the masked spike delays.
-        m = mask[:-shift].copy()
-        d = spike_diff_b[m]
+    Parameters
+    ----------
 
-        # # Update the masks given the clusters to update.
-        # m0 = np.in1d(spike_clusters[:-shift], clusters)
-        # m = m & m0
-        # d = spike_diff_b[m]
-        d = spike_diff_b[m]
+    spike_times : array-like
+        Spike times in seconds.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    pairs : array-like
+        A `(n_pairs, 2)` array of cluster ids. The pair `(i, i)` is the
+        autocorrelogram of cluster `i`.
+    bin_size : float
+        Size of the bin, in seconds.
+    window_size : float
+        Size of the window, in seconds.
+    batch_size : int
+        Maximum number of spike pairs counted at once.
 
-        # Find the indices in the raveled correlograms array that need
-        # to be incremented, taking into account the spike clusters.
-        indices = np.ravel_multi_index((spike_clusters_i[:-shift][m],
-                                        spike_clusters_i[+shift:][m],
-                                        d),
-                                       correlograms.shape)
+    Returns
+    -------
 
-        # Increment the matching spikes in the correlograms array.
-        _increment(correlograms.ravel(), indices)
+    correlograms : array
+        A `(n_pairs, winsize_samples)` array.
 
-        shift += 1
+    """
+    spike_samples, spike_clusters, binsize, winsize_bins = _ccg_params(
+        spike_times, spike_clusters, sample_rate, bin_size, window_size)
+    n_bins = winsize_bins // 2 + 1
+
+    pairs = np.asarray(pairs, dtype=np.int64).reshape((-1, 2))
+    # Directed pairs to count: (i, j) and, for the symmetrization, (j, i).
+    c, c_t = np.split(_pair_counts(spike_samples, spike_clusters,
+                                   np.vstack((pairs, pairs[:, ::-1])),
+                                   n_bins, binsize, batch_size=batch_size),
+                      2)
 
     # Remove ACG peaks.
-    correlograms[np.arange(n_clusters),
-                 np.arange(n_clusters),
-                 0] = 0
+    acg = pairs[:, 0] == pairs[:, 1]
+    c[acg, 0] = c_t[acg, 0] = 0
 
-    if symmetrize:
-        return _symmetrize_correlograms(correlograms)
-    else:
-        return correlograms
+    if not symmetrize:
+        return c
+    return _symmetrize_pairs(c, c_t)
+
+
+def _pair_counts(spike_samples, spike_clusters, pairs, n_bins, binsize,
+                 batch_size=2 ** 20):
+    """Count the pairs of spikes for a list of directed cluster pairs.
+
+    Return a `(n_pairs, n_bins)` array with the raw counts: the ACG peaks
+    are not removed. Only the spikes of the clusters in `pairs` are
+    considered.
+
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape((-1, 2))
+    clusters = _unique(pairs.ravel())
+    n_clusters = len(clusters)
+    pairs_i = _index_of(pairs, clusters)
+
+    # Discard the spikes of the other clusters.
+    keep = np.in1d(spike_clusters, clusters)
+    spike_samples = spike_samples[keep]
+    spike_clusters_i = _index_of(spike_clusters[keep], clusters)
+
+    keys = pairs_i[:, 0] * n_clusters + pairs_i[:, 1]
+    counted = np.unique(keys)
+    ccgs = np.zeros((len(counted), n_bins), dtype=np.int32)
+    if not len(counted):
+        return ccgs
+    flat = ccgs.ravel()
+    for i, j, d in _iter_pairs(spike_samples, n_bins, binsize,
+                               batch_size=batch_size):
+        k = spike_clusters_i[i] * n_clusters + spike_clusters_i[j]
+        row = np.clip(np.searchsorted(counted, k), 0, len(counted) - 1)
+        m = counted[row] == k
+        _accumulate(flat, row[m] * n_bins + d[m])
+    return ccgs[np.searchsorted(counted, keys)]
+
+
+def _symmetrize_pairs(c, c_t):
+    """Symmetrize the correlograms of a list of pairs `(i, j)`, given the
+    correlograms of the pairs `(j, i)`, like
+    `_symmetrize_correlograms()`."""
+    n_pairs, n_bins = c.shape
+    out = np.zeros((n_pairs, 2 * n_bins - 1), dtype=c.dtype)
+    out[:, n_bins - 1:] = c
+    out[:, n_bins - 1] = np.maximum(c[:, 0], c_t[:, 0])
+    out[:, :n_bins - 1] = c_t[:, 1:][:, ::-1]
+    return out
+
+
+#------------------------------------------------------------------------------
+# Correlogram store
+#------------------------------------------------------------------------------
+
+class CorrelogramStore(object):
+    """Store the correlograms of pairs of clusters.
+
+    The raw pair counts are stored by `(cluster_i, cluster_j, bin_size,
+    window_size, excerpts)` in an LRU cache of at most `max_count_bytes`
+    bytes, and only the missing pairs are computed.
+
+    At most `n_excerpts * excerpt_size` spikes are used for a selection of
+    clusters: the spikes of every cluster are subsampled with regular
+    excerpts when they exceed its share of this budget. `excerpts` is
+    None when all spikes of both clusters are used, and the
+    `(excerpt_size, n_excerpts)` share of the selection otherwise, so that
+    the correlograms do not depend on the previous selections.
+
+    When a new cluster is the union of deleted clusters, for example after
+    a merge, its correlograms are the sums of the stored correlograms of
+    these clusters, unless its spikes would be subsampled. Call
+    `on_cluster()` with the `UpdateInfo` of every clustering action to
+    register these unions and drop the correlograms of the deleted
+    clusters.
+
+    """
+    excerpt_size = 10000
+    n_excerpts = 100
+
+    def __init__(self, spike_times=None, spike_clusters=None,
+                 sample_rate=None, spikes_per_cluster=None,
+                 max_spike_bytes=2 ** 27, max_count_bytes=2 ** 26):
+        assert sample_rate > 0
+        self.sample_rate = float(sample_rate)
+        self.spike_times = np.asarray(spike_times, dtype=np.float64)
+        self.spike_clusters = spike_clusters
+        # Optional function cluster_id => spike_ids.
+        self.spikes_per_cluster = spikes_per_cluster
+        # {(cluster_i, cluster_j, bin_size, window_size, excerpts):
+        #  raw counts}
+        self._counts = LRUCache(max_bytes=max_count_bytes)
+        # {cluster: parents} for the clusters that are unions of other
+        # clusters.
+        self._parents = {}
+        # {cluster: number of spikes}
+        self._n_spikes = {}
+        # Spikes of the last used clusters:
+        # {(cluster, excerpt_size, n_excerpts): spike_ids}.
+        self._spikes = LRUCache(max_bytes=max_spike_bytes)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def _excerpt_params(self, n_clusters):
+        """Excerpt size and number of excerpts of every cluster in a
+        selection of clusters."""
+        budget = max(1, (self.n_excerpts * self.excerpt_size) //
+                     max(1, n_clusters))
+        excerpt_size = min(self.excerpt_size, budget)
+        n_excerpts = max(1, min(self.n_excerpts, budget // excerpt_size))
+        return excerpt_size, n_excerpts
+
+    def _cluster_spikes(self, cluster_id, excerpt_size, n_excerpts):
+        """Spike ids of the excerpts of a cluster."""
+        key = (cluster_id, excerpt_size, n_excerpts)
+        spike_ids = self._spikes.get(key)
+        if spike_ids is not None:
+            return spike_ids
+        if self.spikes_per_cluster is None:
+            spike_ids = _spikes_in_clusters(self.spike_clusters,
+                                            [cluster_id])
+        else:
+            spike_ids = np.asarray(self.spikes_per_cluster(cluster_id),
+                                   dtype=np.int64)
+        self._n_spikes[cluster_id] = len(spike_ids)
+        bounds = excerpt_bounds(len(spike_ids),
+                                excerpt_size=excerpt_size,
+                                n_excerpts=n_excerpts)
+        if len(bounds) == 1:
+            start, end = bounds[0]
+            spike_ids = spike_ids[start:end]
+        else:
+            spike_ids = spike_ids[_excerpt_index(bounds)]
+        self._spikes.set(key, spike_ids)
+        return spike_ids
+
+    def _is_complete(self, cluster_id, excerpts):
+        """Whether all spikes of a cluster are used with some excerpt
+        parameters."""
+        if excerpts is None:
+            return True
+        n = self._n_spikes.get(cluster_id, None)
+        excerpt_size, n_excerpts = excerpts
+        return n is not None and n < excerpt_size * n_excerpts
+
+    def _key(self, ci, cj, bin_size, window_size, excerpts):
+        if self._is_complete(ci, excerpts) and \
+                self._is_complete(cj, excerpts):
+            excerpts = None
+        return (ci, cj, bin_size, window_size, excerpts)
+
+    def _lookup(self, ci, cj, bin_size, window_size, excerpts):
+        """Return the stored counts of a pair, or the sum of the counts of
+        the pairs of their parents, or None."""
+        key = self._key(ci, cj, bin_size, window_size, excerpts)
+        counts = self._counts.get(key, None)
+        if counts is not None:
+            return counts
+        pi, pj = self._parents.get(ci, None), self._parents.get(cj, None)
+        if pi is None and pj is None:
+            return None
+        # The sum of the parents' counts is only valid if the spikes of
+        # the unions are not subsampled.
+        if not all(self._is_complete(c, excerpts)
+                   for c, p in ((ci, pi), (cj, pj)) if p):
+            return None
+        counts = 0
+        for a, b in product(pi or [ci], pj or [cj]):
+            c = self._lookup(a, b, bin_size, window_size, excerpts)
+            if c is None:
+                return None
+            counts = counts + c
+        self._counts.set(key, counts)
+        return counts
+
+    def _compute(self, pairs, bin_size, window_size, excerpts):
+        """Compute and store the counts of some directed pairs of existing
+        clusters.
+
+        Return a `{(cluster_i, cluster_j): counts}` dictionary.
+
+        """
+        clusters = _unique(np.ravel(pairs))
+        spike_ids = np.sort(np.concatenate(
+            [self._cluster_spikes(c, *excerpts) for c in clusters]))
+        spike_samples = (self.spike_times[spike_ids] *
+                         self.sample_rate).astype(np.int64)
+        binsize, winsize_bins = _bin_params(self.sample_rate,
+                                            bin_size, window_size)
+        logger.log(5, "Computing %d correlograms (%d spikes).",
+                   len(pairs), len(spike_ids))
+        counts = _pair_counts(spike_samples,
+                              self.spike_clusters[spike_ids],
+                              pairs, winsize_bins // 2 + 1, binsize)
+        out = {}
+        for (ci, cj), c in zip(pairs, counts):
+            self._counts.set(self._key(ci, cj, bin_size, window_size,
+                                       excerpts), c)
+            out[ci, cj] = c
+        return out
+
+    def get(self, cluster_ids, bin_size=None, window_size=None):
+        """Return the `(n_clusters, n_clusters, n_bins)` array of the
+        correlograms of some existing clusters, like `correlograms()`."""
+        cluster_ids = [int(c) for c in cluster_ids]
+        n_clusters = len(cluster_ids)
+        pairs = list(product(cluster_ids, cluster_ids))
+        excerpts = self._excerpt_params(n_clusters)
+        # The number of spikes of the clusters tells which pairs use all
+        # their spikes.
+        for c in cluster_ids:
+            if c not in self._n_spikes:
+                self._cluster_spikes(c, *excerpts)
+
+        # Compute the missing pairs.
+        counts = {}
+        missing = set()
+        for ci, cj in pairs:
+            c = self._lookup(ci, cj, bin_size, window_size, excerpts)
+            if c is None:
+                missing.add((ci, cj))
+            else:
+                counts[ci, cj] = c
+        if missing:
+            counts.update(self._compute(sorted(missing), bin_size,
+                                        window_size, excerpts))
+
+        _, winsize_bins = _bin_params(self.sample_rate, bin_size,
+                                      window_size)
+        ccg = _create_correlograms_array(n_clusters, winsize_bins)
+        for (i, j), pair in zip(product(range(n_clusters),
+                                        range(n_clusters)), pairs):
+            ccg[i, j] = counts[pair]
+
+        # Remove ACG peaks.
+        ccg[np.arange(n_clusters), np.arange(n_clusters), 0] = 0
+        return _symmetrize_correlograms(ccg)
+
+    def _derive(self, cluster_id, deleted):
+        """Store the correlograms of a union cluster with all clusters
+        that can be derived from the stored ones of its parents."""
+        parents = self._parents[cluster_id]
+        others = set()
+        for key in self._counts.keys():
+            if key[0] in parents:
+                others.add(key[1:])
+        for cj, bin_size, window_size, excerpts in others:
+            if cj in parents:
+                cj = cluster_id
+            elif cj in deleted:
+                continue
+            self._lookup(cluster_id, cj, bin_size, window_size, excerpts)
+            self._lookup(cj, cluster_id, bin_size, window_size, excerpts)
+
+    def on_cluster(self, up):
+        """Register the new clusters that are unions of deleted clusters,
+        and drop the correlograms of the deleted clusters."""
+        parents = {}
+        children = {}
+        for old, new in up.descendants:
+            parents.setdefault(new, set()).add(old)
+            children.setdefault(old, set()).add(new)
+        deleted = set(up.deleted)
+        for new in up.added:
+            old = parents.get(new, ())
+            # The spikes of the new cluster all come from the old clusters:
+            # it is their union if all their spikes went to it.
+            if old and all(c in deleted and children[c] == {new}
+                           for c in old):
+                self._parents[new] = sorted(old)
+                if all(c in self._n_spikes for c in old):
+                    self._n_spikes[new] = sum(self._n_spikes[c]
+                                              for c in old)
+                self._derive(new, deleted)
+        for key in self._counts.keys():
+            if key[0] in deleted or key[1] in deleted:
+                self._counts.pop(key)
@@ -78,3 +78,273 @@ def get_mean_masked_features_distance(mean_features_0,
     d_1 = mu_1 * omeg_1
 
     return np.linalg.norm(d_0 - d_1)
+
+
+#------------------------------------------------------------------------------
+# Batch similarity
+#------------------------------------------------------------------------------
+
+def get_masked_features_vectors(mean_features, mean_masks):
+    """Stack the mean masked features of several clusters.
+
+    The Euclidean distance between two rows is the distance returned by
+    `get_mean_masked_features_distance()`.
+
+    Parameters
+    ----------
+
+    mean_features : array
+        A `(n_clusters, n_channels, n_features_per_channel)` array.
+    mean_masks : array
+        A `(n_clusters, n_channels)` array.
+
+    Returns
+    -------
+
+    vectors : array
+        A `(n_clusters, n_channels * n_features_per_channel)` array.
+
+    """
+    n_clusters, n_channels = mean_masks.shape
+    assert mean_features.shape[:2] == (n_clusters, n_channels)
+    vectors = mean_features * mean_masks[..., np.newaxis]
+    return vectors.reshape((n_clusters, -1))
+
+
+def pairwise_distances(x, y=None):
+    """Euclidean distances between the rows of two arrays, computed with a
+    single matrix product."""
+    x = np.asarray(x, dtype=np.float64)
+    y = x if y is None else np.asarray(y, dtype=np.float64)
+    sq = (np.sum(x * x, axis=1)[:, np.newaxis] +
+          np.sum(y * y, axis=1)[np.newaxis, :] -
+          2 * np.dot(x, y.T))
+    # NOTE: rounding errors may give small negative values.
+    return np.sqrt(np.clip(sq, 0, None))
+
+
+def _top_k(dist, ids, k):
+    """Return the ids and the values of the `k` smallest values of every row,
+    sorted by increasing value. The rows are padded with -1 and inf."""
+    n, m = dist.shape
+    out_ids = np.full((n, k), -1, dtype=np.int64)
+    out_dist = np.full((n, k), np.inf)
+    if m == 0:
+        return out_ids, out_dist
+    kk = min(k, m)
+    ind = np.argpartition(dist, kk - 1, axis=1)[:, :kk]
+    d = np.take_along_axis(dist, ind, axis=1)
+    order = np.argsort(d, axis=1, kind='mergesort')
+    ind = np.take_along_axis(ind, order, axis=1)
+    out_ids[:, :kk] = ids[ind]
+    out_dist[:, :kk] = np.take_along_axis(d, order, axis=1)
+    return out_ids, out_dist
+
+
+class ClusterNeighbors(object):
+    """Keep the `n_neighbors` closest clusters of every cluster.
+
+    The distances are the Euclidean distances between per-cluster vectors,
+    for example stacked mean masked features, computed with matrix
+    products by blocks of `block_size` rows.
+
+    `update()` only computes the rows and columns of the new clusters, and
+    the rows whose neighbours have been deleted.
+
+    Parameters
+    ----------
+
+    get_vectors : function
+        A function `cluster_ids => (n_clusters, n_dims) array`.
+    n_neighbors : int
+        Number of neighbours kept per cluster.
+
+    """
+    def __init__(self, get_vectors, n_neighbors=100, block_size=1024):
+        self.get_vectors = get_vectors
+        self.n_neighbors = n_neighbors
+        self.block_size = block_size
+        self.cluster_ids = np.array([], dtype=np.int64)
+        self._vectors = None
+        # (n_clusters, n_neighbors) arrays.
+        self._nn_ids = np.zeros((0, n_neighbors), dtype=np.int64)
+        self._nn_dist = np.zeros((0, n_neighbors))
+
+    def _rows_top_k(self, vectors):
+        """Neighbours of some vectors among all clusters."""
+        k = self.n_neighbors
+        ids = np.zeros((0, k), dtype=np.int64)
+        dist = np.zeros((0, k))
+        blocks = [(ids, dist)]
+        for i in range(0, len(vectors), self.block_size):
+            d = pairwise_distances(vectors[i:i + self.block_size],
+                                   self._vectors)
+            blocks.append(_top_k(d, self.cluster_ids, k))
+        return (np.concatenate([b[0] for b in blocks]),
+                np.concatenate([b[1] for b in blocks]))
+
+    def _remove(self, cluster_ids):
+        keep = ~np.in1d(self.cluster_ids, cluster_ids)
+        self.cluster_ids = self.cluster_ids[keep]
+        self._vectors = self._vectors[keep]
+        self._nn_ids = self._nn_ids[keep]
+        self._nn_dist = self._nn_dist[keep]
+        # Recompute the rows that have lost some neighbours.
+        lost = np.any(np.in1d(self._nn_ids, cluster_ids).
+                      reshape(self._nn_ids.shape), axis=1)
+        if np.any(lost):
+            self._nn_ids[lost], self._nn_dist[lost] = \
+                self._rows_top_k(self._vectors[lost])
+
+    def _add(self, cluster_ids):
+        vectors = np.asarray(self.get_vectors(cluster_ids), dtype=np.float64)
+        vectors = vectors.reshape((len(cluster_ids), -1))
+        n_old = len(self.cluster_ids)
+        if self._vectors is None:
+            self._vectors = vectors
+        else:
+            self._vectors = np.concatenate((self._vectors, vectors))
+        self.cluster_ids = np.concatenate((self.cluster_ids, cluster_ids))
+        # Rows of the new clusters.
+        ids, dist = self._rows_top_k(vectors)
+        # Insert the new clusters in the rows of the old clusters.
+        if n_old:
+            k = self.n_neighbors
+            old_ids, old_dist = self._nn_ids, self._nn_dist
+            for i in range(0, n_old, self.block_size):
+                rows = slice(i, min(i + self.block_size, n_old))
+                d = pairwise_distances(self._vectors[rows], vectors)
+                new_ids, new_dist = _top_k(d, np.asarray(cluster_ids), k)
+                # Merge the old and new neighbours.
+                all_ids = np.hstack((old_ids[rows], new_ids))
+                all_dist = np.hstack((old_dist[rows], new_dist))
+                order = np.argsort(all_dist, axis=1,
+                                   kind='mergesort')[:, :k]
+                old_ids[rows] = np.take_along_axis(all_ids, order, axis=1)
+                old_dist[rows] = np.take_along_axis(all_dist, order, axis=1)
+        self._nn_ids = np.concatenate((self._nn_ids, ids))
+        self._nn_dist = np.concatenate((self._nn_dist, dist))
+
+    def update(self, cluster_ids):
+        """Update the neighbours given the list of all existing clusters."""
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        deleted = np.setdiff1d(self.cluster_ids, cluster_ids)
+        added = np.setdiff1d(cluster_ids, self.cluster_ids)
+        if len(deleted):
+            self._remove(deleted)
+        if len(added):
+            self._add(added)
+
+    def on_cluster(self, up):
+        """Update the neighbours after a clustering action."""
+        cluster_ids = np.union1d(np.setdiff1d(self.cluster_ids, up.deleted),
+                                 up.added)
+        self.update(cluster_ids)
+
+    def neighbors(self, cluster_id):
+        """Return the list of `(cluster_id, distance)` of the closest
+        clusters, the closest first."""
+        i = np.nonzero(self.cluster_ids == cluster_id)[0]
+        if not len(i):
+            return []
+        ids, dist = self._nn_ids[i[0]], self._nn_dist[i[0]]
+        return [(int(c), float(d)) for c, d in zip(ids, dist) if c >= 0]
+
+
+#------------------------------------------------------------------------------
+# Spatial index
+#------------------------------------------------------------------------------
+
+class ClusterChannelIndex(object):
+    """Index the clusters by the position of their best channel.
+
+    The channels are sorted once by their distance to every channel, and
+    the clusters are grouped by best channel. The closest clusters of a
+    cluster are found by walking through the closest channels, without
+    loading any data.
+
+    Parameters
+    ----------
+
+    channel_positions : array
+        A `(n_channels, 2)` or `(n_channels, 3)` array.
+    get_best_channels : function
+        A function `cluster_ids => best_channels`.
+
+    """
+    def __init__(self, channel_positions, get_best_channels):
+        self.channel_positions = np.asarray(channel_positions,
+                                            dtype=np.float64)
+        n_channels = len(self.channel_positions)
+        self.get_best_channels = get_best_channels
+        self.cluster_ids = np.array([], dtype=np.int64)
+        self.best_channels = np.array([], dtype=np.int64)
+        # Distances between channels, and channels sorted by distance to
+        # every channel.
+        pos = self.channel_positions
+        self._channel_dist = np.sqrt(((pos[:, np.newaxis, :] -
+                                       pos[np.newaxis, :, :]) ** 2).
+                                     sum(axis=2))
+        self._channel_order = np.argsort(self._channel_dist, axis=1,
+                                         kind='mergesort')
+        # Sorted clusters of every channel.
+        self._clusters = [[] for _ in range(n_channels)]
+
+    def _index(self, cluster_ids):
+        """Rows of some indexed clusters, -1 for the unknown ones."""
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        if not len(self.cluster_ids):
+            return np.full(cluster_ids.shape, -1, dtype=np.int64)
+        i = np.clip(np.searchsorted(self.cluster_ids, cluster_ids),
+                    0, len(self.cluster_ids) - 1)
+        return np.where(self.cluster_ids[i] == cluster_ids, i, -1)
+
+    def _rebuild(self):
+        order = np.argsort(self.cluster_ids)
+        self.cluster_ids = self.cluster_ids[order]
+        self.best_channels = self.best_channels[order]
+        self._clusters = [[] for _ in range(len(self.channel_positions))]
+        for cluster, channel in zip(self.cluster_ids, self.best_channels):
+            self._clusters[channel].append(int(cluster))
+
+    def update(self, cluster_ids):
+        """Update the index given the list of all existing clusters. The
+        best channels of the new clusters only are computed."""
+        cluster_ids = np.asarray(cluster_ids, dtype=np.int64)
+        added = np.setdiff1d(cluster_ids, self.cluster_ids)
+        keep = np.in1d(self.cluster_ids, cluster_ids)
+        if not len(added) and np.all(keep):
+            return
+        channels = np.asarray(self.get_best_channels(added), dtype=np.int64)
+        self.cluster_ids = np.concatenate((self.cluster_ids[keep], added))
+        self.best_channels = np.concatenate((self.best_channels[keep],
+                                             channels))
+        self._rebuild()
+
+    def on_cluster(self, up):
+        """Update the index after a clustering action."""
+        self.update(np.union1d(np.setdiff1d(self.cluster_ids, up.deleted),
+                               up.added))
+
+    def best_channel_positions(self, cluster_ids):
+        """Positions of the best channels of indexed clusters."""
+        i = self._index(cluster_ids)
+        assert np.all(i >= 0)
+        return self.channel_positions[self.best_channels[i]]
+
+    def closest(self, cluster_id, n=None):
+        """Return the list of `(cluster_id, distance)` of the `n` closest
+        clusters, the closest first. The distance is the distance between
+        the best channels."""
+        i = self._index([cluster_id])[0]
+        if i < 0:
+            return []
+        channel = self.best_channels[i]
+        n = n or len(self.cluster_ids)
+        out = []
+        for other in self._channel_order[channel]:
+            d = float(self._channel_dist[channel, other])
+            out.extend((c, d) for c in self._clusters[other])
+            if len(out) >= n:
+                break
+        return out[:n]
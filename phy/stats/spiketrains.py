@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""Spike train statistics of all clusters."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+
+from phy.utils import Bunch
+from phy.utils._types import _as_array
+from phy.io.array import _index_of, _unique
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def _sorted_by_cluster(spike_times, spike_clusters, cluster_ids=None):
+    """Sort the spikes by cluster, then by time.
+
+    Return the cluster ids, the sorted spike times, the sorted relative
+    cluster indices, and the number of spikes of every cluster.
+
+    """
+    spike_times = np.asarray(spike_times, dtype=np.float64)
+    spike_clusters = _as_array(spike_clusters)
+    assert spike_times.shape == spike_clusters.shape
+    if cluster_ids is None:
+        cluster_ids = _unique(spike_clusters)
+    else:
+        cluster_ids = _as_array(cluster_ids)
+        # Discard the spikes of the other clusters.
+        keep = np.in1d(spike_clusters, cluster_ids)
+        spike_times = spike_times[keep]
+        spike_clusters = spike_clusters[keep]
+    n_clusters = len(cluster_ids)
+    clusters_i = _index_of(spike_clusters, cluster_ids)
+    # NOTE: a stable sort keeps the spikes of every cluster sorted by time.
+    # It is much faster on small integers.
+    if n_clusters <= np.iinfo(np.uint16).max:
+        order = np.argsort(clusters_i.astype(np.uint16), kind='mergesort')
+    else:  # pragma: no cover
+        order = np.argsort(clusters_i, kind='mergesort')
+    clusters_i = clusters_i[order]
+    n_spikes = np.bincount(clusters_i, minlength=n_clusters)
+    return cluster_ids, spike_times[order], clusters_i, n_spikes
+
+
+def _isis(times, clusters_i):
+    """Return the inter-spike intervals within every cluster, and their
+    cluster indices, given spikes sorted by cluster and time."""
+    same = clusters_i[1:] == clusters_i[:-1]
+    return (times[1:] - times[:-1])[same], clusters_i[1:][same]
+
+
+def _histograms(values, clusters_i, n_clusters, bin_size, n_bins):
+    """Histograms of some values for every cluster, with `n_bins` bins of
+    size `bin_size` starting at 0. The values out of range are discarded."""
+    bins = np.floor(values / bin_size).astype(np.int64)
+    keep = (bins >= 0) & (bins < n_bins)
+    indices = clusters_i[keep] * n_bins + bins[keep]
+    hist = np.bincount(indices, minlength=n_clusters * n_bins)
+    return hist.reshape((n_clusters, n_bins)).astype(np.int32)
+
+
+def _duration(spike_times, duration=None):
+    if duration is not None:
+        return float(duration)
+    if len(spike_times) == 0:
+        return 0.
+    return float(np.max(spike_times))
+
+
+#------------------------------------------------------------------------------
+# Spike train statistics
+#------------------------------------------------------------------------------
+
+def isi_histograms(spike_times, spike_clusters, cluster_ids=None,
+                   bin_size=1e-3, window_size=.1):
+    """Return the `(n_clusters, n_bins)` array of the inter-spike interval
+    histograms of all clusters, with bins of `bin_size` seconds up to
+    `window_size` seconds."""
+    cluster_ids, times, clusters_i, _ = _sorted_by_cluster(
+        spike_times, spike_clusters, cluster_ids)
+    isis, isi_clusters = _isis(times, clusters_i)
+    n_bins = int(round(window_size / bin_size))
+    return _histograms(isis, isi_clusters, len(cluster_ids),
+                       bin_size, n_bins)
+
+
+def refractory_violations(spike_times, spike_clusters, cluster_ids=None,
+                          refractory_period=2e-3):
+    """Return the fraction of the spikes of every cluster that follow the
+    previous spike of the cluster within the refractory period."""
+    cluster_ids, times, clusters_i, n_spikes = _sorted_by_cluster(
+        spike_times, spike_clusters, cluster_ids)
+    isis, isi_clusters = _isis(times, clusters_i)
+    violations = np.bincount(isi_clusters[isis < refractory_period],
+                             minlength=len(cluster_ids))
+    return violations / np.maximum(1, n_spikes).astype(np.float64)
+
+
+def firing_rates(spike_times, spike_clusters, cluster_ids=None,
+                 duration=None):
+    """Return the mean firing rate of every cluster, in Hz.
+
+    The duration of the recording is the time of the last spike by
+    default.
+
+    """
+    cluster_ids, _, _, n_spikes = _sorted_by_cluster(
+        spike_times, spike_clusters, cluster_ids)
+    duration = _duration(spike_times, duration)
+    return n_spikes / max(duration, 1e-10)
+
+
+def firing_rates_over_time(spike_times, spike_clusters, cluster_ids=None,
+                           bin_size=60., duration=None):
+    """Return the `(n_clusters, n_bins)` array of the firing rates of every
+    cluster in coarse time bins of `bin_size` seconds, in Hz."""
+    cluster_ids, times, clusters_i, _ = _sorted_by_cluster(
+        spike_times, spike_clusters, cluster_ids)
+    duration = _duration(spike_times, duration)
+    n_bins = max(1, int(np.ceil(duration / bin_size)))
+    # The spikes at the very end go to the last bin.
+    times = np.clip(times, 0, n_bins * bin_size * (1 - 1e-12))
+    return (_histograms(times, clusters_i, len(cluster_ids),
+                        bin_size, n_bins) / float(bin_size))
+
+
+def spike_train_stats(spike_times, spike_clusters, cluster_ids=None,
+                      duration=None,
+                      isi_bin_size=1e-3,
+                      isi_window_size=.1,
+                      refractory_period=2e-3,
+                      rate_bin_size=60.,
+                      ):
+    """Compute all spike train statistics of all clusters with a single
+    sort of the spikes.
+
+    Returns
+    -------
+
+    stats : Bunch
+        With the following `(n_clusters, ...)` arrays, in the order of
+        `cluster_ids`:
+
+        * `cluster_ids`
+        * `n_spikes`
+        * `firing_rate`: mean firing rate in Hz
+        * `refractory_violations`: fraction of the spikes within the
+          refractory period after the previous spike
+        * `isi_histogram`: inter-spike interval histograms
+        * `rate_over_time`: firing rates in coarse time bins, in Hz
+
+    """
+    cluster_ids, times, clusters_i, n_spikes = _sorted_by_cluster(
+        spike_times, spike_clusters, cluster_ids)
+    n_clusters = len(cluster_ids)
+    duration = _duration(spike_times, duration)
+
+    isis, isi_clusters = _isis(times, clusters_i)
+    violations = np.bincount(isi_clusters[isis < refractory_period],
+                             minlength=n_clusters)
+    n_isi_bins = int(round(isi_window_size / isi_bin_size))
+
+    n_rate_bins = max(1, int(np.ceil(duration / rate_bin_size)))
+    times = np.clip(times, 0, n_rate_bins * rate_bin_size * (1 - 1e-12))
+
+    return Bunch(cluster_ids=cluster_ids,
+                 n_spikes=n_spikes,
+                 firing_rate=n_spikes / max(duration, 1e-10),
+                 refractory_violations=(violations /
+                                        np.maximum(1, n_spikes).
+                                        astype(np.float64)),
+                 isi_histogram=_histograms(isis, isi_clusters, n_clusters,
+                                           isi_bin_size, n_isi_bins),
+                 rate_over_time=(_histograms(times, clusters_i, n_clusters,
+                                             rate_bin_size, n_rate_bins) /
+                                 float(rate_bin_size)),
+                 )
+
+
+class SpikeTrainStats(object):
+    """Spike train statistics of all clusters, computed on demand.
+
+    The statistics of all existing clusters are computed in one pass at
+    the first request. The statistics of new clusters are computed when
+    they are first requested: since cluster ids are never reused, they
+    never become stale.
+
+    The methods of this class take a cluster id and can be used as
+    columns of the cluster view.
+
+    """
+    def __init__(self, spike_times=None, spike_clusters=None,
+                 spikes_per_cluster=None, duration=None, **kwargs):
+        self.spike_times = np.asarray(spike_times, dtype=np.float64)
+        self.spike_clusters = spike_clusters
+        # Optional function cluster_id => spike_ids.
+        self.spikes_per_cluster = spikes_per_cluster
+        self.duration = _duration(self.spike_times, duration)
+        # Parameters of `spike_train_stats()`.
+        self._kwargs = kwargs
+        self._stats = None
+        # {cluster_id: row}
+        self._rows = {}
+
+    def _compute(self, cluster_ids=None):
+        if cluster_ids is None:
+            spike_ids = slice(None, None, None)
+        elif self.spikes_per_cluster is not None:
+            spike_ids = np.sort(np.concatenate(
+                [self.spikes_per_cluster(c) for c in cluster_ids]))
+        else:
+            spike_ids = np.nonzero(np.in1d(self.spike_clusters,
+                                           cluster_ids))[0]
+        stats = spike_train_stats(self.spike_times[spike_ids],
+                                  self.spike_clusters[spike_ids],
+                                  cluster_ids=cluster_ids,
+                                  duration=self.duration,
+                                  **self._kwargs)
+        # Append the rows of the new clusters.
+        if self._stats is None:
+            self._stats = stats
+        else:
+            for name, arr in stats.items():
+                self._stats[name] = np.concatenate((self._stats[name], arr))
+        n = len(self._rows)
+        for i, cluster_id in enumerate(stats.cluster_ids):
+            self._rows[int(cluster_id)] = n + i
+
+    def get(self, cluster_id, name):
+        """Return a statistic of a cluster."""
+        if self._stats is None:
+            self._compute()
+        if cluster_id not in self._rows:
+            self._compute([cluster_id])
+        return self._stats[name][self._rows[cluster_id]]
+
+    @property
+    def stats(self):
+        """Bunch with the arrays of all computed clusters."""
+        if self._stats is None:
+            self._compute()
+        return self._stats
+
+    def firing_rate(self, cluster_id):
+        return self.get(cluster_id, 'firing_rate')
+
+    def refractory_violations(self, cluster_id):
+        return self.get(cluster_id, 'refractory_violations')
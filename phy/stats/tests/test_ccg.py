@@ -9,9 +9,16 @@
 import numpy as np
 from numpy.testing import assert_array_equal as ae
 
+from phy.utils import Bunch
+
 from ..ccg import (_increment,
                    _diff_shifted,
+                   _accumulate,
+                   _time_blocks,
                    correlograms,
+                   autocorrelograms,
+                   pair_correlograms,
+                   CorrelogramStore,
                    )
 
 
@@ -54,6 +61,16 @@ def test_utils():
     ae(_diff_shifted(arr, 2), ds2)
 
 
+def test_accumulate():
+    arr = np.zeros(10, dtype=np.int32)
+    indices = [0, 2, 4, 2, 2, 9]
+    expected = [1, 0, 3, 0, 1, 0, 0, 0, 0, 1]
+    # Dense and sparse counting.
+    ae(_accumulate(arr.copy(), indices), expected)
+    ae(_accumulate(arr.copy(), indices[:2]), [1, 0, 1] + [0] * 7)
+    ae(_accumulate(arr.copy(), []), arr)
+
+
 def test_ccg_0():
     spike_samples = [0, 10, 10, 20]
     spike_clusters = [0, 1, 0, 1]
@@ -172,3 +189,194 @@ def test_symmetrize_correlograms():
     assert np.all(sym[np.arange(3), np.arange(3), 25] == 0)
 
     ae(sym[0, 1, :], sym[1, 0, ::-1])
+
+
+def test_ccg_methods():
+    """The sort-based algorithm gives the same result as the reference."""
+    for max_cluster in (1, 3, 10):
+        spike_samples, spike_clusters = _random_data(max_cluster)
+        # Add spikes at identical times.
+        spike_samples[100:110] = spike_samples[100]
+        for bin_size, window_size in ((.001, .05), (.0005, .2), (.01, .01)):
+            kwargs = dict(bin_size=bin_size, window_size=window_size,
+                          sample_rate=20000, symmetrize=False)
+            c0 = correlograms(spike_samples, spike_clusters,
+                              method='shift', **kwargs)
+            for batch_size in (1, 1000, 2 ** 20):
+                c1 = correlograms(spike_samples, spike_clusters,
+                                  method='sort', batch_size=batch_size,
+                                  **kwargs)
+                assert c1.dtype == c0.dtype
+                ae(c1, c0)
+
+
+def test_time_blocks():
+    spike_samples = np.array([0, 1, 2, 10, 11, 30, 31, 32])
+    # Window of 3 samples.
+    blocks = _time_blocks(spike_samples, 3, 3, 1)
+    assert blocks == [(0, 2, 3), (2, 5, 5), (5, 8, 8)]
+
+
+def test_ccg_parallel():
+    spike_samples, spike_clusters = _random_data(5)
+    spike_samples[100:110] = spike_samples[100]
+    kwargs = dict(bin_size=.001, window_size=.05, sample_rate=20000)
+    c0 = correlograms(spike_samples, spike_clusters, method='shift',
+                      **kwargs)
+    for backend in ('thread', 'process'):
+        c1 = correlograms(spike_samples, spike_clusters, n_workers=3,
+                          backend=backend, batch_size=1000, **kwargs)
+        ae(c1, c0)
+
+
+def test_ccg_empty():
+    c = correlograms([], np.array([], dtype=np.int64), cluster_ids=[0, 1],
+                     bin_size=1, window_size=7)
+    ae(c, np.zeros((2, 2, 7)))
+
+
+def test_autocorrelograms():
+    spike_samples, spike_clusters = _random_data(5)
+    spike_samples[100:110] = spike_samples[100]
+    kwargs = dict(bin_size=.001, window_size=.05, sample_rate=20000)
+    for symmetrize in (True, False):
+        c = correlograms(spike_samples, spike_clusters,
+                         symmetrize=symmetrize, **kwargs)
+        acgs = autocorrelograms(spike_samples, spike_clusters,
+                                symmetrize=symmetrize, batch_size=1000,
+                                **kwargs)
+        ae(acgs, c[np.arange(5), np.arange(5)])
+
+    # Subset of clusters, in a custom order.
+    acgs = autocorrelograms(spike_samples, spike_clusters,
+                            cluster_ids=[3, 1], symmetrize=False,
+                            **kwargs)
+    ae(acgs, c[[3, 1], [3, 1]])
+
+
+def test_pair_correlograms():
+    spike_samples, spike_clusters = _random_data(5)
+    spike_samples[100:110] = spike_samples[100]
+    kwargs = dict(bin_size=.001, window_size=.05, sample_rate=20000)
+    pairs = [(0, 1), (1, 0), (2, 2), (4, 1), (3, 4)]
+    for symmetrize in (True, False):
+        c = correlograms(spike_samples, spike_clusters,
+                         symmetrize=symmetrize, **kwargs)
+        ccgs = pair_correlograms(spike_samples, spike_clusters, pairs,
+                                 symmetrize=symmetrize, batch_size=1000,
+                                 **kwargs)
+        assert ccgs.shape == (5, c.shape[-1])
+        ae(ccgs, c[[0, 1, 2, 4, 3], [1, 0, 2, 1, 4]])
+
+
+def test_correlogram_store():
+    spike_samples, spike_clusters = _random_data(6)
+    spike_times = spike_samples / 20000.
+    params = dict(bin_size=.001, window_size=.05)
+
+    def _expected(cluster_ids):
+        keep = np.in1d(spike_clusters, cluster_ids)
+        return correlograms(spike_times[keep], spike_clusters[keep],
+                            cluster_ids=cluster_ids, sample_rate=20000.,
+                            **params)
+
+    store = CorrelogramStore(spike_times=spike_times,
+                             spike_clusters=spike_clusters,
+                             sample_rate=20000.)
+    ae(store.get([0, 1, 2], **params), _expected([0, 1, 2]))
+    assert len(store) == 9
+
+    # Adding a cluster to the selection only computes the new pairs.
+    ae(store.get([3, 0, 1, 2], **params), _expected([3, 0, 1, 2]))
+    assert len(store) == 16
+
+    # Other bin and window sizes.
+    store.get([0, 1], bin_size=.002, window_size=.02)
+    assert len(store) == 20
+
+    # Merge clusters 0 and 1 into 10.
+    spike_clusters[np.in1d(spike_clusters, [0, 1])] = 10
+    up = Bunch(added=[10], deleted=[0, 1], descendants=[(0, 10), (1, 10)])
+    store.on_cluster(up)
+
+    # The correlograms of the merged cluster are derived from the stored
+    # ones, and those of the deleted clusters are dropped.
+    assert not [key for key in store._counts.keys()
+                if key[0] in (0, 1) or key[1] in (0, 1)]
+    assert (10, 3) + tuple(params.values()) + (None,) in store._counts
+    compute = store._compute
+
+    def _fail(*args, **kwargs):
+        raise AssertionError()
+
+    store._compute = _fail
+    ae(store.get([10, 2, 3], **params), _expected([10, 2, 3]))
+    store._compute = compute
+
+    # New pairs with the merged cluster are computed.
+    ae(store.get([10, 4], **params), _expected([10, 4]))
+
+    # A split is not a union.
+    spike_clusters[:100] = 11
+    store.on_cluster(Bunch(added=[11, 12], deleted=[10, 2],
+                           descendants=[(10, 11), (2, 11), (10, 12)]))
+    assert 11 not in store._parents
+
+
+def test_correlogram_store_bounds():
+    spike_samples, spike_clusters = _random_data(10)
+    spike_times = spike_samples / 20000.
+    params = dict(bin_size=.001, window_size=.05)
+
+    store = CorrelogramStore(spike_times=spike_times,
+                             spike_clusters=spike_clusters,
+                             sample_rate=20000.)
+    store.get([0], **params)
+    nbytes = store._counts.nbytes
+
+    store = CorrelogramStore(spike_times=spike_times,
+                             spike_clusters=spike_clusters,
+                             sample_rate=20000.,
+                             max_count_bytes=20 * nbytes)
+    store.excerpt_size = 10
+    store.n_excerpts = 10
+
+    # The stored correlograms are bounded.
+    ccg = store.get(range(10), **params)
+    assert ccg.shape == (10, 10, 51)
+    assert len(store) == 20
+
+    # The spikes of the selection are bounded.
+    assert sum(len(store._spikes.get(key)) for key in store._spikes.keys()
+               if key[1:] == store._excerpt_params(10)) <= 100
+    assert store._excerpt_params(1) == (10, 10)
+    assert store._excerpt_params(10) == (10, 1)
+    assert store._excerpt_params(50) == (2, 1)
+
+
+def test_correlogram_store_history():
+    spike_samples, spike_clusters = _random_data(6)
+    spike_times = spike_samples / 20000.
+    params = dict(bin_size=.001, window_size=.05)
+
+    def _store():
+        store = CorrelogramStore(spike_times=spike_times,
+                                 spike_clusters=spike_clusters,
+                                 sample_rate=20000.)
+        store.excerpt_size = 100
+        store.n_excerpts = 10
+        return store
+
+    # The correlograms of a selection do not depend on the previous
+    # selections.
+    store = _store()
+    store.get([0, 1], **params)
+    ae(store.get(range(6), **params), _store().get(range(6), **params))
+    ae(store.get([0, 1], **params), _store().get([0, 1], **params))
+
+    # Unsubsampled pairs are shared between selections.
+    store = _store()
+    store.excerpt_size = 10000
+    store.get([0, 1], **params)
+    store.get(range(6), **params)
+    assert len(store) == 36
@@ -17,8 +17,13 @@ from ..clusters import (mean,
                         get_sorted_main_channels,
                         get_mean_masked_features_distance,
                         get_waveform_amplitude,
+                        get_masked_features_vectors,
+                        pairwise_distances,
+                        ClusterNeighbors,
+                        ClusterChannelIndex,
                         )
 from phy.electrode.mea import staggered_positions
+from phy.utils import Bunch
 from phy.io.mock import (artificial_features,
                          artificial_masks,
                          artificial_waveforms,
@@ -143,3 +148,91 @@ def test_mean_masked_features_distance(features,
     d_computed = get_mean_masked_features_distance(f0, f1, m0, m1,
                                                    n_features_per_channel)
     ac(d_expected, d_computed)
+
+
+def test_masked_features_vectors(n_channels, n_features_per_channel):
+    n_clusters = 5
+    mean_features = np.random.randn(n_clusters, n_channels,
+                                    n_features_per_channel)
+    mean_masks = np.random.rand(n_clusters, n_channels)
+    vectors = get_masked_features_vectors(mean_features, mean_masks)
+    assert vectors.shape == (n_clusters, n_channels * n_features_per_channel)
+
+    dist = pairwise_distances(vectors)
+    assert dist.shape == (n_clusters, n_clusters)
+    for i in range(n_clusters):
+        for j in range(n_clusters):
+            d = get_mean_masked_features_distance(mean_features[i],
+                                                  mean_features[j],
+                                                  mean_masks[i],
+                                                  mean_masks[j],
+                                                  n_features_per_channel)
+            ac(dist[i, j], d, atol=1e-6)
+
+
+def test_cluster_neighbors():
+    vectors = {c: np.random.randn(3) for c in range(20)}
+
+    def get_vectors(cluster_ids):
+        return np.array([vectors[c] for c in cluster_ids])
+
+    def _expected(cluster_id, cluster_ids, k):
+        x = get_vectors(cluster_ids)
+        d = np.sqrt(((x - vectors[cluster_id]) ** 2).sum(axis=1))
+        order = np.argsort(d, kind='mergesort')[:k]
+        return [int(cluster_ids[i]) for i in order], d[order]
+
+    def _check(nn, cluster_ids):
+        for c in cluster_ids:
+            ids, dist = _expected(c, cluster_ids, nn.n_neighbors)
+            out = nn.neighbors(c)
+            assert [_[0] for _ in out] == ids
+            ac([_[1] for _ in out], dist, atol=1e-6)
+
+    nn = ClusterNeighbors(get_vectors, n_neighbors=5, block_size=7)
+    cluster_ids = list(range(15))
+    nn.update(cluster_ids)
+    _check(nn, cluster_ids)
+    assert nn.neighbors(100) == []
+
+    # Merge 0, 1, 2 into 15.
+    vectors[15] = np.random.randn(3)
+    _calls = []
+
+    def get_vectors_calls(cluster_ids):
+        _calls.append(list(cluster_ids))
+        return get_vectors(cluster_ids)
+
+    nn.get_vectors = get_vectors_calls
+    nn.on_cluster(Bunch(added=[15], deleted=[0, 1, 2]))
+    cluster_ids = list(range(3, 16))
+    _check(nn, cluster_ids)
+    # Only the vectors of the new cluster are computed.
+    assert _calls == [[15]]
+
+    # Fewer clusters than neighbours.
+    nn.update([4, 5])
+    _check(nn, [4, 5])
+
+
+def test_cluster_channel_index():
+    channel_positions = np.c_[np.zeros(5), np.arange(5)]
+    best = {0: 0, 1: 4, 2: 1, 3: 2, 4: 0, 5: 3}
+    _calls = []
+
+    def get_best_channels(cluster_ids):
+        _calls.append(list(cluster_ids))
+        return [best[c] for c in cluster_ids]
+
+    index = ClusterChannelIndex(channel_positions, get_best_channels)
+    index.update([0, 1, 2, 3, 4])
+    ae(index.best_channel_positions([1, 3]), [[0, 4], [0, 2]])
+
+    assert index.closest(0) == [(0, 0.), (4, 0.), (2, 1.), (3, 2.), (1, 4.)]
+    assert index.closest(3, 3) == [(3, 0.), (2, 1.), (0, 2.)]
+    assert index.closest(10) == []
+
+    # Merge 0 and 1 into 5.
+    index.on_cluster(Bunch(added=[5], deleted=[0, 1]))
+    assert _calls[-1] == [5]
+    assert index.closest(5) == [(5, 0.), (3, 1.), (2, 2.), (4, 3.)]
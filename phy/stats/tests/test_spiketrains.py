@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of spike train statistics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+
+from ..spiketrains import (isi_histograms,
+                           refractory_violations,
+                           firing_rates,
+                           firing_rates_over_time,
+                           spike_train_stats,
+                           SpikeTrainStats,
+                           )
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _data():
+    spike_times = np.array([0., .0005, .003, .010, .0105, .5, 1.2, 1.9])
+    spike_clusters = np.array([0, 0, 3, 0, 3, 3, 0, 5])
+    return spike_times, spike_clusters
+
+
+def test_isi_histograms():
+    spike_times, spike_clusters = _data()
+    hist = isi_histograms(spike_times, spike_clusters,
+                          bin_size=1e-3, window_size=.01)
+    assert hist.shape == (3, 10)
+    # Cluster 0: ISIs of .5, 9.5 and 1190 ms.
+    ae(hist[0], [1, 0, 0, 0, 0, 0, 0, 0, 0, 1])
+    # Cluster 3: ISIs of 7.5 and 489.5 ms.
+    ae(hist[1], [0, 0, 0, 0, 0, 0, 0, 1, 0, 0])
+    ae(hist[2], 0)
+
+    # Subset of clusters.
+    hist = isi_histograms(spike_times, spike_clusters, cluster_ids=[3],
+                          bin_size=1e-3, window_size=.01)
+    ae(hist, [[0, 0, 0, 0, 0, 0, 0, 1, 0, 0]])
+
+
+def test_refractory_violations():
+    spike_times, spike_clusters = _data()
+    ac(refractory_violations(spike_times, spike_clusters,
+                             refractory_period=1e-3), [.25, 0, 0])
+    ac(refractory_violations(spike_times, spike_clusters,
+                             refractory_period=1e-2), [.5, 1. / 3, 0])
+
+
+def test_firing_rates():
+    spike_times, spike_clusters = _data()
+    ac(firing_rates(spike_times, spike_clusters), [4 / 1.9, 3 / 1.9, 1 / 1.9])
+    ac(firing_rates(spike_times, spike_clusters, cluster_ids=[5, 0],
+                    duration=2.), [.5, 2.])
+
+    rates = firing_rates_over_time(spike_times, spike_clusters,
+                                   bin_size=1.)
+    ac(rates, [[3, 1], [3, 0], [0, 1]])
+
+
+def test_spike_train_stats():
+    n = 10000
+    spike_times = np.cumsum(np.random.exponential(.01, n))
+    spike_clusters = np.random.randint(0, 20, n)
+    kwargs = dict(duration=spike_times[-1] + 1.)
+
+    stats = spike_train_stats(spike_times, spike_clusters, **kwargs)
+    ae(stats.cluster_ids, np.arange(20))
+    ae(stats.n_spikes, np.bincount(spike_clusters))
+    ac(stats.firing_rate, firing_rates(spike_times, spike_clusters,
+                                       **kwargs))
+    ac(stats.refractory_violations,
+       refractory_violations(spike_times, spike_clusters))
+    ae(stats.isi_histogram, isi_histograms(spike_times, spike_clusters))
+    ac(stats.rate_over_time,
+       firing_rates_over_time(spike_times, spike_clusters, **kwargs))
+    ac(stats.rate_over_time.mean(axis=1) * stats.rate_over_time.shape[1] *
+       60., stats.n_spikes)
+
+
+def test_spike_train_stats_class():
+    spike_times, spike_clusters = _data()
+    s = SpikeTrainStats(spike_times=spike_times,
+                        spike_clusters=spike_clusters,
+                        duration=2.,
+                        refractory_period=1e-3,
+                        )
+    assert s.firing_rate(0) == 2.
+    assert s.refractory_violations(0) == .25
+    ae(s.stats.cluster_ids, [0, 3, 5])
+
+    # New cluster.
+    spike_clusters[[2, 4]] = 10
+    assert s.firing_rate(10) == 1.
+    ae(s.stats.cluster_ids, [0, 3, 5, 10])
@@ -8,6 +8,7 @@
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
 from pytest import raises, yield_fixture
 
 from phy.io.mock import artificial_traces, artificial_spike_samples
@@ -235,6 +236,31 @@ def test_loader_channels():
         loader[500:510]
 
 
+def test_loader_windows():
+    n_samples_trace, n_channels = 100, 5
+    traces = artificial_traces(n_samples_trace, n_channels)
+
+    loader = WaveformLoader(traces,
+                            n_samples_waveforms=(4, 6),
+                            filter_margin=3,
+                            channels=[1, 3, 4])
+
+    # Unsorted, duplicate, overlapping, isolated and edge times.
+    times = np.array([50, 0, 99, 52, 3, 50, 70, 96, 20, 51])
+    windows = loader._load_windows(times)
+    assert windows.shape == (10, 13, 3)
+    for i, t in enumerate(times):
+        ae(windows[i], loader._load_at(t))
+
+    assert loader._load_windows(np.array([], dtype=np.int64)).shape == \
+        (0, 13, 3)
+
+    # Invalid times are left to zero.
+    waveforms = loader[[-1, 50, 200]]
+    ae(waveforms[[0, 2]], 0)
+    ae(waveforms[1], traces[46:56, [1, 3, 4]])
+
+
 def test_loader_filter():
     traces = np.c_[np.arange(20), np.arange(20, 40)].astype(np.int32)
     n_samples_trace, n_channels = traces.shape
@@ -252,3 +278,81 @@ def test_loader_filter():
     waveform_filtered = loader[t]
     traces_filtered = my_filter(traces)
     assert np.allclose(waveform_filtered, traces_filtered[t - h:t + h, :])
+
+
+def test_loader_filter_blocks():
+    n_samples_trace, n_channels = 1000, 4
+    traces = artificial_traces(n_samples_trace, n_channels)
+    h = 5
+
+    def my_filter(x, axis=0):
+        return x * x
+
+    loader = WaveformLoader(traces,
+                            n_samples_waveforms=(h, h),
+                            filter=my_filter,
+                            filter_margin=3,
+                            filter_block_size=64,
+                            channels=[0, 2, 3],
+                            scale_factor=.5,
+                            )
+    traces_filtered = my_filter(np.r_[np.zeros((h, n_channels)),
+                                      traces,
+                                      np.zeros((h, n_channels))])
+    traces_filtered = traces_filtered[:, [0, 2, 3]] * .5
+
+    # Edges, waveforms spanning two blocks, and duplicates.
+    times = np.array([500, 0, 62, 999, 64, 4, 500, 127, 995])
+    waveforms = loader[times]
+    assert waveforms.shape == (9, 2 * h, 3)
+    for i, t in enumerate(times):
+        ac(waveforms[i], traces_filtered[t:t + 2 * h])
+
+    # The filtered blocks are cached.
+    n_blocks = len(loader._blocks)
+    assert n_blocks == 6
+    loader[times[::-1]]
+    assert len(loader._blocks) == n_blocks
+
+    # Invalid times are left to zero.
+    waveforms = loader[[-1, 100]]
+    ae(waveforms[0], 0)
+    ac(waveforms[1], traces_filtered[100:100 + 2 * h])
+
+    # Same dtype as without blocks.
+    for dtype in (np.float32, np.int64):
+        kwargs = dict(n_samples_waveforms=(h, h), filter=my_filter,
+                      filter_margin=3, dtype=dtype)
+        w = WaveformLoader(traces.astype(dtype), **kwargs)[times]
+        wb = WaveformLoader(traces.astype(dtype), filter_block_size=64,
+                            **kwargs)[times]
+        assert w.dtype == wb.dtype == dtype
+
+    # Changing the channels clears the cache.
+    loader.channels = [1]
+    assert len(loader._blocks) == 0
+    ac(loader[100][0, :, 0], .5 * traces[95:105, 1] ** 2)
+
+
+def test_loader_filter_blocks_bandpass():
+    n_samples_trace, n_channels = 5000, 3
+    traces = artificial_traces(n_samples_trace, n_channels)
+    b_filter = bandpass_filter(rate=1000, low=50, high=200, order=3)
+
+    def my_filter(x, axis=0):
+        return apply_filter(x, b_filter, axis=axis)
+
+    loader = WaveformLoader(traces,
+                            n_samples_waveforms=20,
+                            filter=my_filter,
+                            filter_margin=200,
+                            filter_block_size=1000,
+                            )
+    times = artificial_spike_samples(50, max_isi=90) + 100
+    waveforms = loader[times]
+    traces_filtered = my_filter(traces)
+    expected = np.array([traces_filtered[t - 10:t + 10] for t in times])
+    ac(waveforms, expected, atol=1e-3)
+    unblocked = WaveformLoader(traces, n_samples_waveforms=20,
+                               filter=my_filter, filter_margin=200)
+    assert waveforms.dtype == unblocked[times].dtype
@@ -9,10 +9,11 @@
 import logging
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from scipy.interpolate import interp1d
 
 from ..utils._types import _as_array, Bunch
-from phy.io.array import _pad, _get_padded
+from phy.io.array import _pad, _get_padded, LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -191,7 +192,11 @@ class WaveformLoader(object):
                  scale_factor=None,
                  dc_offset=None,
                  dtype=None,
+                 filter_block_size=None,
+                 max_block_bytes=2 ** 27,
                  ):
+        # Cache of the filtered blocks: {block_index: block}.
+        self._blocks = LRUCache(max_bytes=max_block_bytes)
         if traces is not None:
             self.traces = traces
         else:
@@ -218,6 +223,10 @@ class WaveformLoader(object):
         # Number of samples in the extracted raw data chunk.
         self._n_samples_extract = (self.n_samples_waveforms +
                                    sum(self._filter_margin))
+        # If set, the traces are filtered in aligned blocks of that many
+        # samples (with the filter margin on both sides), and the
+        # waveforms are cut out of the filtered blocks.
+        self.filter_block_size = filter_block_size
 
     @property
     def offset(self):
@@ -240,6 +249,7 @@ class WaveformLoader(object):
     def traces(self, value):
         self.n_samples_trace, self.n_channels_traces = value.shape
         self._traces = value
+        self._blocks.clear()
 
     @property
     def channels(self):
@@ -249,6 +259,7 @@ class WaveformLoader(object):
     @channels.setter
     def channels(self, value):
         self._channels = value
+        self._blocks.clear()
 
     @property
     def n_channels_waveforms(self):
@@ -258,6 +269,59 @@ class WaveformLoader(object):
         else:
             return self.n_channels_traces
 
+    def _filtered_block(self, k):
+        """Return the filtered block `k` on the selected channels."""
+        block = self._blocks.get(k)
+        if block is not None:
+            return block
+        bs = self.filter_block_size
+        margin_before, margin_after = self._filter_margin
+        start, stop = k * bs - margin_before, (k + 1) * bs + margin_after
+        # Raw chunk, with zeros out of the traces.
+        nc = self.n_channels_waveforms
+        # NOTE: like the waveforms filtered one by one, the filter input
+        # has the loader's dtype.
+        chunk = np.zeros((stop - start, nc), dtype=self.dtype)
+        a, b = max(start, 0), min(stop, self.n_samples_trace)
+        if a < b:
+            raw = self._traces[a:b]
+            if self._channels is not None:
+                raw = raw[:, self._channels]
+            chunk[a - start:b - start] = raw
+        block = self._filter(chunk, axis=0)[margin_before:margin_before + bs]
+        block = np.ascontiguousarray(block)
+        self._blocks.set(k, block)
+        return block
+
+    def _load_filtered(self, times):
+        """Cut the waveforms at many valid times (relative to the offset)
+        out of the filtered blocks."""
+        bs = self.filter_block_size
+        n = self.n_samples_waveforms
+        nc = self.n_channels_waveforms
+        out = np.zeros((len(times), n, nc), dtype=self.dtype)
+        starts = times - self.n_samples_before_after[0]
+        # First and last block of every waveform.
+        first = starts // bs
+        last = (starts + n - 1) // bs
+        order = np.argsort(first, kind='mergesort')
+        blocks, bounds = np.unique(first[order], return_index=True)
+        bounds = np.r_[bounds, len(order)]
+        # Process the waveforms starting in the same block together.
+        for k, i, j in zip(blocks, bounds[:-1], bounds[1:]):
+            ind = order[i:j]
+            data = np.concatenate([self._filtered_block(int(m))
+                                   for m in range(k, last[ind].max() + 1)])
+            s0, s1 = data.strides
+            windows = as_strided(data, shape=(len(data) - n + 1, n, nc),
+                                 strides=(s0, s0, s1))
+            # The output has the dtype of the filtered data, as when the
+            # waveforms are filtered one by one.
+            if out.dtype != data.dtype:
+                out = out.astype(data.dtype)
+            out[ind] = windows[starts[ind] - k * bs]
+        return out
+
     def _load_at(self, time):
         """Load a waveform at a given time."""
         time = int(time)
@@ -285,6 +349,61 @@ class WaveformLoader(object):
                                  self.n_channels_waveforms)
         return extract
 
+    def _load_windows(self, times):
+        """Load the raw chunks at many valid times (relative to the offset).
+
+        The windows are sorted and the overlapping or adjacent ones are
+        merged into contiguous blocks, which are read in order in a single
+        pass. All chunks are then gathered from the blocks with a single
+        index, and the samples out of the traces are set to zero.
+
+        """
+        n = self._n_samples_extract
+        ns = self.n_samples_trace
+        nc = self.n_channels_waveforms
+        if len(times) == 0:
+            return np.zeros((0, n, nc), dtype=self._traces.dtype)
+        before = self.n_samples_before_after[0] + self._filter_margin[0]
+        order = np.argsort(times, kind='mergesort')
+        starts = times[order] - before
+        # All windows have the same size, so the stops are sorted too.
+        starts_c = np.clip(starts, 0, ns)
+        stops_c = np.clip(starts + n, 0, ns)
+        # Groups of overlapping or adjacent windows.
+        first = np.r_[0, np.nonzero(starts_c[1:] > stops_c[:-1])[0] + 1]
+        last = np.r_[first[1:], len(starts)] - 1
+        group = np.repeat(np.arange(len(first)), last - first + 1)
+        block_starts = starts_c[first]
+        block_stops = stops_c[last]
+
+        # Read all blocks at once with sorted sample indices.
+        lengths = block_stops - block_starts
+        block_offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+        rows = (np.arange(lengths.sum()) +
+                np.repeat(block_starts - block_offsets, lengths))
+        data = self._traces[rows]
+        if self._channels is not None:
+            data = data[:, self._channels]
+
+        # Zeros for the samples out of the traces.
+        pad_before = max(0, -starts[0])
+        pad_after = max(0, starts[-1] + n - ns)
+        if pad_before or pad_after:
+            data = np.concatenate((np.zeros((pad_before, nc), data.dtype),
+                                   data,
+                                   np.zeros((pad_after, nc), data.dtype)))
+            block_offsets += pad_before
+
+        # Gather all windows with a single index in a strided view of the
+        # blocks, in the original order of the times.
+        offsets = np.empty_like(starts)
+        offsets[order] = starts - block_starts[group] + block_offsets[group]
+        data = np.ascontiguousarray(data)
+        s0, s1 = data.strides
+        windows = as_strided(data, shape=(len(data) - n + 1, n, nc),
+                             strides=(s0, s0, s1))
+        return windows[offsets]
+
     def __getitem__(self, item):
         """Load waveforms."""
         if isinstance(item, slice):
@@ -304,24 +423,34 @@ class WaveformLoader(object):
         # No traces: return null arrays.
         if self.n_samples_trace == 0:
             return np.zeros(shape, dtype=self.dtype)
-        waveforms = np.zeros(shape, dtype=self.dtype)
-
-        # Load all spikes.
-        for i, time in enumerate(spikes):
-            try:
-                waveforms[i, ...] = self._load_at(time)
-            except ValueError as e:  # pragma: no cover
-                logger.warn("Error while loading waveform: %s", str(e))
-
-        # Filter the waveforms.
-        if self._filter is not None:
-            waveforms = self._filter(waveforms, axis=1)
 
-        # Remove the margin.
-        margin_before, margin_after = self._filter_margin
-        if margin_after > 0:
-            assert margin_before >= 0
-            waveforms = waveforms[:, margin_before:-margin_after, :]
+        # Load all spikes. The waveforms at invalid times are null.
+        times = spikes.astype(np.int64) - self._offset
+        valid = (0 <= times) & (times < self.n_samples_trace)
+        filter_blocks = self._filter is not None and self.filter_block_size
+        load = self._load_filtered if filter_blocks else self._load_windows
+        if np.all(valid):
+            waveforms = load(times)
+        else:
+            logger.warn("Error while loading waveforms: %d invalid time(s).",
+                        np.sum(~valid))
+            loaded = load(times[valid])
+            waveforms = np.zeros((n_spikes,) + loaded.shape[1:],
+                                 dtype=loaded.dtype)
+            waveforms[valid] = loaded
+
+        if not filter_blocks:
+            waveforms = waveforms.astype(self.dtype, copy=False)
+
+            # Filter the waveforms.
+            if self._filter is not None:
+                waveforms = self._filter(waveforms, axis=1)
+
+            # Remove the margin.
+            margin_before, margin_after = self._filter_margin
+            if margin_after > 0:
+                assert margin_before >= 0
+                waveforms = waveforms[:, margin_before:-margin_after, :]
 
         # Transform.
         if self._dc_offset: